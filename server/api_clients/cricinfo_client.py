@@ -1,31 +1,116 @@
 from logging import warn
 import bs4
 from bs4 import BeautifulSoup
+import lxml.html
+import os
 import aiohttp
 import re
 import urllib
 import logging
+from datetime import datetime, timedelta
 from utils.logging import time_logger
 from cache import PersistentCache
+from utils.singleflight import SingleFlight
+from player_directory import PlayerDirectory
+from typing import Optional
 import json
 
 logger = logging.getLogger(__name__)
 
+# statsguru results whose span/season ended before this many days ago are treated as final
+SETTLED_AFTER_DAYS = 3
+SETTLED_TTL = 365 * 24 * 3600
+OPEN_TTL = 6 * 3600
+
+# shared connection pool, statsguru and google are the only hosts we talk to
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 20
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 60
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# parse statsguru tables with lxml, the BeautifulSoup path is kept as the fallback
+use_fast_parser = os.environ.get("FAST_HTML_PARSER", 'True').lower() == 'true'
+
+NON_TEXT_TAGS = ["script", "style", "template"]
+
+# every statsguru dropdown is on the advanced filter page
+DROPDOWN_URL = "https://stats.espncricinfo.com/ci/engine/stats/index.html?class=11;filter=advanced;type=batting"
+DROPDOWN_SELECTS = ["ground", "trophy", "series", "season", "team", "opposition", "host", "continent"]
+
+ENGINE_TABLES_XPATH = "//table[contains(concat(' ', normalize-space(@class), ' '), ' engineTable ')]"
+
 class CricInfoClient:
-    def __init__(self, cache: PersistentCache):
+    def __init__(self, cache: PersistentCache, player_directory: Optional[PlayerDirectory] = None):
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
         }
         self.cache: PersistentCache = cache
+        self.session: aiohttp.ClientSession = None
+        # concurrent misses for the same page or player share one fetch
+        self.flight = SingleFlight("cricinfo")
+        # players of the cricsheet register are resolved locally, only unknown names go through google
+        self.player_directory = player_directory
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # created lazily, the session has to be bound to the running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=CONNECTION_LIMIT,
+                limit_per_host=CONNECTION_LIMIT_PER_HOST,
+                ttl_dns_cache=DNS_CACHE_TTL,
+                keepalive_timeout=KEEPALIVE_TIMEOUT
+            )
+            timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers)
+
+        return self.session
+
+    async def fetch(self, url: str) -> str:
+        async with self.get_session().get(url) as response:
+            return await response.text()
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
     
     @time_logger()
     async def get_search_data(self, url, class_name: str = None):
 
+        cache_id = f"statsguru_page_{class_name}_{CricInfoClient.canonical_url(url)}"
+
+        cache_str = await self.cache.get(cache_id)
+
+        if cache_str is not None:
+            return json.loads(cache_str)
+
+        return await self.flight.do(cache_id, lambda: self.load_search_data(cache_id, url, class_name))
+
+    async def load_search_data(self, cache_id: str, url, class_name: str = None):
+        results = await self.fetch_search_data(url, class_name)
+
+        await self.cache.set(cache_id, json.dumps(results), ttl=CricInfoClient.get_ttl(url, results))
+
+        return results
+
+    async def fetch_search_data(self, url, class_name: str = None):
+
         # Send a GET request to the URL
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers) as response:
-                html = await response.text()
+        html = await self.fetch(url)
+
+        if use_fast_parser:
+            try:
+                return CricInfoClient.extract_search_results_fast(html, class_name)
+            except Exception as e:
+                logger.warning(f"Fast statsguru parser failed, falling back to BeautifulSoup: {e}")
+
+        return CricInfoClient.extract_search_results(html, class_name)
 
+    @staticmethod
+    def extract_search_results(html: str, class_name: str = None):
         # Parse the HTML
         soup = BeautifulSoup(html, 'html.parser')
 
@@ -47,6 +132,12 @@ class CricInfoClient:
     @time_logger()
     async def get_cricinfo_player(self, player: str):
 
+        if self.player_directory is not None:
+            player_info = self.player_directory.lookup(player)
+
+            if player_info is not None:
+                return player_info
+
         player_cache_id = f"cricinfo_player_{player}"
 
         player_cache_str = await self.cache.get(player_cache_id)
@@ -55,15 +146,16 @@ class CricInfoClient:
             player_cache = json.loads(player_cache_str)
             return player_cache["player_name"], player_cache["player_id"]
 
+        return await self.flight.do(player_cache_id, lambda: self.load_cricinfo_player(player_cache_id, player))
+
+    async def load_cricinfo_player(self, player_cache_id: str, player: str):
         player = player.replace(' ', '+')
 
         query = f"{player}+cricinfo+stats"
 
         url = f"https://www.google.com/search?q={query}"
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers) as response:
-                html = await response.text()
+        html = await self.fetch(url)
         
         soup = BeautifulSoup(html, 'html.parser')
 
@@ -97,9 +189,7 @@ class CricInfoClient:
 
         url = f"https://stats.espncricinfo.com/ci/engine/stats/index.html?class=11;filter=advanced;type=allround;search_player={search_player_name}"
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers) as response:
-                html = await response.text()
+        html = await self.fetch(url)
 
         soup = BeautifulSoup(html, 'html.parser')
 
@@ -171,6 +261,63 @@ class CricInfoClient:
 
         return None, None # If no information found
     
+    @staticmethod
+    def canonical_url(url: str) -> str:
+        # same query with the parameters in a fixed order, statsguru accepts both ; and & as separators
+        parsed_url = urllib.parse.urlparse(url)
+        params = sorted(param for param in re.split(r"[;&]", parsed_url.query) if param)
+
+        return f"{parsed_url.netloc}{parsed_url.path}?{'&'.join(params)}"
+
+    @staticmethod
+    def get_ttl(url: str, results: list = None) -> int:
+        """Cache lifetime of a statsguru page, based on when its span/season filters end.
+
+        Args:
+            url: The statsguru query url.
+            results: The rows parsed from the page, if known.
+
+        Returns:
+            SETTLED_TTL if the filters end in the past, OPEN_TTL if they are open ended or the page had no rows.
+        """
+        # an empty page may be a transient statsguru failure, don't keep it for a year
+        if results is not None and not results:
+            return OPEN_TTL
+
+        params = urllib.parse.parse_qs(re.sub(r";", "&", urllib.parse.urlparse(url).query))
+
+        end_dates = []
+
+        for value in params.get("spanmax1", []):
+            try:
+                end_dates.append(datetime.strptime(value, "%d+%b+%Y"))
+            except ValueError:
+                try:
+                    end_dates.append(datetime.strptime(value, "%d %b %Y"))
+                except ValueError:
+                    return OPEN_TTL
+
+        seasons = params.get("season", [])
+        for season in seasons:
+            # 2019, 2019/20 or 2019/2020, the season ends with its last year
+            years = re.findall(r"\d+", season)
+            if not years:
+                return OPEN_TTL
+
+            start_year = int(years[0])
+            end_year = start_year + 1 if len(years) > 1 else start_year
+
+            end_dates.append(datetime(end_year, 12, 31))
+
+        # an open ended span or a season filter without a span end
+        if not end_dates or ("spanmax1" not in params and "spanmin1" in params):
+            return OPEN_TTL
+
+        if max(end_dates) < datetime.now() - timedelta(days=SETTLED_AFTER_DAYS):
+            return SETTLED_TTL
+
+        return OPEN_TTL
+
     @staticmethod
     def extract_table_data(tables, class_ = "headlinks"):
         # Find the table that contains rows with class 'data1' and 'headlinks'
@@ -202,20 +349,123 @@ class CricInfoClient:
 
         return results
     
+    @staticmethod
+    def extract_search_results_fast(html: str, class_name: str = None):
+        """Same results as the BeautifulSoup path of fetch_search_data, using the lxml C parser and only
+        walking the engineTable nodes.
+
+        Args:
+            html: The statsguru page.
+            class_name: "player" to include the career summary rows.
+
+        Returns:
+            The list of row dicts, keyed by the table headers.
+        """
+        tables = lxml.html.fromstring(html).xpath(ENGINE_TABLES_XPATH)
+
+        results = []
+
+        if class_name == "player":
+            results.extend(CricInfoClient.extract_table_data_fast(tables, class_="head"))
+
+        results.extend(CricInfoClient.extract_table_data_fast(tables))
+
+        return results
+
+    @staticmethod
+    def extract_table_data_fast(tables, class_ = "headlinks"):
+        # lxml version of extract_table_data, rows are matched on the class token like bs4 does
+        data_xpath = ".//tr[contains(concat(' ', normalize-space(@class), ' '), ' data1 ')]"
+        header_xpath = f".//tr[contains(concat(' ', normalize-space(@class), ' '), ' {class_} ')]"
+
+        table = None
+        for t in tables:
+            if t.xpath(data_xpath) and t.xpath(header_xpath):
+                table = t
+                break
+
+        header_row = table.xpath(header_xpath)[0]
+        headers = [get_stripped_text(th) for th in header_row.iter("th")]
+
+        results = []
+        for row in table.xpath(data_xpath):
+            columns = list(row.iter("td"))
+
+            if len(columns) == 1 and not get_stripped_text(columns[0]):
+                # Skip empty rows
+                continue
+
+            row = {headers[i]: get_stripped_text(columns[i]) for i in range(len(headers))}
+            results.append(row)
+
+        return results
+
     async def get_dropdown_options(self, class_name: str):
+        snapshot = await self.get_dropdown_snapshot([class_name])
 
-        url = f"https://stats.espncricinfo.com/ci/engine/stats/index.html?class=11;filter=advanced;type=batting"
+        return snapshot.get(class_name, {})
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers) as response:
-                html_content = await response.text()
+    async def get_dropdown_snapshot(self, class_names: list[str] = DROPDOWN_SELECTS) -> dict[str, dict[str, str]]:
+        # one fetch and one parse for all the dropdowns, select name -> {option text: option value}
+        html_content = await self.fetch(DROPDOWN_URL)
+
+        if use_fast_parser:
+            try:
+                return CricInfoClient.extract_dropdowns_fast(html_content, class_names)
+            except Exception as e:
+                logger.warning(f"Fast dropdown parser failed, falling back to BeautifulSoup: {e}")
 
         soup = BeautifulSoup(html_content, 'html.parser')
-        select_element = soup.find('select', {'name': class_name})
-        if not select_element:
-            return {}
-        options = select_element.find_all('option')
 
-        dropdown_options = {option.get_text(): option['value'] for option in options}
+        snapshot = {}
+
+        for class_name in class_names:
+            select_element = soup.find('select', {'name': class_name})
+            if not select_element:
+                snapshot[class_name] = {}
+                continue
+            options = select_element.find_all('option')
+
+            snapshot[class_name] = {option.get_text(): option['value'] for option in options}
+
+        return snapshot
+
+    @staticmethod
+    def extract_dropdowns_fast(html: str, class_names: list[str]) -> dict[str, dict[str, str]]:
+        # lxml version of the BeautifulSoup path of get_dropdown_snapshot
+        selects = {}
+        for select in lxml.html.fromstring(html).iter("select"):
+            # the first select with the name wins, same as soup.find
+            selects.setdefault(select.get("name"), select)
+
+        snapshot = {}
+
+        for class_name in class_names:
+            select = selects.get(class_name)
+
+            snapshot[class_name] = {} if select is None else {
+                option.text_content(): option.attrib["value"] for option in select.iter("option")
+            }
+
+        return snapshot
+
+
+@staticmethod
+def get_stripped_text(element) -> str:
+    # same as bs4 get_text(strip=True)
+    texts = []
+    collect_stripped_text(element, texts)
+    return "".join(texts)
+
+@staticmethod
+def collect_stripped_text(element, texts: list[str]):
+    if element.text and element.text.strip():
+        texts.append(element.text.strip())
+
+    for child in element:
+        # bs4 leaves out comments and script/style/template contents
+        if not isinstance(child, lxml.html.HtmlComment) and child.tag not in NON_TEXT_TAGS:
+            collect_stripped_text(child, texts)
 
-        return dropdown_options
+        if child.tail and child.tail.strip():
+            texts.append(child.tail.strip())
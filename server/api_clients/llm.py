@@ -31,25 +31,46 @@ class OpenAIClient:
 
     @time_logger()
     async def get_response(self, system_prompt: str, query: str, history: Optional[list[dict]] = None):
-        system_prompt = {"role": "system", "content": system_prompt}
+        messages = build_messages(system_prompt, query, history)
 
-        query = {"role": "user", "content": query}
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+        )
 
-        # add system prompt
-        messages = [system_prompt]
+        return response.choices[0].message.content
 
-        # add history
-        if history:
-            for h in history:
-                if h.get("role") and h.get("content"):
-                    messages.append({"role": h.get("role"), "content": h.get("content")})
-        
-        # add query
-        messages.append(query)
+    async def get_response_stream(self, system_prompt: str, query: str, history: Optional[list[dict]] = None):
+        # yields the content deltas as the model produces them
+        messages = build_messages(system_prompt, query, history)
 
-        response = await self.client.chat.completions.create(
+        stream = await self.client.chat.completions.create(
             model=self.model,
             messages=messages,
+            stream=True,
         )
 
-        return response.choices[0].message.content
\ No newline at end of file
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+@staticmethod
+def build_messages(system_prompt: str, query: str, history: Optional[list[dict]] = None) -> list[dict]:
+    system_prompt = {"role": "system", "content": system_prompt}
+
+    query = {"role": "user", "content": query}
+
+    # add system prompt
+    messages = [system_prompt]
+
+    # add history
+    if history:
+        for h in history:
+            if h.get("role") and h.get("content"):
+                messages.append({"role": h.get("role"), "content": h.get("content")})
+    
+    # add query
+    messages.append(query)
+
+    return messages
\ No newline at end of file
@@ -1,22 +1,58 @@
 from typing import Optional
+from contextlib import asynccontextmanager
+import asyncio
+import json
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from cricgpt import CricGPT
+from cricgpt import CricGPT, get_request_key
 from api_clients.cricinfo_client import CricInfoClient
 from api_clients.llm import OpenAIClient
 from id_mapper import IdMapper
 import sys
 import argparse
 import logging
-from cache import PersistentCache
+from cache import PersistentCache, LRUCache
 from store import LocalSessionStore, SessionStore, Session, SessionCronJob
 from datetime import datetime, timedelta, timezone
 from utils.utils import datetime_to_epoch
+from db.sqlclient import SQLClient
+from db.stats_engine import LocalStatsEngine
+from similarity_cache import SimilarityCache
+from utils.singleflight import SingleFlight
+from player_directory import PlayerDirectory
+import os
+
+# hot keys (player ids, statsguru pages) are served from memory, the sqlite cache is shared across workers
+cache_max_size_mb = int(os.environ.get("CACHE_MAX_SIZE_MB", '512'))
+cache_eviction_policy = os.environ.get("CACHE_EVICTION_POLICY", 'lru').lower()
+persistent_cache = PersistentCache(max_size_bytes=cache_max_size_mb * 1024 * 1024, eviction_policy=cache_eviction_policy)
+cache = LRUCache(persistent_cache)
+# local name -> cricinfo id lookups from the cricsheet people register, empty until built with "python -m player_directory"
+player_directory = PlayerDirectory.load()
+cricinfo_client = CricInfoClient(cache=cache, player_directory=player_directory)
+id_mapper = IdMapper(cricinfo_client, cache=cache, player_directory=player_directory)
+openai_client = OpenAIClient(model="gpt4o")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # expire, evict and compact the sqlite cache in the background
+    sweeper = asyncio.create_task(persistent_cache.run_sweeper())
+    # refresh the statsguru dropdowns before they expire, requests keep using the old ones meanwhile
+    refresher = asyncio.create_task(id_mapper.run_refresher())
+
+    yield
+
+    sweeper.cancel()
+    refresher.cancel()
+    # close the pooled statsguru connections and flush the buffered cache writes on shutdown
+    await cricinfo_client.close()
+    await cache.close()
 
 # Fast api code
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
@@ -28,10 +64,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-cache = PersistentCache()
-cricinfo_client = CricInfoClient(cache=cache)
-id_mapper = IdMapper(cricinfo_client, cache=cache)
-openai_client = OpenAIClient(model="gpt4o")
+# answer the supported queries from the local ball by ball database instead of statsguru
+use_local_stats = os.environ.get("USE_LOCAL_STATS", 'False').lower() == 'true'
+stats_engine = LocalStatsEngine(SQLClient().engine) if use_local_stats else None
+
+# reuse the resolved parameters of near duplicate sub-queries, shared by all requests of this worker
+similarity_cache = SimilarityCache()
+
+# identical /stats requests in flight at the same time (a trending question) share one execution
+stats_flight = SingleFlight("stats")
+
 localstore = LocalSessionStore()
 # sessionstore = SessionStore()
 # sessioncronjob = SessionCronJob(localstore, sessionstore)
@@ -66,10 +108,40 @@ class LikeUnlikeParams(BaseModel):
 
 @app.post("/stats")
 async def process_data(data: Query):
-    cricgpt = CricGPT(openai_client=openai_client, cricinfo_client=cricinfo_client, id_mapper=id_mapper)
-    response = await cricgpt.execute(data.query, data.history)
+    cricgpt = CricGPT(openai_client=openai_client, cricinfo_client=cricinfo_client, id_mapper=id_mapper, stats_engine=stats_engine, cache=cache, similarity_cache=similarity_cache)
+    response = await stats_flight.do(get_request_key(data.query, data.history), lambda: cricgpt.execute(data.query, data.history))
     return response
 
+@app.post("/stats/stream")
+async def stream_data(data: Query):
+    # same as /stats, but sends each stage as a server sent event as soon as it's ready
+    cricgpt = CricGPT(openai_client=openai_client, cricinfo_client=cricinfo_client, id_mapper=id_mapper, stats_engine=stats_engine, cache=cache, similarity_cache=similarity_cache)
+
+    async def events():
+        try:
+            async for event, payload in cricgpt.execute_stream(data.query, data.history):
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        except Exception as e:
+            logging.exception(e)
+            yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+
+    # no-transform/X-Accel-Buffering keep nginx and proxies from holding back the events
+    headers = {"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"}
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+@app.get("/metrics")
+async def get_metrics():
+    return {
+        "stats_requests": stats_flight.stats(),
+        "cricinfo_lookups": cricinfo_client.flight.stats(),
+        "id_lookups": id_mapper.flight.stats(),
+        "dropdowns": id_mapper.options_stats(),
+        "player_directory": player_directory.stats(),
+        "cache": cache.stats(),
+        "similarity_cache": similarity_cache.stats(),
+    }
+
 @app.post("/sharelink")
 async def share_link(data: ShareLinkParams):    
     share_link = "https://cricstatsai.com/id/" + data.sessionId
@@ -1,15 +1,50 @@
 import os
+import time
+import fcntl
+import asyncio
 import pathlib
 import sqlite3
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+# pending value of a key deleted but not yet flushed
+DELETED = object()
+
+# sqlite limits the number of bound parameters per statement
+MAX_KEYS_PER_QUERY = 500
+
+EVICTION_POLICIES = {
+    "lru": "accessed_at ASC",
+    "lfu": "hits ASC, accessed_at ASC",
+}
+
+# rows deleted per statement when evicting, at most MAX_KEYS_PER_QUERY, and pages returned to the os per sweep
+EVICTION_BATCH = 500
+VACUUM_PAGES = 2000
+
 class PersistentCache:
-    def __init__(self, db_path: str = "cricgpt_cache.db"):
+    '''
+    sqlite backed key value cache.
+
+    All sqlite calls run on a single dedicated thread that owns the connection, so the event loop never waits on disk.
+    Writes are buffered and flushed in one transaction every flush_interval seconds (or once max_batch keys are pending),
+    reads see the pending writes before they reach the database.
+
+    Keys can be given a ttl, run_sweeper deletes the expired rows, evicts by the eviction policy (lru or lfu, from the
+    access time and hit count of each key) while the database is over max_size_bytes, and returns the freed pages.
+    '''
+
+    def __init__(self, db_path: str = "cricgpt_cache.db", flush_interval: float = 0.05, max_batch: int = 500,
+                 max_size_bytes: Optional[int] = 512 * 1024 * 1024, eviction_policy: str = "lru"):
         try:
+            if eviction_policy not in EVICTION_POLICIES:
+                raise ValueError(f"Eviction policy {eviction_policy} not found")
+
             self.db_path = os.path.realpath(os.path.expanduser(db_path))
             dir_path = os.path.dirname(self.db_path)
 
@@ -19,8 +54,21 @@ class PersistentCache:
             if not os.path.exists(self.db_path):
                 open(self.db_path, 'a').close()
 
-            self.conn = sqlite3.connect(self.db_path)
-            self._init_db()
+            self.flush_interval = flush_interval
+            self.max_batch = max_batch
+            self.max_size_bytes = max_size_bytes
+            self.eviction_policy = eviction_policy
+
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistent-cache")
+            # key -> (value, expires_at) or DELETED
+            self.pending: dict[str, object] = {}
+            # keys read since the last flush, key -> hits
+            self.accessed: dict[str, int] = {}
+            self.flush_task: Optional[asyncio.Task] = None
+
+            self.conn = None
+            self.executor.submit(self._connect).result()
+            self.executor.submit(self._init_db).result()
         except sqlite3.OperationalError as e:
             logger.error(f"SQLite error: {e}")
             raise
@@ -32,9 +80,17 @@ class PersistentCache:
         self.conn = sqlite3.connect(
             self.db_path,
             timeout=30,
-            isolation_level=None
+            isolation_level=None,
+            check_same_thread=False
         )
 
+        # only takes effect on a new cache file, older ones are converted by the sweeper, see _convert_auto_vacuum
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+        # readers don't block the writer, and a commit doesn't fsync the main database file
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
     def _init_db(self):
         cursor = self.conn.cursor()
         cursor.execute("""
@@ -42,50 +98,357 @@ class PersistentCache:
                 key TEXT PRIMARY KEY,
                 value TEXT NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at REAL,
+                accessed_at REAL,
+                hits INTEGER NOT NULL DEFAULT 0
             )
         """)
-        self.conn.commit()
+
+        # cache files created before expiry was added
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(cache)")}
+        for column, definition in [("expires_at", "REAL"), ("accessed_at", "REAL"), ("hits", "INTEGER NOT NULL DEFAULT 0")]:
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE cache ADD COLUMN {column} {definition}")
+
+        cursor.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at) WHERE expires_at IS NOT NULL")
+        cursor.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
 
     async def get(self, key: str) -> Optional[str]:
+        values = await self.get_many([key])
+        return values.get(key)
+
+    async def get_many(self, keys: list[str]) -> dict[str, str]:
+        '''
+        Returns the cached, unexpired values of the keys found, in one round trip to the cache thread.
+        '''
+        results = {}
+        missing = []
+
+        now = time.time()
+
+        for key in keys:
+            if key in self.pending:
+                entry = self.pending[key]
+                if entry is not DELETED and (entry[1] is None or entry[1] > now):
+                    results[key] = entry[0]
+            else:
+                missing.append(key)
+
+        if missing:
+            try:
+                results.update(await self._run(self._select, missing, now))
+            except Exception as e:
+                logger.error(f"Error getting keys {missing}: {e}")
+
+        # access times are only used for eviction, they are written with the next flush
+        for key in results:
+            self.accessed[key] = self.accessed.get(key, 0) + 1
+
+        if results:
+            self.schedule_flush()
+
+        return results
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        return await self.set_many({key: value}, ttl=ttl)
+
+    async def set_many(self, items: dict[str, str], ttl: Optional[float] = None) -> bool:
+        '''
+        Stores the values, they expire after ttl seconds or never if ttl is None.
+        '''
+        expires_at = time.time() + ttl if ttl is not None else None
+
+        for key, value in items.items():
+            self.pending[key] = (value, expires_at)
+
+        self.schedule_flush()
+        return True
+
+    async def delete(self, key: str) -> bool:
+        self.pending[key] = DELETED
+        self.schedule_flush()
+        return True
+
+    def schedule_flush(self):
+        if len(self.pending) >= self.max_batch:
+            if self.flush_task is None or self.flush_task.done():
+                self.flush_task = asyncio.create_task(self.flush())
+            return
+
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush(delay=self.flush_interval))
+
+    async def flush(self, delay: float = 0):
+        if delay:
+            await asyncio.sleep(delay)
+
+        if not self.pending and not self.accessed:
+            return
+
+        batch = self.pending
+        accessed = self.accessed
+        self.pending = {}
+        self.accessed = {}
+
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT value FROM cache WHERE key = ?", (key,))
-            row = cursor.fetchone()
-            return row[0] if row else None
+            await self._run(self._write, batch, accessed)
         except Exception as e:
-            logger.error(f"Error getting key {key}: {e}")
-            return None
+            logger.error(f"Error writing {len(batch)} cache keys: {e}")
+            # keep the newer pending values, retry the rest with the next flush
+            for key, value in batch.items():
+                self.pending.setdefault(key, value)
+
+        if self.pending:
+            self.schedule_flush()
+
+    async def sweep(self) -> dict:
+        await self.flush()
+        return await self._run(self._sweep)
+
+    async def run_sweeper(self, interval: float = 300):
+        '''
+        Sweeps the cache every interval seconds until cancelled, meant to run as a background task.
+        '''
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                stats = await self.sweep()
+                logger.info(f"Cache sweep: {stats}")
+            except Exception as e:
+                logger.error(f"Error sweeping the cache: {e}")
+
+    async def close(self):
+        await self.flush()
+        await self._run(self.conn.close)
+        self.executor.shutdown(wait=True)
 
-    async def set(self, key: str, value: str) -> bool:
+    def _select(self, keys: list[str], now: float) -> dict[str, str]:
+        results = {}
+        cursor = self.conn.cursor()
+
+        for start in range(0, len(keys), MAX_KEYS_PER_QUERY):
+            chunk = keys[start:start + MAX_KEYS_PER_QUERY]
+            cursor.execute(f"""
+                SELECT key, value FROM cache
+                WHERE key IN ({', '.join('?' * len(chunk))}) AND (expires_at IS NULL OR expires_at > ?)
+            """, chunk + [now])
+            results.update(cursor.fetchall())
+
+        return results
+
+    def _write(self, batch: dict[str, object], accessed: dict[str, int]):
+        now = datetime.now(timezone.utc).isoformat()
+        accessed_at = time.time()
+
+        upserts = [(key, value[0], now, value[1], accessed_at) for key, value in batch.items() if value is not DELETED]
+        deletes = [(key,) for key, value in batch.items() if value is DELETED]
+        accesses = [(accessed_at, hits, key) for key, hits in accessed.items()]
+
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN")
         try:
-            cursor = self.conn.cursor()
-            now = datetime.now(timezone.utc).isoformat()
-            cursor.execute("""
-                INSERT INTO cache (key, value, updated_at)
-                VALUES (?, ?, ?)
+            cursor.executemany("""
+                INSERT INTO cache (key, value, updated_at, expires_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?)
                 ON CONFLICT(key) DO UPDATE
                 SET value = excluded.value,
-                    updated_at = excluded.updated_at
-            """, (key, value, now))
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Error setting key {key}: {e}")
-            return False
+                    updated_at = excluded.updated_at,
+                    expires_at = excluded.expires_at,
+                    accessed_at = excluded.accessed_at
+            """, upserts)
+            cursor.executemany("DELETE FROM cache WHERE key = ?", deletes)
+            cursor.executemany("UPDATE cache SET accessed_at = ?, hits = hits + ? WHERE key = ?", accesses)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
 
-    async def delete(self, key: str) -> bool:
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute("DELETE FROM cache WHERE key = ?", (key,))
-            self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Error deleting key {key}: {e}")
-            return False
+    def _sweep(self) -> dict:
+        cursor = self.conn.cursor()
+
+        expired = cursor.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)).rowcount
+
+        evicted = 0
+        size = self._get_size()
+
+        if self.max_size_bytes is not None and size > self.max_size_bytes:
+            # pick the rows to evict up front by their content size, deleting until the page count drops would
+            # overshoot since partially emptied pages never reach the freelist
+            content_size = cursor.execute("SELECT COALESCE(SUM(length(key) + length(value)), 0) FROM cache").fetchone()[0]
+            excess = content_size * (size - self.max_size_bytes) / size
+
+            keys = []
+            freed = 0
+
+            for key, row_size in cursor.execute(f"SELECT key, length(key) + length(value) FROM cache ORDER BY {EVICTION_POLICIES[self.eviction_policy]}"):
+                if freed >= excess:
+                    break
+
+                keys.append(key)
+                freed += row_size
+
+            for start in range(0, len(keys), EVICTION_BATCH):
+                chunk = keys[start:start + EVICTION_BATCH]
+                evicted += cursor.execute(f"DELETE FROM cache WHERE key IN ({', '.join('?' * len(chunk))})", chunk).rowcount
+
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            self._convert_auto_vacuum()
+
+        cursor.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        return {"expired": expired, "evicted": evicted, "size_bytes": self._get_size()}
+
+    def _convert_auto_vacuum(self):
+        # auto_vacuum of a cache file created before it was set only switches with a full vacuum, which rewrites the
+        # whole file, so only the worker holding the lock runs it and the others see the converted file on a later sweep
+        with open(f"{self.db_path}.vacuum.lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            try:
+                if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                    logger.info(f"Converting {self.db_path} to incremental auto vacuum")
+                    self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    self.conn.execute("VACUUM")
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _get_size(self) -> int:
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+        return (page_count - freelist_count) * page_size
 
     def __del__(self):
         try:
             self.conn.close()
         except:
-            pass
\ No newline at end of file
+            pass
+
+
+class LRUCache:
+    '''
+    Bounded in-memory tier in front of a PersistentCache, reads and writes go through to it.
+
+    Entries are evicted least recently used first once either max_entries or max_bytes is exceeded,
+    and expire after ttl seconds so values written by the other workers are picked up.
+    '''
+
+    def __init__(self, persistent_cache: PersistentCache, max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024, ttl: float = 3600):
+        self.persistent_cache = persistent_cache
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (value, expires_at), in least to most recently used order
+        self.entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        values = await self.get_many([key])
+        return values.get(key)
+
+    async def get_many(self, keys: list[str]) -> dict[str, str]:
+        results = {}
+        missing = []
+
+        now = time.monotonic()
+
+        for key in keys:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[1] <= now:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                missing.append(key)
+                continue
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            results[key] = entry[0]
+
+        if missing:
+            values = await self.persistent_cache.get_many(missing)
+
+            for key, value in values.items():
+                self._put(key, value)
+
+            results.update(values)
+
+        return results
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        return await self.set_many({key: value}, ttl=ttl)
+
+    async def set_many(self, items: dict[str, str], ttl: Optional[float] = None) -> bool:
+        for key, value in items.items():
+            self._put(key, value, ttl)
+
+        return await self.persistent_cache.set_many(items, ttl=ttl)
+
+    async def delete(self, key: str) -> bool:
+        if key in self.entries:
+            self._remove(key)
+
+        return await self.persistent_cache.delete(key)
+
+    async def close(self):
+        await self.persistent_cache.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _put(self, key: str, value: str, ttl: Optional[float] = None):
+        if key in self.entries:
+            self._remove(key)
+
+        entry_size = entry_bytes(key, value)
+
+        # too large to keep in memory, only the persistent cache has it
+        if entry_size > self.max_bytes:
+            return
+
+        self.entries[key] = (value, time.monotonic() + min(self.ttl, ttl if ttl is not None else self.ttl))
+        self.size += entry_size
+
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        value, _ = self.entries.pop(key)
+        self.size -= entry_bytes(key, value)
+
+
+@staticmethod
+def entry_bytes(key: str, value: str) -> int:
+    return len(key.encode()) + len(value.encode())
@@ -1,6 +1,8 @@
 import re
 import json
 import asyncio
+import hashlib
+import logging
 from api_clients.llm import OpenAIClient
 from api_clients.cricinfo_client import CricInfoClient
 from utils.utils import load_json
@@ -8,28 +10,33 @@ from id_mapper import IdMapper
 from execution.allround import AllRound
 from execution.player import Player
 from utils.logging import time_logger
+from db.stats_engine import LocalStatsEngine
+from cache import LRUCache
+from similarity_cache import SimilarityCache
+from typing import Optional
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
+# planner output is reused for a day, queries like "last year" depend on the current date
+PLAN_CACHE_TTL = 24 * 3600
+# history turns that can change the meaning of the query
+PLAN_HISTORY_TURNS = 4
+
 
 class CricGPT:
-    def __init__(self, openai_client: OpenAIClient, cricinfo_client: CricInfoClient, id_mapper: IdMapper):
+    def __init__(self, openai_client: OpenAIClient, cricinfo_client: CricInfoClient, id_mapper: IdMapper, stats_engine: Optional[LocalStatsEngine] = None, cache: Optional[LRUCache] = None, similarity_cache: Optional[SimilarityCache] = None):
         self.openai_client = openai_client
         self.cricinfo_client = cricinfo_client
         self.id_mapper = id_mapper
+        self.stats_engine = stats_engine
+        self.cache = cache
+        self.similarity_cache = similarity_cache
 
     @time_logger()
     async def execute(self, query, history= None):
         # get the breakdown parts of the query
-        planning_prompt = get_planner_prompt()
-
-        planning_output = await self.openai_client.get_response(system_prompt=planning_prompt, query=query, history=history)
-
-        print(planning_output)
-
-        #load the response to json
-        breakdown_parts = load_json(planning_output)
-
-        print(breakdown_parts)
+        breakdown_parts, planning_output = await self.plan(query, history)
 
         if breakdown_parts is None or len(breakdown_parts) == 0:
             return {
@@ -58,12 +65,94 @@ class CricGPT:
             "queries": breakdown_parts
         }
     
+    async def execute_stream(self, query, history= None):
+        '''
+        Same as execute, but yields (event, data) pairs as each stage finishes: the plan, every breakdown part
+        as soon as its result is ready, the summary tokens and finally the urls and queries.
+        '''
+        breakdown_parts, planning_output = await self.plan(query, history)
+
+        if breakdown_parts is None or len(breakdown_parts) == 0:
+            yield "summary", planning_output
+            yield "done", {"urls": [], "queries": [query]}
+            return
+
+        yield "plan", breakdown_parts
+
+        tasks = [asyncio.create_task(self.process_breakdown_part(breakdown_part)) for breakdown_part in breakdown_parts]
+
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                yield "part", result
+        finally:
+            # the client went away, don't leave the remaining parts running
+            for task in tasks:
+                task.cancel()
+
+        # keep the planner order in the summary, same as execute
+        results = [task.result() for task in tasks]
+
+        summary_prompt = get_summary_prompt()
+        summary_query = self.build_summary_query(query, history, results)
+
+        async for token in self.openai_client.get_response_stream(system_prompt=summary_prompt, query=summary_query):
+            yield "summary", token
+
+        yield "done", {
+            "urls": [result["url"] for result in results],
+            "queries": breakdown_parts
+        }
+
+    async def plan(self, query, history= None) -> tuple[Optional[list[dict]], Optional[str]]:
+        planning_prompt = get_planner_prompt()
+
+        plan_cache_id = get_plan_cache_id(planning_prompt, query, history)
+
+        breakdown_parts = await self.get_cached_plan(plan_cache_id)
+
+        if breakdown_parts is not None:
+            return breakdown_parts, None
+
+        planning_output = await self.openai_client.get_response(system_prompt=planning_prompt, query=query, history=history)
+
+        print(planning_output)
+
+        #load the response to json
+        breakdown_parts = load_json(planning_output)
+
+        print(breakdown_parts)
+
+        # only plans are cached, the conversational replies are cheap to regenerate
+        if breakdown_parts:
+            await self.set_cached_plan(plan_cache_id, breakdown_parts)
+
+        return breakdown_parts, planning_output
+
+    async def get_cached_plan(self, plan_cache_id: str) -> Optional[list[dict]]:
+        if self.cache is None:
+            return None
+
+        plan_cache_str = await self.cache.get(plan_cache_id)
+
+        if plan_cache_str is None:
+            return None
+
+        logger.info(f"Plan cache hit for {plan_cache_id}")
+        return json.loads(plan_cache_str)
+
+    async def set_cached_plan(self, plan_cache_id: str, breakdown_parts: list[dict]):
+        if self.cache is None:
+            return
+
+        await self.cache.set(plan_cache_id, json.dumps(breakdown_parts), ttl=PLAN_CACHE_TTL)
+
     async def process_breakdown_part(self, breakdown_part):
         if breakdown_part["type"] == "player":
-            player_stats = Player(self.openai_client, self.cricinfo_client, self.id_mapper)
+            player_stats = Player(self.openai_client, self.cricinfo_client, self.id_mapper, self.stats_engine, self.similarity_cache)
             result = await player_stats.execute(breakdown_part)
         else:
-            stats = AllRound(self.openai_client, self.cricinfo_client, self.id_mapper)
+            stats = AllRound(self.openai_client, self.cricinfo_client, self.id_mapper, self.stats_engine, self.similarity_cache)
             result = await stats.execute(breakdown_part)
         return result
 
@@ -84,6 +173,38 @@ class CricGPT:
         return summary_query
 
 
+@staticmethod
+def get_plan_cache_id(planning_prompt: str, query: str, history: Optional[list[dict]]) -> str:
+    # the prompt embeds the current time, leave it out of the version so only prompt edits invalidate the cache
+    prompt_version = hashlib.sha256(re.sub(r"Current Time: [^,]*,", "", planning_prompt).encode()).hexdigest()[:16]
+
+    turns = [
+        {"role": turn.get("role"), "content": normalize_query(turn.get("content"))}
+        for turn in (history or [])[-PLAN_HISTORY_TURNS:]
+        if turn.get("role") and turn.get("content")
+    ]
+    history_hash = hashlib.sha256(json.dumps(turns).encode()).hexdigest()[:16]
+
+    return f"plan_{prompt_version}_{history_hash}_{normalize_query(query)}"
+
+@staticmethod
+def get_request_key(query: str, history: Optional[list[dict]]) -> str:
+    # the whole history goes into the summary, so identical requests must share all of it
+    turns = [
+        {"role": turn.get("role"), "content": normalize_query(turn.get("content"))}
+        for turn in history or []
+        if turn.get("role") and turn.get("content")
+    ]
+    history_hash = hashlib.sha256(json.dumps(turns).encode()).hexdigest()[:16]
+
+    return f"{history_hash}_{normalize_query(query)}"
+
+@staticmethod
+def normalize_query(query: str) -> str:
+    # case, whitespace and trailing punctuation don't change the plan
+    query = re.sub(r"\s+", " ", str(query).lower()).strip()
+    return query.rstrip("?.! ")
+
 @staticmethod
 def get_planner_prompt():
     return f'''
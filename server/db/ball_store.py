@@ -0,0 +1,308 @@
+import os
+import json
+import logging
+import argparse
+import itertools
+from typing import Optional
+import numpy as np
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+# wicket kinds credited to the bowler
+BOWLER_WICKETS = ["bowled", "caught", "caught and bowled", "lbw", "stumped", "hit wicket"]
+
+BALL_COLUMNS = {
+    "match_id": np.int32,
+    "innings_id": np.int32,
+    "batsman_id": np.int32,
+    "bowler_id": np.int32,
+    "batting_team_id": np.int32,
+    "bowling_team_id": np.int32,
+    "year": np.int16,
+    "batter_runs": np.int16,
+    "total_runs": np.int16,
+    "wides": np.int16,
+    "noballs": np.int16,
+    "byes": np.int16,
+    "legbyes": np.int16,
+    "bowler_wickets": np.int8,
+}
+
+INNINGS_COLUMNS = {
+    "player_id": np.int32,
+    "match_id": np.int32,
+    "innings_id": np.int32,
+    "batting_team_id": np.int32,
+    "bowling_team_id": np.int32,
+    "year": np.int16,
+    "runs_scored": np.int16,
+    "balls_faced": np.int16,
+    "fours": np.int16,
+    "sixes": np.int16,
+    "batted": np.bool_,
+    "not_out": np.bool_,
+}
+
+# rows converted to numpy at a time while exporting, only one partition is held in memory
+EXPORT_CHUNK_ROWS = 50000
+
+# defaults of BallStore's filters, the matches statsguru's classes count
+DEFAULT_TEAM_TYPES = ["international"]
+DEFAULT_GENDERS = ["male"]
+
+# both queries are ordered by partition so that each partition is complete once the next one starts
+BALLS_QUERY = f"""
+SELECT COALESCE(m.team_type, 'other') AS team_type, COALESCE(m.gender, 'other') AS gender, m.match_type, m.season,
+       b.match_id, b.innings_id, b.batsman_id, b.bowler_id,
+       i.batting_team_id, i.bowling_team_id,
+       EXTRACT(YEAR FROM m.match_dates[1])::int AS year,
+       COALESCE((b.runs->>'batter')::int, 0) AS batter_runs,
+       COALESCE((b.runs->>'total')::int, 0) AS total_runs,
+       COALESCE((b.extras->>'wides')::int, 0) AS wides,
+       COALESCE((b.extras->>'noballs')::int, 0) AS noballs,
+       COALESCE((b.extras->>'byes')::int, 0) AS byes,
+       COALESCE((b.extras->>'legbyes')::int, 0) AS legbyes,
+       (
+           SELECT COUNT(*) FROM jsonb_array_elements(
+               CASE WHEN jsonb_typeof(b.wicket) = 'array' THEN b.wicket ELSE '[]'::jsonb END
+           ) w
+           WHERE w->>'kind' IN ({", ".join(f"'{kind}'" for kind in BOWLER_WICKETS)})
+       ) AS bowler_wickets
+FROM balls b
+JOIN matches m ON m.match_id = b.match_id
+JOIN innings i ON i.innings_id = b.innings_id
+WHERE i.super_over IS NOT TRUE
+ORDER BY 1, 2, m.match_type, m.season
+"""
+
+INNINGS_QUERY = """
+SELECT COALESCE(m.team_type, 'other') AS team_type, COALESCE(m.gender, 'other') AS gender, m.match_type, m.season,
+       psi.player_id, psi.match_id, psi.innings_id,
+       i.batting_team_id, i.bowling_team_id,
+       EXTRACT(YEAR FROM m.match_dates[1])::int AS year,
+       COALESCE(psi.runs_scored, 0) AS runs_scored,
+       COALESCE(psi.balls_faced, 0) AS balls_faced,
+       COALESCE(psi.fours, 0) AS fours,
+       COALESCE(psi.sixes, 0) AS sixes,
+       COALESCE(psi.did_not_bat, TRUE) = FALSE AS batted,
+       COALESCE(psi.not_out, TRUE) AS not_out
+FROM player_stats_innings psi
+JOIN matches m ON m.match_id = psi.match_id
+JOIN innings i ON i.innings_id = psi.innings_id
+WHERE i.super_over IS NOT TRUE
+ORDER BY 1, 2, m.match_type, m.season
+"""
+
+
+class BallStoreBuilder:
+    '''
+    Exports the balls and player_stats_innings tables into column oriented numpy files,
+    partitioned by team type, gender, match type and season:
+
+        <path>/manifest.json
+        <path>/<team_type>/<gender>/<match_type>/<season>/balls/<column>.npy
+        <path>/<team_type>/<gender>/<match_type>/<season>/innings/<column>.npy
+
+    cricsheet's match types don't tell internationals from leagues (an IPL match is a T20 like a T20I), the team type
+    and gender partitions keep them apart.
+
+    A standalone build step for now, LocalStatsEngine still answers from postgres and nothing loads a BallStore yet.
+    '''
+
+    def __init__(self, engine: sqlalchemy.engine.Engine, path: str):
+        self.engine = engine
+        self.path = path
+
+    def build(self):
+        partitions = {}
+
+        self.export_table("balls", BALLS_QUERY, BALL_COLUMNS, partitions)
+        self.export_table("innings", INNINGS_QUERY, INNINGS_COLUMNS, partitions)
+
+        with open(os.path.join(self.path, "manifest.json"), "w") as f:
+            json.dump({"partitions": list(partitions.values())}, f, indent=4)
+
+        logger.info(f"Built ball store with {len(partitions)} partitions at {self.path}")
+
+    def export_table(self, table: str, query: str, columns: dict, partitions: dict):
+        # typed arrays of the partition being exported, one per chunk it spans
+        current_key = None
+        chunks = []
+
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS).execute(sqlalchemy.text(query))
+
+            for rows in result.mappings().partitions(EXPORT_CHUNK_ROWS):
+                for key, group in itertools.groupby(rows, key=lambda row: (row["team_type"], row["gender"], row["match_type"], row["season"])):
+                    if key != current_key:
+                        if current_key is not None:
+                            self.write_partition(table, current_key, chunks, columns, partitions)
+
+                        current_key = key
+                        chunks = []
+
+                    group = list(group)
+                    chunks.append({column: np.fromiter((row[column] for row in group), dtype=dtype, count=len(group)) for column, dtype in columns.items()})
+
+        if current_key is not None:
+            self.write_partition(table, current_key, chunks, columns, partitions)
+
+    def write_partition(self, table: str, key: tuple, chunks: list[dict], columns: dict, partitions: dict):
+        team_type, gender, match_type, season = key
+        partition_path = os.path.join(*(partition_dir(value) for value in key))
+
+        directory = os.path.join(self.path, partition_path, table)
+        os.makedirs(directory, exist_ok=True)
+
+        for column in columns:
+            np.save(os.path.join(directory, f"{column}.npy"), np.concatenate([chunk[column] for chunk in chunks]))
+
+        partition = partitions.setdefault(key, {
+            "team_type": team_type,
+            "gender": gender,
+            "match_type": match_type,
+            "season": season,
+            "path": partition_path,
+            "rows": {}
+        })
+        partition["rows"][table] = sum(len(chunk["match_id"]) for chunk in chunks)
+
+
+class BallStore:
+    '''
+    Memory mapped, read only view over a store built by BallStoreBuilder.
+
+    Aggregates are computed with vectorized masks over the partitions selected by team type, gender, match type and
+    season, men's internationals unless asked otherwise. All ids are the database ids (players.player_id, teams.team_id).
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.partitions = json.load(f)["partitions"]
+
+        self.columns = {}
+
+    def get_column(self, partition: dict, table: str, column: str) -> np.ndarray:
+        key = (partition["path"], table, column)
+
+        if key not in self.columns:
+            file_path = os.path.join(self.path, partition["path"], table, f"{column}.npy")
+            self.columns[key] = np.load(file_path, mmap_mode="r")
+
+        return self.columns[key]
+
+    def select_partitions(self, table: str, match_types: Optional[list[str]] = None, seasons: Optional[list[str]] = None,
+                          team_types: list[str] = DEFAULT_TEAM_TYPES, genders: list[str] = DEFAULT_GENDERS) -> list[dict]:
+        selected = []
+
+        for partition in self.partitions:
+            if partition["team_type"] not in team_types or partition["gender"] not in genders:
+                continue
+            if match_types is not None and partition["match_type"] not in match_types:
+                continue
+            if seasons is not None and partition["season"] not in seasons:
+                continue
+            if partition["rows"].get(table, 0) == 0:
+                continue
+
+            selected.append(partition)
+
+        return selected
+
+    def get_mask(self, partition: dict, table: str, player_column: str, player_id: int, opposition: Optional[list[int]], opposition_column: str, years: Optional[list[int]]) -> np.ndarray:
+        mask = self.get_column(partition, table, player_column) == player_id
+
+        if opposition is not None:
+            mask &= np.isin(self.get_column(partition, table, opposition_column), opposition)
+
+        if years is not None:
+            mask &= np.isin(self.get_column(partition, table, "year"), years)
+
+        return mask
+
+    def batting(self, player_id: int, match_types: Optional[list[str]] = None, seasons: Optional[list[str]] = None,
+                opposition: Optional[list[int]] = None, years: Optional[list[int]] = None,
+                team_types: list[str] = DEFAULT_TEAM_TYPES, genders: list[str] = DEFAULT_GENDERS) -> dict:
+        innings = runs = balls = not_outs = hundreds = fifties = fours = sixes = 0
+
+        for partition in self.select_partitions("innings", match_types, seasons, team_types, genders):
+            mask = self.get_mask(partition, "innings", "player_id", player_id, opposition, "bowling_team_id", years)
+            mask &= self.get_column(partition, "innings", "batted")
+
+            if not mask.any():
+                continue
+
+            player_runs = self.get_column(partition, "innings", "runs_scored")[mask]
+
+            innings += int(mask.sum())
+            runs += int(player_runs.sum(dtype=np.int64))
+            balls += int(self.get_column(partition, "innings", "balls_faced")[mask].sum(dtype=np.int64))
+            not_outs += int(self.get_column(partition, "innings", "not_out")[mask].sum())
+            hundreds += int((player_runs >= 100).sum())
+            fifties += int(((player_runs >= 50) & (player_runs < 100)).sum())
+            fours += int(self.get_column(partition, "innings", "fours")[mask].sum(dtype=np.int64))
+            sixes += int(self.get_column(partition, "innings", "sixes")[mask].sum(dtype=np.int64))
+
+        dismissals = innings - not_outs
+
+        return {
+            "innings": innings,
+            "runs": runs,
+            "balls": balls,
+            "not_outs": not_outs,
+            "dismissals": dismissals,
+            "average": runs / dismissals if dismissals else None,
+            "strike_rate": runs * 100 / balls if balls else None,
+            "hundreds": hundreds,
+            "fifties": fifties,
+            "fours": fours,
+            "sixes": sixes,
+        }
+
+    def bowling(self, player_id: int, match_types: Optional[list[str]] = None, seasons: Optional[list[str]] = None,
+                opposition: Optional[list[int]] = None, years: Optional[list[int]] = None,
+                team_types: list[str] = DEFAULT_TEAM_TYPES, genders: list[str] = DEFAULT_GENDERS) -> dict:
+        balls = runs = wickets = 0
+
+        for partition in self.select_partitions("balls", match_types, seasons, team_types, genders):
+            mask = self.get_mask(partition, "balls", "bowler_id", player_id, opposition, "batting_team_id", years)
+
+            if not mask.any():
+                continue
+
+            wides = self.get_column(partition, "balls", "wides")[mask]
+            noballs = self.get_column(partition, "balls", "noballs")[mask]
+
+            balls += int(((wides == 0) & (noballs == 0)).sum())
+            runs += int(self.get_column(partition, "balls", "batter_runs")[mask].sum(dtype=np.int64) + wides.sum(dtype=np.int64) + noballs.sum(dtype=np.int64))
+            wickets += int(self.get_column(partition, "balls", "bowler_wickets")[mask].sum(dtype=np.int64))
+
+        return {
+            "balls": balls,
+            "runs": runs,
+            "wickets": wickets,
+            "economy": runs * 6 / balls if balls else None,
+            "average": runs / wickets if wickets else None,
+            "strike_rate": balls / wickets if wickets else None,
+        }
+
+
+@staticmethod
+def partition_dir(value) -> str:
+    # seasons are like 2010/11, keep the directory names flat
+    return str(value).replace("/", "-").replace(" ", "_")
+
+
+if __name__ == "__main__":
+    from db.sqlclient import SQLClient
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Build the columnar ball store from the stats database.")
+    parser.add_argument("--path", type=str, default="data/ball_store", help="Directory to write the store to")
+    args = parser.parse_args()
+
+    BallStoreBuilder(SQLClient().engine, args.path).build()
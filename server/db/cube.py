@@ -0,0 +1,331 @@
+import logging
+from typing import Optional
+from sqlalchemy import text, bindparam
+
+logger = logging.getLogger(__name__)
+
+# cube key, in primary key order
+DIMENSIONS = ["match_type", "year", "opposition_id", "host_country", "innings_number"]
+
+MEASURES = [
+    "matches",
+    "innings",
+    "not_outs",
+    "runs_scored",
+    "balls_faced",
+    "fours",
+    "sixes",
+    "hundreds",
+    "fifties",
+    "ducks",
+    "innings_bowled",
+    "balls_bowled",
+    "runs_conceded",
+    "wickets_taken",
+    "four_wickets",
+    "five_wickets",
+    "catches",
+    "stumpings",
+    "run_outs",
+]
+
+# measures combined with a max instead of a sum, stored as sortable keys, see best_innings_key/best_bowling_key
+MAX_MEASURES = ["best_innings", "best_bowling"]
+
+# dimensions that can be rolled up on, opposition is exposed by team name
+ROLLUP_DIMENSIONS = {
+    "match_type": "c.match_type",
+    "year": "c.year",
+    "opposition": "t.name",
+    "host_country": "c.host_country",
+    "innings_number": "c.innings_number",
+}
+
+UPSERT_QUERY = f"""
+INSERT INTO player_stats_cube (player_id, {", ".join(DIMENSIONS + MEASURES + MAX_MEASURES)})
+VALUES (:player_id, {", ".join(":" + column for column in DIMENSIONS + MEASURES + MAX_MEASURES)})
+ON CONFLICT (player_id, {", ".join(DIMENSIONS)}) DO UPDATE SET
+    {", ".join(f"{measure} = player_stats_cube.{measure} + excluded.{measure}" for measure in MEASURES)},
+    {", ".join(f"{measure} = GREATEST(player_stats_cube.{measure}, excluded.{measure})" for measure in MAX_MEASURES)}
+"""
+
+# per innings rows of the base tables, in the same shape the ingester passes to add_rows,
+# men's matches only like statsguru's classes, player ids are shared with the women's matches of a player
+SOURCE_QUERY = """
+SELECT psi.player_id, psi.match_id, m.match_type,
+       EXTRACT(YEAR FROM m.match_dates[1])::int AS year,
+       COALESCE(s.country, '') AS host_country,
+       n.innings_number, n.batting_team_id, n.bowling_team_id,
+       psi.runs_scored, psi.balls_faced, psi.fours, psi.sixes, psi.not_out, psi.did_not_bat, psi.did_not_bowl,
+       psi.balls_bowled, psi.runs_conceded, psi.wickets_taken, psi.catches, psi.stumpings, psi.run_outs
+FROM player_stats_innings psi
+JOIN matches m ON m.match_id = psi.match_id
+LEFT JOIN stadiums s ON s.stadium_id = m.stadium_id
+JOIN (
+    SELECT innings_id, batting_team_id, bowling_team_id,
+           ROW_NUMBER() OVER (PARTITION BY match_id ORDER BY innings_id) AS innings_number
+    FROM innings
+    -- super overs don't count towards the stats or the innings numbers
+    WHERE innings.super_over IS NOT TRUE
+) n ON n.innings_id = psi.innings_id
+WHERE m.gender = 'male' AND ({filter})
+"""
+
+DELETE_EMPTY_QUERY = f"""
+DELETE FROM player_stats_cube
+WHERE player_id = :player_id AND {" AND ".join(f"{dimension} = :{dimension}" for dimension in DIMENSIONS)}
+AND {" AND ".join(f"{measure} = 0" for measure in MEASURES)}
+"""
+
+
+class PlayerStatsCube:
+    '''
+    Incrementally maintained aggregates of player_stats_innings, keyed by
+    player x match type x year x opposition x host country x innings number.
+
+    Every measure is additive, so any dimension can be rolled up by summing, except best_innings and best_bowling which are a max.
+    Only men's matches are counted, the same as statsguru's classes.
+    A match is counted once per player, in the cell of the player's first innings of that match.
+    '''
+
+    def __init__(self, session):
+        # a sqlalchemy Session or Connection
+        self.session = session
+
+    def add_rows(self, rows: list[dict]):
+        self.apply(build_deltas(rows, sign=1))
+
+    def remove_matches(self, match_ids: list[int]) -> set[tuple]:
+        '''
+        Subtracts the matches from the cube, call before the matches are deleted and call refresh_best
+        with the returned keys once the replacement rows are in.
+        '''
+        if not match_ids:
+            return set()
+
+        rows = self.fetch_source_rows("psi.match_id IN :ids", match_ids)
+        deltas = build_deltas(rows, sign=-1)
+
+        self.apply(deltas)
+
+        # cells only the removed matches contributed to, re-created by add_rows if the replacement has them
+        if deltas:
+            self.session.execute(text(DELETE_EMPTY_QUERY), [dict(zip(["player_id"] + DIMENSIONS, key)) for key in deltas])
+
+        return set(deltas.keys())
+
+    def refresh_best(self, keys: set[tuple]):
+        # a max can't be subtracted, recompute it for the cells touched by remove_matches
+        if not keys:
+            return
+
+        player_ids = list({key[0] for key in keys})
+        deltas = build_deltas(self.fetch_source_rows("psi.player_id IN :ids", player_ids), sign=1)
+
+        params = []
+        for key in keys:
+            delta = deltas.get(key, {})
+            params.append(dict(zip(["player_id"] + DIMENSIONS, key), **{measure: delta.get(measure) for measure in MAX_MEASURES}))
+
+        self.session.execute(
+            text(f"""
+                UPDATE player_stats_cube SET {", ".join(f"{measure} = :{measure}" for measure in MAX_MEASURES)}
+                WHERE player_id = :player_id AND {" AND ".join(f"{dimension} = :{dimension}" for dimension in DIMENSIONS)}
+            """),
+            params
+        )
+
+    def rebuild(self, batch_size: int = 500):
+        '''
+        Recomputes the whole cube from the base tables, a batch of players at a time.
+        Needed after a change to how the cells are computed, the caller commits.
+        '''
+        self.session.execute(text("DELETE FROM player_stats_cube"))
+
+        player_ids = [row[0] for row in self.session.execute(text("SELECT DISTINCT player_id FROM player_stats_innings ORDER BY player_id"))]
+
+        for i in range(0, len(player_ids), batch_size):
+            self.apply(build_deltas(self.fetch_source_rows("psi.player_id IN :ids", player_ids[i:i + batch_size]), sign=1))
+
+        logger.info(f"Rebuilt the player stats cube for {len(player_ids)} players")
+
+    def fetch_source_rows(self, filter: str, ids: list[int]) -> list[dict]:
+        statement = text(SOURCE_QUERY.format(filter=filter)).bindparams(bindparam("ids", expanding=True))
+        return [dict(row._mapping) for row in self.session.execute(statement, {"ids": ids})]
+
+    def apply(self, deltas: dict):
+        if not deltas:
+            return
+
+        params = [dict(zip(["player_id"] + DIMENSIONS, key), **delta) for key, delta in deltas.items()]
+
+        self.session.execute(text(UPSERT_QUERY), params)
+
+    def rollup(self, group_by: list[str], player_id: Optional[int] = None, cricinfo_id: Optional[int] = None,
+               match_types: Optional[list[str]] = None, years: Optional[list[int]] = None, opposition: Optional[list[str]] = None,
+               host_countries: Optional[list[str]] = None, innings_numbers: Optional[list[int]] = None) -> list[dict]:
+        '''
+        Sums the cube over every dimension not in group_by, opposition is filtered and returned by team name.
+        '''
+        for dimension in group_by:
+            if dimension not in ROLLUP_DIMENSIONS:
+                raise ValueError(f"Dimension {dimension} not found")
+
+        filters = []
+        params = {}
+        expanding = []
+
+        if player_id is not None:
+            filters.append("c.player_id = :player_id")
+            params["player_id"] = player_id
+
+        if cricinfo_id is not None:
+            filters.append("c.player_id IN (SELECT player_id FROM players WHERE cricinfo_id = :cricinfo_id)")
+            params["cricinfo_id"] = cricinfo_id
+
+        for name, column, values in [
+            ("match_types", "c.match_type", match_types),
+            ("years", "c.year", years),
+            ("opposition", "t.name", opposition),
+            ("host_countries", "c.host_country", host_countries),
+            ("innings_numbers", "c.innings_number", innings_numbers),
+        ]:
+            if values is None:
+                continue
+
+            filters.append(f"{column} IN :{name}")
+            params[name] = values
+            expanding.append(name)
+
+        columns = [f"{ROLLUP_DIMENSIONS[dimension]} AS {dimension}" for dimension in group_by]
+        columns += [f"SUM(c.{measure}) AS {measure}" for measure in MEASURES]
+        columns += [f"MAX(c.{measure}) AS {measure}" for measure in MAX_MEASURES]
+        columns += ["MIN(c.year) AS first_year", "MAX(c.year) AS last_year"]
+
+        query = f"""
+            SELECT {", ".join(columns)}
+            FROM player_stats_cube c
+            LEFT JOIN teams t ON t.team_id = c.opposition_id
+            WHERE {" AND ".join(filters) if filters else "TRUE"}
+            {"GROUP BY " + ", ".join(ROLLUP_DIMENSIONS[dimension] for dimension in group_by) if group_by else ""}
+            {"ORDER BY " + ", ".join(ROLLUP_DIMENSIONS[dimension] for dimension in group_by) if group_by else ""}
+        """
+
+        statement = text(query)
+        for name in expanding:
+            statement = statement.bindparams(bindparam(name, expanding=True))
+
+        results = []
+        for row in self.session.execute(statement, params):
+            result = dict(row._mapping)
+
+            # an empty roll up still returns one row of nulls
+            if result["first_year"] is None:
+                continue
+
+            for measure in MEASURES:
+                result[measure] = int(result[measure] or 0)
+
+            results.append(result)
+
+        return results
+
+
+@staticmethod
+def build_deltas(rows: list[dict], sign: int = 1) -> dict[tuple, dict]:
+    # a match counts once per player, in the player's first innings of the match
+    first_innings = {}
+    for row in rows:
+        key = (row["player_id"], row["match_id"])
+        first_innings[key] = min(first_innings.get(key, row["innings_number"]), row["innings_number"])
+
+    deltas = {}
+
+    for row in rows:
+        batted = row["did_not_bat"] is False
+        bowled = row["did_not_bowl"] is False
+
+        opposition_id = row["bowling_team_id"] if batted else row["batting_team_id"]
+
+        key = (row["player_id"], row["match_type"], int(row["year"]), opposition_id, row["host_country"] or "", row["innings_number"])
+
+        if key not in deltas:
+            deltas[key] = dict({measure: 0 for measure in MEASURES}, **{measure: None for measure in MAX_MEASURES})
+
+        delta = deltas[key]
+
+        if first_innings[(row["player_id"], row["match_id"])] == row["innings_number"]:
+            delta["matches"] += sign
+
+        if batted:
+            runs = row["runs_scored"] or 0
+
+            delta["innings"] += sign
+            delta["not_outs"] += sign if row["not_out"] else 0
+            delta["runs_scored"] += sign * runs
+            delta["balls_faced"] += sign * (row["balls_faced"] or 0)
+            delta["fours"] += sign * (row["fours"] or 0)
+            delta["sixes"] += sign * (row["sixes"] or 0)
+            delta["hundreds"] += sign if runs >= 100 else 0
+            delta["fifties"] += sign if 50 <= runs < 100 else 0
+            delta["ducks"] += sign if runs == 0 and not row["not_out"] else 0
+
+            # a max can't be subtracted, removed cells are recomputed by refresh_best
+            if sign > 0:
+                delta["best_innings"] = max_key(delta["best_innings"], best_innings_key(runs, row["not_out"]))
+
+        if bowled:
+            wickets = row["wickets_taken"] or 0
+
+            delta["innings_bowled"] += sign
+            delta["balls_bowled"] += sign * (row["balls_bowled"] or 0)
+            delta["runs_conceded"] += sign * (row["runs_conceded"] or 0)
+            delta["wickets_taken"] += sign * wickets
+            delta["four_wickets"] += sign if wickets == 4 else 0
+            delta["five_wickets"] += sign if wickets >= 5 else 0
+
+            if sign > 0:
+                delta["best_bowling"] = max_key(delta["best_bowling"], best_bowling_key(wickets, row["runs_conceded"] or 0))
+
+        delta["catches"] += sign * (row["catches"] or 0)
+        delta["stumpings"] += sign * (row["stumpings"] or 0)
+        delta["run_outs"] += sign * (row["run_outs"] or 0)
+
+    return deltas
+
+@staticmethod
+def max_key(current: Optional[int], value: int) -> int:
+    return value if current is None else max(current, value)
+
+@staticmethod
+def best_innings_key(runs: int, not_out: bool) -> int:
+    # a not out wins a tie on runs, same as statsguru's HS
+    return runs * 2 + (1 if not_out else 0)
+
+@staticmethod
+def decode_best_innings(key: Optional[int]) -> Optional[tuple[int, bool]]:
+    if key is None:
+        return None
+    return key // 2, key % 2 == 1
+
+@staticmethod
+def best_bowling_key(wickets: int, runs_conceded: int) -> int:
+    # more wickets first, then fewer runs
+    return wickets * 10000 - runs_conceded
+
+@staticmethod
+def decode_best_bowling(key: Optional[int]) -> Optional[tuple[int, int]]:
+    if key is None:
+        return None
+    wickets = (key + 9999) // 10000
+    return wickets, wickets * 10000 - key
+
+
+if __name__ == "__main__":
+    # rebuild: python cube.py, from the db folder like populate.py
+    from sqlclient import SQLClient
+
+    logging.basicConfig(level=logging.INFO)
+
+    with SQLClient().engine.begin() as conn:
+        PlayerStatsCube(conn).rebuild()
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Date, ForeignKey, Float, Boolean, inspect
+from sqlalchemy import create_engine, Column, Integer, String, Date, DateTime, ForeignKey, Float, Boolean, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY
@@ -9,7 +9,8 @@ Base = declarative_base()
 class Player(Base):
     __tablename__ = 'players'
     player_id = Column(Integer, primary_key=True)
-    external_id = Column(Integer, unique=True)
+    external_id = Column(String(20), unique=True) # cricsheet people register identifier
+    cricinfo_id = Column(Integer, unique=True) # statsguru/cricinfo player id, from the cricsheet people register
     name = Column(String(100), nullable=False)
     gender = Column(String(10), nullable=False)
     role = Column(String(50))
@@ -213,5 +214,41 @@ class Fielding(Base):
     ball_number = Column(Integer)
     out_type = Column(String(20))
 
-
-
+# Ingest Manifest Table, one row per loaded cricsheet file
+class IngestManifest(Base):
+    __tablename__ = 'ingest_manifest'
+    file_name = Column(String(255), primary_key=True)
+    match_id = Column(Integer, ForeignKey('matches.match_id'))
+    content_hash = Column(String(64), nullable=False) # sha256 of the file contents
+    ingested_at = Column(DateTime, nullable=False)
+
+# Player Stats Cube Table, pre aggregated player_stats_innings maintained by the ingester, see db/cube.py
+class PlayerStatsCube(Base):
+    __tablename__ = 'player_stats_cube'
+    player_id = Column(Integer, ForeignKey('players.player_id'), primary_key=True)
+    match_type = Column(String(20), primary_key=True)
+    year = Column(Integer, primary_key=True)
+    opposition_id = Column(Integer, ForeignKey('teams.team_id'), primary_key=True)
+    host_country = Column(String(50), primary_key=True) # stadium country, empty when unknown
+    innings_number = Column(Integer, primary_key=True)
+    matches = Column(Integer, default=0)
+    innings = Column(Integer, default=0)
+    not_outs = Column(Integer, default=0)
+    runs_scored = Column(Integer, default=0)
+    balls_faced = Column(Integer, default=0)
+    fours = Column(Integer, default=0)
+    sixes = Column(Integer, default=0)
+    hundreds = Column(Integer, default=0)
+    fifties = Column(Integer, default=0)
+    ducks = Column(Integer, default=0)
+    innings_bowled = Column(Integer, default=0)
+    balls_bowled = Column(Integer, default=0)
+    runs_conceded = Column(Integer, default=0)
+    wickets_taken = Column(Integer, default=0)
+    four_wickets = Column(Integer, default=0)
+    five_wickets = Column(Integer, default=0)
+    catches = Column(Integer, default=0)
+    stumpings = Column(Integer, default=0)
+    run_outs = Column(Integer, default=0)
+    best_innings = Column(Integer) # runs * 2 + not out, so a max keeps the not out flag
+    best_bowling = Column(Integer) # wickets * 10000 - runs conceded
@@ -1,9 +1,43 @@
+import io
+import os
+import contextlib
+import csv
 import json
-from data_models.schema import Tournament, Match, Team, Innings, Player, Ball, PlayerStatsInnings, PlayerStatsOver, PlayerVsPlayerInnings, Stadium, Partnership, Fielding
+import hashlib
+import logging
+import zipfile
+from datetime import datetime, timezone
+from typing import Optional
+from sqlalchemy import insert, text
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY, insert as pg_insert
+from data_models.schema import Tournament, Match, Team, Innings, Player, Ball, PlayerStatsInnings, PlayerStatsOver, PlayerVsPlayerInnings, Stadium, Partnership, Fielding, IngestManifest
+from cube import PlayerStatsCube
+
+logger = logging.getLogger(__name__)
+
+# wicket kinds credited to the bowler
+BOWLER_WICKETS = ["caught", "caught and bowled", "stumped", "bowled", "lbw", "hit wicket"]
+
+# wicket kinds that don't end the batter's innings as an out
+NOT_OUT_WICKETS = ["retired hurt", "retired not out"]
+
+# rows per multi row insert, for drivers without COPY
+INSERT_CHUNK_ROWS = 1000
+
+# per innings tables, in the order they are written
+INNINGS_TABLES = {
+    "player_stats_innings": PlayerStatsInnings,
+    "player_stats_over": PlayerStatsOver,
+    "player_vs_player_innings": PlayerVsPlayerInnings,
+    "partnerships": Partnership,
+    "fielding": Fielding,
+    "balls": Ball,
+}
 
 class MatchData:
     tourament_id: int
     stadium_id: int
+    host_country: str
     team_ids: dict
     player_id_map: dict
     match_id: int
@@ -14,57 +48,91 @@ class ProcessMatchData:
         self.filePath = filePath
         self.session = session
         self.curr_data = MatchData()
-    
+        self.cube = PlayerStatsCube(session)
+
+        # name -> id lookups, shared across the matches processed by this instance
+        self.tournament_ids = {}
+        self.stadium_ids = {}
+        self.stadium_countries = {}
+        self.team_ids = {}
+        self.player_ids = {}
+
     def process(self):
 
         with open(self.filePath, 'r') as file:
             data = json.load(file)
-        
-        tournament_name = data["info"]["event"]["name"] + " " + data["info"]["season"]
+
+        self.try_create_dimensions(data)
+
+        #Match
+        self.curr_data.match_id = self.try_create_match(data)
+
+        innings_num = 1
+        innings_rows = []
+
+        for innings in data['innings']:
+            innings_rows.append(self.try_create_innings(innings, innings_num))
+            innings_num += 1
+
+        #Cube
+        self.cube.add_rows(self.build_cube_rows(self.curr_data.match_id, data["info"], self.curr_data.host_country, innings_rows))
+        self.session.commit()
+
+        #TODO: add match stats
+
+    def try_create_dimensions(self, data: dict):
+        info = data["info"]
+
+        tournament_name = get_event_name(data) + " " + str(info["season"])
 
         #search for the tournament with in database if not found create a new one
         self.curr_data.tourament_id = self.try_create_tournament(tournament_name, data)
 
         #Stadium
-        self.curr_data.stadium_id = self.try_create_stadium(data['info']['venue'], data= data)
+        self.curr_data.stadium_id = self.try_create_stadium(info['venue'], data= data)
+        self.curr_data.host_country = self.stadium_countries[self.curr_data.stadium_id]
 
         #Team
         self.curr_data.team_ids = self.try_create_teams(data)
 
         #Players, can contain referees and umpires as well
         self.curr_data.player_id_map = self.try_create_players(data)
-        
-        #Match
-        self.curr_data.match_id = self.try_create_match(data)
 
-        innings_num = 1
+    def try_create_innings(self, data: dict, innings_num: int):
 
-        for innings in data['innings']:
-            self.try_create_innings(innings, innings_num)
-            innings_num += 1
+        rows = self.build_innings_rows(data, innings_num)
 
-        #TODO: add match stats
+        innings = Innings(match_id = self.curr_data.match_id, **rows["innings"])
 
+        self.session.add(innings)
+        self.session.commit()
 
+        for table, model in INNINGS_TABLES.items():
+            for row in rows[table]:
+                self.session.add(model(match_id = self.curr_data.match_id, innings_id = innings.innings_id, **row))
 
-    def try_create_innings(self, data: dict, innings_num: int):
+        self.session.commit()
 
-        innings = data["innings"][innings_num]
+        return rows
+
+    def build_innings_rows(self, innings: dict, innings_num: int) -> dict:
+        '''
+        Builds the rows of the innings and all the per innings tables, without the match_id and innings_id keys
+        '''
 
         batting_team_id = self.curr_data.team_ids[innings["team"]]
 
         #find the bowling team id, the team that is not the batting team
-        bowling_team_id = self.curr_data.team_ids.values()[0] if self.curr_data.team_ids.values()[0] != batting_team_id else self.curr_data.team_ids.values()[1]
+        bowling_team_id = [team_id for team_id in self.curr_data.team_ids.values() if team_id != batting_team_id][0]
 
         runs_scored = 0
         wickets_lost = 0
         total_deliveries = 0
-        overs_played = 0
         total_extras = {
             "byes": 0,
-            "leg_byes": 0,
+            "legbyes": 0,
             "wides": 0,
-            "no_balls": 0,
+            "noballs": 0,
             "penalty": 0
         }
         fall_of_wickets = {
@@ -72,14 +140,6 @@ class ProcessMatchData:
             "runs": []
         }
 
-        target = innings["target"]
-        declared = innings["declared"]
-        forfeited = innings["forfeited"]
-        powerplay = innings["powerplay"]
-        miscounted_overs = innings["miscounted_overs"]
-        target = innings["target"]
-        super_over = innings["super_over"]
-
         #Player innings stats
         player_innings_stats = {}
 
@@ -93,9 +153,9 @@ class ProcessMatchData:
         ball_data = []
         player_over_data = []
 
-        powerplay_overs = innings["powerplays"]
+        powerplay_overs = innings.get("powerplays", [])
 
-        for over in innings["overs"]:
+        for over in innings.get("overs", []):
             delivery_num = 1
 
             over_num = over["over"]
@@ -111,441 +171,199 @@ class ProcessMatchData:
                 partnershipId = self.partnership_id(batter_id, non_striker_id)
                 playerVplayerId = self.player_v_player_id(batter_id, bowler_id)
 
-                if batter_id not in player_innings_stats:
-                    player_innings_stats[batter_id] = {
-                        "runs_scored": 0,
-                        "balls_faced": 0,
-                        "fours": 0,
-                        "sixes": 0
-                    }
+                for player_id in [batter_id, non_striker_id, bowler_id]:
+                    if player_id not in player_innings_stats:
+                        player_innings_stats[player_id] = new_player_stats()
 
-                if non_striker_id not in player_innings_stats:
-                    player_innings_stats[non_striker_id] = {
-                        "runs_scored": 0,
-                        "balls_faced": 0,
-                        "fours": 0,
-                        "sixes": 0
-                    }
-                
-                if bowler_id not in  player_innings_stats:
-                    player_innings_stats[bowler_id] = {
-                        "runs_scored": 0,
-                        "balls_faced": 0,
-                        "fours": 0,
-                        "sixes": 0
-                    }
+                    if player_id not in player_over_stats:
+                        player_over_stats[player_id] = new_player_stats(over_number = over_num)
 
                 if playerVplayerId not in player_vs_player_innings:
-                    player_vs_player_innings[f"{batter_id}_{bowler_id}"] = {
-                        "runs_scored": 0,
-                        "balls_faced": 0,
-                        "fours": 0,
-                        "sixes": 0
-                    }
-
-                if bowler_id not in player_over_stats:
-                    player_over_stats[bowler_id] = {
-                        "overs_bowled": 0,
-                        "runs_conceded": 0,
-                        "wickets_taken": 0,
-                        "economy": 0,
-                        "fours_conceded": 0,
-                        "sixes_conceded": 0
-                    }
-                
-                if batter_id not in player_over_stats:
-                    player_over_stats[batter_id] = {
-                        "overs_number": over_num,
-                        "runs_scored": 0,
-                        "balls_faced": 0,
-                        "strike_rate": 0,
-                        "fours": 0,
-                        "sixes": 0,
-                        "outs": 0,    
-                    }
-
-                if non_striker_id not in player_over_stats:
-                    player_over_stats[non_striker_id] = {
-                        "overs_number": over_num,
-                        "runs_scored": 0,
-                        "balls_faced": 0,
-                        "strike_rate": 0,
-                        "fours": 0,
-                        "sixes": 0,
-                        "outs": 0,    
-                    }
+                    player_vs_player_innings[playerVplayerId] = new_player_vs_player_stats()
 
                 if partnershipId not in partnerships:
                     partnerships[partnershipId] = {
                         "runs": 0,
                         "balls": 0,
-                        "strike_rate": 0,
                         "out": False,
                         "four": 0,
                         "six": 0
                     }
 
-
                 #runs first
                 runs = ball["runs"]
 
                 batter_runs = runs["batter"]
-                extra_runs = runs["extras"]
                 total_runs = runs["total"]
 
                 is_batter_four = batter_runs == 4 and runs.get("non_boundary", False) == False
                 is_batter_six = batter_runs == 6 and runs.get("non_boundary", False) == False
 
-                is_extra_four = extra_runs == 4 and runs.get("non_boundary", False) == False
-                is_extra_six = extra_runs == 6 and runs.get("non_boundary", False) == False
+                extras = ball.get("extras", {})
 
-                extras = ball["extras"]
+                #wides and no balls are not legal deliveries and are charged to the bowler
+                is_valid_ball = extras.get("wides", 0) == 0 and extras.get("noballs", 0) == 0
+                bowler_runs = batter_runs + extras.get("wides", 0) + extras.get("noballs", 0)
 
-                is_valid_ball = True
+                for extra_type, extra_runs in extras.items():
+                    total_extras[extra_type] = total_extras.get(extra_type, 0) + extra_runs #add to total extras
+
+                batter_stats = [player_innings_stats[batter_id], player_over_stats[batter_id], player_vs_player_innings[playerVplayerId]]
+                bowler_stats = [player_innings_stats[bowler_id], player_over_stats[bowler_id], player_vs_player_innings[playerVplayerId]]
 
                 #batter
                 player_innings_stats[batter_id]["did_not_bat"] = False
                 player_innings_stats[non_striker_id]["did_not_bat"] = False
-                player_innings_stats[batter_id]["runs_scored"] += batter_runs
-                player_innings_stats[batter_id]["balls_faced"] += 1
-                player_innings_stats[batter_id]["fours"] += 1 if is_batter_four else 0
-                player_innings_stats[batter_id]["sixes"] += 1 if is_batter_six else 0
+
+                for stats in batter_stats:
+                    stats["runs_scored"] += batter_runs
+                    stats["balls_faced"] += 0 if extras.get("wides", 0) > 0 else 1
+                    stats["fours"] += 1 if is_batter_four else 0
+                    stats["sixes"] += 1 if is_batter_six else 0
 
                 #bowler
                 player_innings_stats[bowler_id]["did_not_bowl"] = False
-                player_innings_stats[bowler_id]["runs_conceded"] += batter_runs
-                player_innings_stats[bowler_id]["fours_conceded"] += 1 if is_batter_four else 0
-                player_innings_stats[bowler_id]["sixes_conceded"] += 1 if is_batter_six else 0
-
-                if extras is not None:
-                    if extras.get("wides", 0) > 0:
-                        player_innings_stats[bowler_id]["runs_conceded"] += extras["wides"]
-                        is_valid_ball = False
-                    if extras.get("no_balls", 0) > 0:
-                        player_innings_stats[bowler_id]["runs_conceded"] += extras["no_balls"]
-                        is_valid_ball = False
 
-                for extra_type, extra_runs in extras.items():
-                    total_extras[extra_type] += extra_runs #add to total extras
-                    
-                
-                if is_valid_ball:
-                    player_innings_stats[bowler_id]["balls_bowled"] += 1
-                    delivery_num += 1
-
-                #player vs player innings
-                player_vs_player_innings[playerVplayerId]["runs_scored"] += batter_runs
-                player_vs_player_innings[playerVplayerId]["balls_faced"] += 1
-                player_vs_player_innings[playerVplayerId]["fours"] += 1 if is_batter_four else 0
-                player_vs_player_innings[playerVplayerId]["sixes"] += 1 if is_batter_six else 0
+                for stats in bowler_stats:
+                    stats["runs_conceded"] += bowler_runs
+                    stats["balls_bowled"] += 1 if is_valid_ball else 0
+                    stats["fours_conceded"] += 1 if is_batter_four else 0
+                    stats["sixes_conceded"] += 1 if is_batter_six else 0
 
                 #patnership
-                partnerships[partnershipId]["runs"] += batter_runs
-                partnerships[partnershipId]["balls"] += 1
+                partnerships[partnershipId]["runs"] += total_runs
+                partnerships[partnershipId]["balls"] += 1 if is_valid_ball else 0
                 partnerships[partnershipId]["four"] += 1 if is_batter_four else 0
                 partnerships[partnershipId]["six"] += 1 if is_batter_six else 0
 
-                #player over stats
-                player_over_stats[batter_id]["over_number"] = over_num
-                player_over_stats[batter_id]["runs_scored"] += batter_runs
-                player_over_stats[batter_id]["balls_faced"] += 1
-                player_over_stats[batter_id]["fours"] += 1 if is_batter_four else 0
-                player_over_stats[batter_id]["sixes"] += 1 if is_batter_six else 0
-
-                wickets = ball["wicket"]
-
                 runs_scored += total_runs
                 total_deliveries += 1 if is_valid_ball else 0
 
+                wickets = ball.get("wickets", [])
+
                 #follow of wickets
+                for wicket in wickets:
+                    wicket_kind = wicket["kind"]
+                    player_out = self.curr_data.player_id_map[wicket["player_out"]]
 
-                if wickets is not None:
-                    for wicket in wickets:
-                        wicket_kind = wicket["kind"]
-                        player_out = self.curr_data.player_id_map[wicket["player_out"]]
-
-
-                        if wicket_kind != "retired hurt":
-                            wickets_lost += 1
-                            fall_of_wickets["wickets"].append(wickets_lost)
-                            fall_of_wickets["runs"].append(runs_scored)
-
-                        match wicket_kind:
-                            case "caught" | "caught and bowled" | "stumped":
-                                partnerships[partnershipId]["out"] = True
-                                player_innings_stats[batter_id]["not_out"] = False
-                                player_over_stats[batter_id]["not_out"] = False
-                                player_innings_stats[bowler_id]["wickets_taken"] += 1
-                                player_over_stats[bowler_id]["wickets_taken"] += 1
-                                player_vs_player_innings[playerVplayerId]["outs"] += 1
-
-                                if wicket_kind == "caught and bowled":
-                                    fielding_stats.append({
-                                        "fielder": bowler_id,
-                                        "out_type": "caught and bowled",
-                                        "over_number": over_num,
-                                        "ball_number": delivery_num,
-                                        "out_player_id": player_out,
-                                        "bowler_id": bowler_id
-                                    })
-
-                                    player_innings_stats[bowler_id]["catches"] += 1
-
-                                else:
-                                    for fielder in wicket["fielders"]:
-                                        fielder_id = self.curr_data.player_id_map[fielder]
-                                        fielding_stats.append({
-                                            "fielder": fielder_id,
-                                            "out_type": wicket_kind,
-                                            "over_number": over_num,
-                                            "ball_number": delivery_num,
-                                            "out_player_id": player_out,
-                                            "bowler_id": bowler_id
-                                        })
-
-                            case "bowled" | "lbw" | "hit wicket":
-                                partnerships[partnershipId]["out"] = True
-                                player_innings_stats[batter_id]["not_out"] = False
-                                player_over_stats[batter_id]["not_out"] = False
-                                player_innings_stats[bowler_id]["wickets_taken"] += 1
-                                player_over_stats[bowler_id]["wickets_taken"] += 1
-                                player_vs_player_innings[playerVplayerId]["outs"] += 1
-
-
-
-                                
-                            case "run out":
-                                partnerships[partnershipId]["out"] = True
-                                player_innings_stats[player_out]["not_out"] = False
-                                player_over_stats[player_out]["not_out"] = False
-
-
-                                for fielder in wicket["fielders"]:
-                                    fielder_id = self.curr_data.player_id_map[fielder]
-                                    fielding_stats.append({
-                                        "fielder": fielder_id,
-                                        "out_type": wicket_kind,
-                                        "over_number": over_num,
-                                        "ball_number": delivery_num,
-                                        "out_player_id": player_out,
-                                        "bowler_id": bowler_id
-                                    })
-
-
-                            case "retired hurt":
-                                # do nothing
-                                pass
-    
-                            case _:
-                                partnerships[partnershipId]["out"] = True
-                                player_innings_stats[player_out]["not_out"] = False
-                                player_over_stats[player_out]["not_out"] = False
+                    if wicket_kind in NOT_OUT_WICKETS:
+                        # do nothing
+                        continue
 
+                    wickets_lost += 1
+                    fall_of_wickets["wickets"].append(wickets_lost)
+                    fall_of_wickets["runs"].append(runs_scored)
 
-                is_powerplay, powerplay_type = self.is_powerplay(over_num, delivery_num, powerplay_overs)
+                    partnerships[partnershipId]["out"] = True
 
-                ball_data.append({
-                    "ball_number": delivery_num,
-                    "batsman_id": batter_id,
-                    "bowler_id": bowler_id,
-                    "non_striker_id": non_striker_id,
-                    "runs": json.dumps(runs),
-                    "extras": json.dumps(extras),
-                    "wicket": json.dumps(wickets),
-                    "replacement": json.dumps(ball["replacements"]),
-                    "review": json.dumps(ball["review"]),
-                    "is_powerplay": is_powerplay,
-                    "powerplay_type": powerplay_type
-                })
+                    if player_out in player_innings_stats:
+                        player_innings_stats[player_out]["not_out"] = False
+                    if player_out in player_over_stats:
+                        player_over_stats[player_out]["not_out"] = False
 
-                
+                    if wicket_kind in BOWLER_WICKETS:
+                        for stats in bowler_stats:
+                            stats["wickets_taken"] += 1
+                        player_vs_player_innings[playerVplayerId]["outs"] += 1
 
+                    fielders = [fielder.get("name") for fielder in wicket.get("fielders", [])]
 
+                    if wicket_kind == "caught and bowled":
+                        fielders = [ball["bowler"]]
 
-            for _, over_stats in player_over_stats:
-                player_over_data.append(over_stats)
+                    for fielder in fielders:
+                        fielder_id = self.curr_data.player_id_map.get(fielder)
 
-        #Innings
+                        if fielder_id is None:
+                            continue
 
-        overs_played = total_deliveries / 6 + (total_deliveries % 6) / 10
-
-        innings = Innings(
-            match_id = self.curr_data.match_id,
-            batting_team_id = batting_team_id,
-            bowling_team_id = bowling_team_id,
-            runs_scored = runs_scored,
-            wickets_lost = wickets_lost,
-            total_deliveries = total_deliveries,
-            overs_played = overs_played,
-            total_extras = json.dumps(total_extras),
-            fall_of_wickets = json.dumps(fall_of_wickets),
-            target = target,
-            declared = declared,
-            forfeited = forfeited,
-            powerplay = powerplay,
-            miscounted_overs = miscounted_overs,
-            super_over = super_over
-        )
+                        if fielder_id not in player_innings_stats:
+                            player_innings_stats[fielder_id] = new_player_stats()
 
-        self.session.add(innings)
-        self.session.commit()
-
-        #PlayerStatsInnings
-        for player_id, stats in player_innings_stats.items():
-            player_stats = PlayerStatsInnings(
-                player_id = player_id,
-                match_id = self.curr_data.match_id,
-                innings_id = innings.innings_id,
-                runs_scored = stats["runs_scored"],
-                balls_faced = stats["balls_faced"],
-                fours = stats["fours"],
-                sixes = stats["sixes"],
-                strike_rate = (stats["runs_scored"] / stats["balls_faced"]) * 100,
-                not_out = stats.get("not_out", True),
-                did_not_bat = stats.get("did_not_bat"),
-                did_not_bowl = stats.get("did_not_bowl"),
-                balls_bowled = stats.get("balls_bowled"),
-                wickets_taken = stats.get("wickets_taken"),
-                runs_conceded = stats.get("runs_conceded"),
-                economy = stats.get("runs_conceded") / stats.get("balls_bowled")*6,
-                catches = stats.get("catches"), #TODO: add catches
-                run_outs = stats.get("run_outs"), #TODO: add run_outs
-                stumpings = stats.get("stumpings") #TODO: add stumpings
-            )
-
-            self.session.add(player_stats)
-
-
-        #PlayerStatsOver
-        for player_id, stats in player_over_data.items():
-            player_over = PlayerStatsOver(
-                player_id = player_id,
-                match_id = self.curr_data.match_id,
-                innings_id = innings.innings_id,
-                overs_number = stats["overs_number"],
-                runs_scored = stats["runs_scored"],
-                balls_faced = stats["balls_faced"],
-                strike_rate = (stats["runs_scored"] / stats["balls_faced"]) * 100,
-                fours = stats["fours"],
-                sixes = stats["sixes"],
-                outs = stats["outs"],
-                not_out = stats.get("not_out", True),
-                balls_bowled = stats.get("balls_bowled"),
-                runs_conceded = stats.get("runs_conceded"),
-                wickets_taken = stats.get("wickets_taken"),
-                economy = stats.get("runs_conceded") / stats.get("balls_bowled")*6,
-                fours_conceded = stats.get("fours_conceded"),
-                sixes_conceded = stats.get("sixes_conceded")
-            )
-
-            self.session.add(player_over)
-
-
-        #PlayerVsPlayerInnings
-        for player_id, stats in player_vs_player_innings.items():
-            player_vs_player = PlayerVsPlayerInnings(
-                batsman_id = player_id.split("_")[0],
-                bowler_id = player_id.split("_")[1],
-                match_id = self.curr_data.match_id,
-                innings_id = innings.innings_id,
-                runs_scored = stats["runs_scored"],
-                balls_faced = stats["balls_faced"],
-                fours = stats["fours"],
-                sixes = stats["sixes"],
-                strike_rate = (stats["runs_scored"] / stats["balls_faced"]) * 100,
-                outs = stats["outs"],
-                overs_bowled = stats["overs_bowled"],
-                runs_conceded = stats["runs_conceded"],
-                fours_conceded = stats["fours_conceded"],
-                sixes_conceded = stats["sixes_conceded"],
-                wickets_taken = stats["wickets_taken"],
-                economy = stats["runs_conceded"] / stats["overs_bowled"]*6
-            )
+                        fielder_stats = player_innings_stats[fielder_id]
 
-            self.session.add(player_vs_player)
-
-
-        #Partnerships
-        for partnership_id, stats in partnerships.items():
-            partnership = Partnership(
-                partnership_id = partnership_id,
-                match_id = self.curr_data.match_id,
-                innings_id = innings.innings_id,
-                player1_id = partnership_id.split("_")[0],
-                player2_id = partnership_id.split("_")[1],
-                runs_scored = stats["runs"],
-                balls_faced = stats["balls"],
-                fours = stats["fours"],
-                sixes = stats["sixes"],
-                out = stats["out"],
-                strike_rate = (stats["runs"] / stats["balls"]) * 100
-            )
+                        if wicket_kind in ["caught", "caught and bowled"]:
+                            fielder_stats["catches"] += 1
+                        elif wicket_kind == "stumped":
+                            fielder_stats["stumpings"] += 1
+                        elif wicket_kind == "run out":
+                            fielder_stats["run_outs"] += 1
 
-            self.session.add(partnership)
-        
-
-        #Fielding
-        for fielding in fielding_stats:
-            fielding = Fielding(
-                fielder_id = fielding["fielder"],
-                out_type = fielding["out_type"],
-                over_number = fielding["over_number"],
-                ball_number = fielding["ball_number"],
-                out_player_id = fielding["out_player_id"],
-                bowler_id = fielding["bowler_id"],
-                match_id = self.curr_data.match_id,
-                innings_id = innings.innings_id
-            )
+                        fielding_stats.append({
+                            "fielder_id": fielder_id,
+                            "out_type": wicket_kind,
+                            "over_number": over_num,
+                            "ball_number": delivery_num,
+                            "out_player_id": player_out,
+                            "bowler_id": bowler_id
+                        })
 
-            self.session.add(fielding)
-
-        #Ball
-        for ball in ball_data:
-            ball = Ball(
-                ball_number = ball["ball_number"],
-                innings_id = innings.innings_id,
-                match_id = self.curr_data.match_id,
-                batsman_id = ball["bastman_id"],
-                bowler_id = ball["bowler_id"],
-                non_striker_id = ball["non_striker_id"],
-                runs = ball["runs"],
-                extras = ball["extras"],
-                wicket = ball["wicket"],
-                replacement = ball["replacement"],
-                review = ball["review"],
-                is_powerplay = ball["is_powerplay"],
-                powerplay_type = ball["powerplay_type"]
-            )
+                is_powerplay, powerplay_type = self.is_powerplay(over_num, delivery_num, powerplay_overs)
 
-            self.session.add(ball)
+                ball_data.append({
+                    "ball_number": delivery_num,
+                    "batsman_id": batter_id,
+                    "bowler_id": bowler_id,
+                    "non_striker_id": non_striker_id,
+                    "runs": runs,
+                    "extras": extras,
+                    "wicket": wickets,
+                    "replacement": ball.get("replacements"),
+                    "review": ball.get("review"),
+                    "is_powerplay": is_powerplay,
+                    "powerplay_type": powerplay_type
+                })
 
-        self.session.commit()
+                if is_valid_ball:
+                    delivery_num += 1
 
+            for player_id, over_stats in player_over_stats.items():
+                player_over_data.append(player_over_row(player_id, over_stats))
 
+        #Innings
 
+        overs_played = total_deliveries // 6 + (total_deliveries % 6) / 10
 
+        return {
+            "innings": {
+                "batting_team_id": batting_team_id,
+                "bowling_team_id": bowling_team_id,
+                "runs_scored": runs_scored,
+                "wickets_lost": wickets_lost,
+                "overs_played": overs_played,
+                "extras": total_extras,
+                "fall_of_wickets": fall_of_wickets,
+                "absent_hurt": innings.get("absent_hurt"),
+                "penalty_runs": innings.get("penalty_runs"),
+                "target": innings.get("target"),
+                "declared": innings.get("declared", False),
+                "forfeited": innings.get("forfeited", False),
+                "powerplay": powerplay_overs,
+                "miscounted_overs": innings.get("miscounted_overs"),
+                "super_over": innings.get("super_over", False)
+            },
+            "player_stats_innings": [player_innings_row(player_id, stats) for player_id, stats in player_innings_stats.items()],
+            "player_stats_over": player_over_data,
+            "player_vs_player_innings": [player_vs_player_row(key, stats) for key, stats in player_vs_player_innings.items()],
+            "partnerships": [partnership_row(key, stats) for key, stats in partnerships.items()],
+            "fielding": fielding_stats,
+            "balls": ball_data,
+        }
 
     def is_powerplay(self, over_num: int, delivery_num, powerplay_overs) -> tuple[bool, str]:
-        for powerplay in powerplay_overs:
-            start_over, start_del = powerplay["from"].split(".")
-            end_over, to_del = powerplay["to"].split(".")
-
-            if over_num >= start_over and over_num <= end_over:
-                if over_num == start_over and delivery_num >= start_del:
-                    return True, powerplay["type"]
-                elif over_num == end_over and delivery_num <= to_del:
-                    return True, powerplay["type"]
-                elif over_num > start_over and over_num < end_over:
-                    return True, powerplay["type"]
-                
-        return False, None
+        # powerplays are given as over.ball, like 0.1 to 9.6
+        position = over_num + delivery_num / 10
 
+        for powerplay in powerplay_overs:
+            if float(powerplay["from"]) <= position <= float(powerplay["to"]):
+                return True, powerplay["type"]
 
-        
-
+        return False, None
 
-    
     def try_create_tournament(self, tournament_name:str, data: dict) -> int:
+        if tournament_name in self.tournament_ids:
+            return self.tournament_ids[tournament_name]
+
         tournament = self.session.query(Tournament).filter(Tournament.name == tournament_name).first()
 
         if tournament is None:
@@ -553,113 +371,162 @@ class ProcessMatchData:
                 name=tournament_name,
                 gender = data["info"]["gender"],
                 format = data["info"]["match_type"],
-                season = data["info"]["season"]
+                season = str(data["info"]["season"])
             )
-            
+
             self.session.add(tournament)
             self.session.commit()
 
         #need to return the tournament_id
+        self.tournament_ids[tournament_name] = tournament.tournament_id
         return tournament.tournament_id
 
-
-
     def try_create_stadium(self, stadium_name: str, data: dict) -> int:
+        if stadium_name in self.stadium_ids:
+            return self.stadium_ids[stadium_name]
+
         stadium = self.session.query(Stadium).filter(Stadium.name == stadium_name).first()
-        
+
         if stadium is None:
             stadium = Stadium(
                 name=stadium_name,
-                city = data["info"]["city"]
+                city = data["info"].get("city"),
+                country = "" #need to fill this later
             )
             self.session.add(stadium)
             self.session.commit()
-        
+
+        self.stadium_ids[stadium_name] = stadium.stadium_id
+        self.stadium_countries[stadium.stadium_id] = stadium.country or ""
         return stadium.stadium_id
-    
+
     def try_create_teams(self, data: dict):
         assert len(data["info"]["teams"]) == 2
 
-        team1  = data["info"]["teams"][0]
-        team2 = data["info"]["teams"][1]
+        team_ids = {}
 
-        team1 = self.session.query(Team).filter(Team.name == team1).first()
-        team2 = self.session.query(Team).filter(Team.name == team2).first()
+        for team_name in data["info"]["teams"]:
+            if team_name not in self.team_ids:
+                team = self.session.query(Team).filter(Team.name == team_name).first()
 
-        if team1 is None:
-            team1 = Team(
-                name = team1,
-                gender = data["info"]["gender"]
-            )
-            self.session.add(team1)
+                if team is None:
+                    team = Team(
+                        name = team_name,
+                        country = team_name,
+                        gender = data["info"]["gender"]
+                    )
+                    self.session.add(team)
+                    self.session.commit()
 
-        if team2 is None:
-            team2 = Team(
-                name = team2,
-                gender = data["info"]["gender"]
-            )
-            self.session.add(team2)
+                self.team_ids[team_name] = team.team_id
 
-        self.session.commit()
+            team_ids[team_name] = self.team_ids[team_name]
+
+        return team_ids
 
-        return {
-            team1: team1.team_id,
-            team2: team2.team_id
-        }
-    
     def try_create_players(self, data: dict):
         player_id_map = {}
 
-        for player_name, player_external_id in data["info"]["registry"]["people"]:
+        # team of each player, officials don't have one
+        player_teams = {}
+        for team, players in data["info"].get("players", {}).items():
+            for player_name in players:
+                player_teams[player_name] = team
+
+        new_players = []
+
+        for player_name, player_external_id in data["info"]["registry"]["people"].items():
+            if player_external_id in self.player_ids:
+                continue
+
             player = self.session.query(Player).filter(Player.external_id == player_external_id).first()
 
             if player is None:
                 player = Player(
                     external_id = player_external_id,
                     name = player_name,
-                    gender = data["info"]["gender"]
+                    gender = data["info"]["gender"],
+                    country = player_teams.get(player_name, "")
                 )
                 self.session.add(player)
+                new_players.append(player)
+            else:
+                self.player_ids[player_external_id] = player.player_id
 
-        self.session.commit()
+        if new_players:
+            self.session.commit()
 
-        for player_name, player_external_id in data["info"]["registry"]["people"]:
-            player_id_map[player_name] = self.session.query(Player).filter(Player.external_id == player_external_id).first().player_id
+            for player in new_players:
+                self.player_ids[player.external_id] = player.player_id
 
+        for player_name, player_external_id in data["info"]["registry"]["people"].items():
+            player_id_map[player_name] = self.player_ids[player_external_id]
 
         return player_id_map
-    
+
     def try_create_match(self, data: dict):
 
-        match = Match(
-            balls_per_over = data["info"]["balls_per_over"],
-            stadium_id = self.curr_data.stadium_id,
-            tournament_id = self.curr_data.tourament_id,
-            tournament_match_details = data["info"]["event"],
-            gender = data["info"]["gender"],
-            match_dates = data["info"]["dates"],
-            match_type = data["info"]["match_type"],
-            match_type_number = data["info"]["match_type_number"],
-            season = data["info"]["season"],
-            team1_id = self.curr_data.team_ids.values()[0],
-            team2_id = self.curr_data.team_ids.values()[1],
-            outcome = json.dumps(data["info"]["outcome"]),
-            toss = json.dumps(data["info"]["toss"]),
-            man_of_the_match = self.map_player_names_to_ids(data["info"]["player_of_match"]),
-            team_type = data["info"]["team_type"],
-            players = json.dumps(self.map_player_field(data["info"]["players"])),
-            bowl_out = json.dumps(data["info"]["bowl_out"]),
-            missing = json.dumps(data["info"]["missing"]),
-            officials = json.dumps(data["info"]["officials"]),
-            supersubs = json.dumps(self.map_player_field(data["info"]["supersubs"])),
-        )
+        match = Match(**self.build_match_row(data))
 
         self.session.add(match)
         self.session.commit()
 
         return match.match_id
 
-    
+    def build_match_row(self, data: dict) -> dict:
+        info = data["info"]
+        team_ids = list(self.curr_data.team_ids.values())
+
+        return {
+            "balls_per_over": info.get("balls_per_over", 6),
+            "stadium_id": self.curr_data.stadium_id,
+            "tournament_id": self.curr_data.tourament_id,
+            "tournament_match_details": info.get("event"),
+            "gender": info["gender"],
+            "match_dates": info["dates"],
+            "match_type": info["match_type"],
+            "match_type_number": info.get("match_type_number"),
+            "season": str(info["season"]),
+            "team1_id": team_ids[0],
+            "team2_id": team_ids[1],
+            "outcome": info.get("outcome"),
+            "toss": info.get("toss"),
+            "overs": info.get("overs"),
+            "man_of_the_match": self.map_player_names_to_ids(info.get("player_of_match", [])),
+            "team_type": info.get("team_type"),
+            "players": [player_id for players in self.map_player_field(info.get("players", {})).values() for player_id in players],
+            "bowl_out": info.get("bowl_out"),
+            "missing": info.get("missing"),
+            "officials": info.get("officials"),
+            "super_subs": self.map_player_field(info.get("supersubs", {})),
+        }
+
+    def build_cube_rows(self, match_id: int, info: dict, host_country: str, innings: list[dict]) -> list[dict]:
+        # one row per player innings, in the shape PlayerStatsCube.add_rows expects
+        rows = []
+
+        # the cube only counts men's matches, see SOURCE_QUERY
+        if info["gender"] != "male":
+            return rows
+
+        # super overs are left out of the cube, they always come after the innings they decide
+        innings = [innings_rows for innings_rows in innings if not innings_rows["innings"]["super_over"]]
+
+        for innings_num, innings_rows in enumerate(innings, start=1):
+            for row in innings_rows["player_stats_innings"]:
+                rows.append(dict(
+                    row,
+                    match_id = match_id,
+                    match_type = info["match_type"],
+                    year = int(str(info["dates"][0])[:4]),
+                    host_country = host_country,
+                    innings_number = innings_num,
+                    batting_team_id = innings_rows["innings"]["batting_team_id"],
+                    bowling_team_id = innings_rows["innings"]["bowling_team_id"]
+                ))
+
+        return rows
+
     def map_player_names_to_ids(self, player_names: list):
         return [self.curr_data.player_id_map[player] for player in player_names]
 
@@ -677,7 +544,7 @@ class ProcessMatchData:
                 player_data[self.curr_data.team_ids[team]] = self.curr_data.player_id_map[players]
 
         return player_data
-    
+
     def player_v_player_id(self, batter_id: int, bowler_id: int) -> str:
         return f"{batter_id}_{bowler_id}"
 
@@ -688,12 +555,411 @@ class ProcessMatchData:
             return f"{batter2_id}_{batter1_id}"
 
 
+class BulkProcessMatchData(ProcessMatchData):
+    '''
+    Bulk load path, builds the rows of every table for a batch of matches in memory and writes each table
+    in one go, with COPY FROM STDIN when the driver supports it and multi row inserts otherwise.
+
+    Match and innings ids are allocated client side from their sequences, one round trip per batch,
+    so the per innings tables can reference them without waiting for an insert.
+    '''
+
+    def __init__(self, filePaths: list[str], session, batch_size: int = 200):
+        super().__init__(None, session)
+        self.filePaths = filePaths
+        self.batch_size = batch_size
+
+    def process(self):
+        for start in range(0, len(self.filePaths), self.batch_size):
+            batch = self.filePaths[start:start + self.batch_size]
+
+            self.process_batch(batch)
+
+            logger.info(f"Loaded {start + len(batch)}/{len(self.filePaths)} matches")
+
+    def process_batch(self, filePaths: list[str]):
+        matches = []
+
+        for filePath in filePaths:
+            with open(filePath, 'r') as file:
+                data = json.load(file)
+
+            matches.append(self.build_match(data))
+
+        self.write_matches(matches)
+        self.session.commit()
+
+    def build_match(self, data: dict) -> dict:
+        self.try_create_dimensions(data)
+
+        innings = []
+        for innings_num, innings_data in enumerate(data["innings"], start=1):
+            innings.append(self.build_innings_rows(innings_data, innings_num))
+
+        return {
+            "match": self.build_match_row(data),
+            "info": data["info"],
+            "host_country": self.curr_data.host_country,
+            "innings": innings
+        }
+
+    def write_matches(self, matches: list[dict]):
+        match_ids = self.allocate_ids("matches", "match_id", len(matches))
+        innings_ids = iter(self.allocate_ids("innings", "innings_id", sum(len(match["innings"]) for match in matches)))
 
-            
+        rows = {table: [] for table in ["matches", "innings"] + list(INNINGS_TABLES.keys())}
+        cube_rows = []
 
-        
+        for match, match_id in zip(matches, match_ids):
+            rows["matches"].append(dict(match["match"], match_id = match_id))
+            cube_rows.extend(self.build_cube_rows(match_id, match["info"], match["host_country"], match["innings"]))
 
+            for innings in match["innings"]:
+                innings_id = next(innings_ids)
 
+                rows["innings"].append(dict(innings["innings"], match_id = match_id, innings_id = innings_id))
 
+                for table in INNINGS_TABLES:
+                    for row in innings[table]:
+                        rows[table].append(dict(row, match_id = match_id, innings_id = innings_id))
 
+        self.write_rows(Match, rows["matches"])
+        self.write_rows(Innings, rows["innings"])
+
+        for table, model in INNINGS_TABLES.items():
+            self.write_rows(model, rows[table])
+
+        # one upsert for the whole batch, cells touched by several matches are merged client side
+        self.cube.add_rows(cube_rows)
+
+        return match_ids
+
+    def allocate_ids(self, table: str, column: str, count: int) -> list[int]:
+        if count == 0:
+            return []
+
+        result = self.session.execute(
+            text(f"SELECT nextval(pg_get_serial_sequence('{table}', '{column}')) FROM generate_series(1, :count)"),
+            {"count": count}
+        )
 
+        return [row[0] for row in result]
+
+    def write_rows(self, model, rows: list[dict]):
+        if not rows:
+            return
+
+        columns = list(rows[0].keys())
+        connection = self.session.connection().connection
+        cursor = connection.cursor()
+
+        # pg8000 streams COPY through execute, psycopg2 through copy_expert
+        is_pg8000 = type(cursor).__module__.startswith("pg8000")
+
+        if not is_pg8000 and not hasattr(cursor, "copy_expert"):
+            for start in range(0, len(rows), INSERT_CHUNK_ROWS):
+                self.session.execute(insert(model.__table__).values(rows[start:start + INSERT_CHUNK_ROWS]))
+            return
+
+        column_types = {column.name: column.type for column in model.__table__.columns}
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        for row in rows:
+            writer.writerow([copy_value(column_types[column], row[column]) for column in columns])
+
+        buffer.seek(0)
+
+        # nulls are written as \N so empty strings stay empty strings
+        copy_sql = f"COPY {model.__tablename__} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+        if is_pg8000:
+            cursor.execute(copy_sql, stream=buffer)
+        else:
+            cursor.copy_expert(copy_sql, buffer)
+
+
+class IncrementalProcessMatchData(BulkProcessMatchData):
+    '''
+    Loads a directory or zip of cricsheet files against the ingest manifest.
+
+    Unchanged files (same content hash) are skipped, new files are bulk loaded and changed files replace their
+    previously loaded match, the delete and the reload of a batch happen in a single transaction.
+    Replaced matches are subtracted from the player stats cube before they are deleted.
+    '''
+
+    def __init__(self, path: str, session, batch_size: int = 200):
+        super().__init__([], session, batch_size)
+        self.path = path
+
+    def process(self):
+        manifest = {row.file_name: row for row in self.session.query(IngestManifest)}
+
+        # file name -> hash, then each batch is read again, only one batch of files is held in memory at a time
+        changed = []
+        skipped = 0
+
+        with self.open_archive() as archive:
+            file_names = self.list_files(archive)
+            current_names = set(file_names)
+
+            for file_name in file_names:
+                content_hash = hashlib.sha256(self.read_file(archive, file_name)).hexdigest()
+
+                entry = manifest.get(file_name)
+                if entry is not None and entry.content_hash == content_hash:
+                    skipped += 1
+                    continue
+
+                changed.append((file_name, content_hash, self.get_previous_name(file_name, manifest, current_names)))
+
+            logger.info(f"Found {len(changed)} new or changed files, skipping {skipped} unchanged files")
+
+            for start in range(0, len(changed), self.batch_size):
+                batch = changed[start:start + self.batch_size]
+                contents = [self.read_file(archive, file_name) for file_name, _, _ in batch]
+
+                self.process_changed(batch, contents, manifest)
+
+                logger.info(f"Loaded {start + len(batch)}/{len(changed)} matches")
+
+    def open_archive(self):
+        if zipfile.is_zipfile(self.path):
+            return zipfile.ZipFile(self.path)
+
+        return contextlib.nullcontext()
+
+    def list_files(self, archive) -> list[str]:
+        # zip entries by their full path, two files with the same name in different folders are different matches
+        if archive is not None:
+            return sorted(file_name for file_name in archive.namelist() if file_name.endswith(".json"))
+
+        return sorted(file_name for file_name in os.listdir(self.path) if file_name.endswith(".json"))
+
+    def read_file(self, archive, file_name: str) -> bytes:
+        if archive is not None:
+            return archive.read(file_name)
+
+        with open(os.path.join(self.path, file_name), 'rb') as file:
+            return file.read()
+
+    def get_previous_name(self, file_name: str, manifest: dict, current_names: set[str]) -> Optional[str]:
+        # manifest key of the match this file replaces, zip entries used to be keyed by their base name
+        if file_name in manifest:
+            return file_name
+
+        legacy_name = os.path.basename(file_name)
+
+        # unless a file of the archive still has that name, then the entry is its own
+        if legacy_name in manifest and legacy_name not in current_names:
+            return legacy_name
+
+        return None
+
+    def process_changed(self, batch: list[tuple], contents: list[bytes], manifest: dict):
+        # dimensions are committed as they are created, so build everything before touching the old matches
+        matches = [self.build_match(json.loads(content)) for content in contents]
+
+        # a legacy entry shared by colliding files is only replaced once
+        previous_names = list(dict.fromkeys(previous_name for _, _, previous_name in batch if previous_name in manifest))
+        old_match_ids = [manifest[previous_name].match_id for previous_name in previous_names if manifest[previous_name].match_id is not None]
+        legacy_names = [previous_name for previous_name in previous_names if previous_name not in {file_name for file_name, _, _ in batch}]
+
+        try:
+            touched_cells = self.cube.remove_matches(old_match_ids)
+
+            self.delete_matches(old_match_ids)
+
+            match_ids = self.write_matches(matches)
+
+            self.cube.refresh_best(touched_cells)
+
+            ingested_at = datetime.now(timezone.utc)
+            rows = [
+                {
+                    "file_name": file_name,
+                    "match_id": match_id,
+                    "content_hash": content_hash,
+                    "ingested_at": ingested_at
+                }
+                for (file_name, content_hash, _), match_id in zip(batch, match_ids)
+            ]
+
+            if legacy_names:
+                self.session.query(IngestManifest).filter(IngestManifest.file_name.in_(legacy_names)).delete(synchronize_session=False)
+
+            statement = pg_insert(IngestManifest.__table__).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=["file_name"],
+                set_={
+                    "match_id": statement.excluded.match_id,
+                    "content_hash": statement.excluded.content_hash,
+                    "ingested_at": statement.excluded.ingested_at
+                }
+            )
+            self.session.execute(statement)
+
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        for legacy_name in legacy_names:
+            manifest.pop(legacy_name, None)
+
+        for row in rows:
+            manifest[row["file_name"]] = IngestManifest(**row)
+
+    def delete_matches(self, match_ids: list[int]):
+        if not match_ids:
+            return
+
+        # the manifest points at the match, so detach it before deleting
+        self.session.query(IngestManifest).filter(IngestManifest.match_id.in_(match_ids)).update({"match_id": None}, synchronize_session=False)
+
+        for model in reversed(list(INNINGS_TABLES.values())):
+            self.session.query(model).filter(model.match_id.in_(match_ids)).delete(synchronize_session=False)
+
+        self.session.query(Innings).filter(Innings.match_id.in_(match_ids)).delete(synchronize_session=False)
+        self.session.query(Match).filter(Match.match_id.in_(match_ids)).delete(synchronize_session=False)
+
+
+@staticmethod
+def get_event_name(data: dict) -> str:
+    event = data["info"].get("event")
+
+    if event is not None:
+        return event["name"]
+
+    return " v ".join(data["info"]["teams"])
+
+@staticmethod
+def new_player_stats(**kwargs) -> dict:
+    stats = {
+        "runs_scored": 0,
+        "balls_faced": 0,
+        "fours": 0,
+        "sixes": 0,
+        "balls_bowled": 0,
+        "runs_conceded": 0,
+        "wickets_taken": 0,
+        "fours_conceded": 0,
+        "sixes_conceded": 0,
+        "catches": 0,
+        "run_outs": 0,
+        "stumpings": 0,
+        "not_out": True,
+        "did_not_bat": True,
+        "did_not_bowl": True
+    }
+    stats.update(kwargs)
+    return stats
+
+@staticmethod
+def new_player_vs_player_stats() -> dict:
+    return {
+        "runs_scored": 0,
+        "balls_faced": 0,
+        "fours": 0,
+        "sixes": 0,
+        "outs": 0,
+        "balls_bowled": 0,
+        "runs_conceded": 0,
+        "fours_conceded": 0,
+        "sixes_conceded": 0,
+        "wickets_taken": 0
+    }
+
+@staticmethod
+def rate(numerator: float, denominator: float, multiplier: float):
+    if not denominator:
+        return None
+    return numerator / denominator * multiplier
+
+@staticmethod
+def player_innings_row(player_id: int, stats: dict) -> dict:
+    return {
+        "player_id": player_id,
+        "runs_scored": stats["runs_scored"],
+        "balls_faced": stats["balls_faced"],
+        "fours": stats["fours"],
+        "sixes": stats["sixes"],
+        "strike_rate": rate(stats["runs_scored"], stats["balls_faced"], 100),
+        "not_out": stats["not_out"],
+        "did_not_bat": stats["did_not_bat"],
+        "did_not_bowl": stats["did_not_bowl"],
+        "balls_bowled": stats["balls_bowled"],
+        "wickets_taken": stats["wickets_taken"],
+        "runs_conceded": stats["runs_conceded"],
+        "economy": rate(stats["runs_conceded"], stats["balls_bowled"], 6),
+        "catches": stats["catches"],
+        "run_outs": stats["run_outs"],
+        "stumpings": stats["stumpings"]
+    }
+
+@staticmethod
+def player_over_row(player_id: int, stats: dict) -> dict:
+    return {
+        "player_id": player_id,
+        "over_number": stats["over_number"],
+        "runs_scored": stats["runs_scored"],
+        "balls_faced": stats["balls_faced"],
+        "strike_rate": rate(stats["runs_scored"], stats["balls_faced"], 100),
+        "fours": stats["fours"],
+        "sixes": stats["sixes"],
+        "not_out": stats["not_out"],
+        "balls_bowled": stats["balls_bowled"],
+        "runs_conceded": stats["runs_conceded"],
+        "wickets_taken": stats["wickets_taken"],
+        "economy": rate(stats["runs_conceded"], stats["balls_bowled"], 6),
+        "fours_conceded": stats["fours_conceded"],
+        "sixes_conceded": stats["sixes_conceded"]
+    }
+
+@staticmethod
+def player_vs_player_row(key: str, stats: dict) -> dict:
+    batsman_id, bowler_id = key.split("_")
+
+    return {
+        "batsman_id": int(batsman_id),
+        "bowler_id": int(bowler_id),
+        "runs_scored": stats["runs_scored"],
+        "balls_faced": stats["balls_faced"],
+        "fours": stats["fours"],
+        "sixes": stats["sixes"],
+        "strike_rate": rate(stats["runs_scored"], stats["balls_faced"], 100),
+        "outs": stats["outs"],
+        "overs_bowled": stats["balls_bowled"] // 6 + (stats["balls_bowled"] % 6) / 10,
+        "runs_conceded": stats["runs_conceded"],
+        "fours_conceded": stats["fours_conceded"],
+        "sixes_conceded": stats["sixes_conceded"],
+        "wickets_taken": stats["wickets_taken"],
+        "economy": rate(stats["runs_conceded"], stats["balls_bowled"], 6)
+    }
+
+@staticmethod
+def partnership_row(key: str, stats: dict) -> dict:
+    player1_id, player2_id = key.split("_")
+
+    return {
+        "player1_id": int(player1_id),
+        "player2_id": int(player2_id),
+        "runs_scored": stats["runs"],
+        "balls_faced": stats["balls"],
+        "fours": stats["four"],
+        "sixes": stats["six"],
+        "out": str(stats["out"]),
+        "strike_rate": rate(stats["runs"], stats["balls"], 100)
+    }
+
+@staticmethod
+def copy_value(column_type, value):
+    # values in the postgres COPY csv format, \N means null, see write_rows
+    if value is None:
+        return "\\N"
+    if isinstance(column_type, JSONB):
+        return json.dumps(value)
+    if isinstance(column_type, ARRAY):
+        return "{" + ",".join(str(v) for v in value) + "}"
+    return value
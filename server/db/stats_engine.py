@@ -0,0 +1,796 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Optional
+import sqlalchemy
+from data_models.cricinfo import CricInfoPlayer, CricInfoAllRound, months
+from db.cube import PlayerStatsCube, decode_best_innings, decode_best_bowling
+from utils.logging import time_logger
+
+logger = logging.getLogger(__name__)
+
+# statsguru class -> cricsheet match types
+MATCH_TYPES = {
+    1: ["Test"],
+    2: ["ODI"],
+    3: ["T20", "IT20"],
+    11: ["Test", "ODI", "T20", "IT20"],
+}
+
+STATS_TYPES = ["batting", "bowling", "fielding", "allround"]
+
+PLAYER_VIEWS = [None, "default", "innings", "match", "year", "season", "opposition", "ground", "series"]
+
+# model fields that can be answered from the database, anything else falls back to statsguru
+PLAYER_FIELDS = {
+    "player", "type", "class_", "opposition", "span", "innings_number", "result", "toss",
+    "runs_scored", "balls_bowled", "runs_conceded", "wickets_taken", "view", "orderby", "orderbyad",
+}
+
+ALLROUND_FIELDS = {
+    "type", "class_", "team", "opposition", "span", "innings_number", "result", "toss",
+    "runs_scored", "balls_bowled", "runs_conceded", "wickets_taken", "view", "groupby",
+    "result_qualifications", "qual_value", "orderby", "orderbyad",
+}
+
+# player queries answered from the pre aggregated player_stats_cube instead of the innings rows,
+# only Test and ODI since the cube has no team_type to tell international T20s from domestic ones,
+# and no innings number filter since a match is only counted in the player's first innings of it
+CUBE_FIELDS = {"player", "type", "class_", "opposition", "view", "orderby", "orderbyad"}
+CUBE_TYPES = ["batting", "bowling"]
+CUBE_VIEWS = [None, "default", "year", "opposition"]
+CUBE_CLASSES = [1, 2]
+
+# statsguru orderby/qualification values -> column header of the generated rows
+ORDERBY_HEADERS = {
+    "matches": "Mat",
+    "innings": "Inns",
+    "notouts": "NO",
+    "runs": "Runs",
+    "high_score": "HS",
+    "batting_average": "Ave",
+    "balls_faced": "BF",
+    "batting_strike_rate": "SR",
+    "hundreds": "100",
+    "fifty_plus": "50",
+    "ducks": "0",
+    "fours": "4s",
+    "sixes": "6s",
+    "balls": "Balls",
+    "conceded": "Runs",
+    "wickets": "Wkts",
+    "bowling_average": "Ave",
+    "economy_rate": "Econ",
+    "bowling_strike_rate": "SR",
+    "four_wickets": "4",
+    "five_wickets": "5",
+    "dismissals": "Dis",
+    "caught": "Ct",
+    "stumped": "St",
+    "dismissals_per_inns": "D/I",
+}
+
+MAX_LIST_ROWS = 50
+
+# statsguru's order of a list without an orderby
+DEFAULT_ORDERBY = {
+    "batting": "runs",
+    "bowling": "wickets",
+    "fielding": "dismissals",
+    "allround": "runs",
+}
+
+# statsguru orderby/qualification values -> the column of an ALLROUND_QUERY row, innings depends on the type
+ORDERBY_COLUMNS = {
+    "matches": "matches",
+    "notouts": "not_outs",
+    "runs": "runs_scored",
+    "high_score": "best_innings",
+    "batting_average": "runs_scored::float / NULLIF(innings - not_outs, 0)",
+    "balls_faced": "balls_faced",
+    "batting_strike_rate": "runs_scored * 100.0 / NULLIF(balls_faced, 0)",
+    "hundreds": "hundreds",
+    "fifty_plus": "fifties",
+    "ducks": "ducks",
+    "fours": "fours",
+    "sixes": "sixes",
+    "balls": "balls_bowled",
+    "conceded": "runs_conceded",
+    "wickets": "wickets_taken",
+    "bowling_average": "runs_conceded::float / NULLIF(wickets_taken, 0)",
+    "economy_rate": "runs_conceded * 6.0 / NULLIF(balls_bowled, 0)",
+    "bowling_strike_rate": "balls_bowled::float / NULLIF(wickets_taken, 0)",
+    "four_wickets": "four_wickets",
+    "five_wickets": "five_wickets",
+    "dismissals": "catches + stumpings",
+    "caught": "catches",
+    "stumped": "stumpings",
+    "dismissals_per_inns": "(catches + stumpings)::float / NULLIF(fielded_innings, 0)",
+}
+
+INNINGS_COLUMNS = {
+    "batting": "innings",
+    "bowling": "innings_bowled",
+    "fielding": "fielded_innings",
+    "allround": "innings",
+}
+
+INNINGS_QUERY = """
+WITH numbered_innings AS (
+    SELECT innings_id, match_id, batting_team_id, bowling_team_id,
+           ROW_NUMBER() OVER (PARTITION BY match_id ORDER BY innings_id) AS innings_number
+    FROM innings
+    -- super overs don't count towards the stats or the innings numbers
+    WHERE innings.super_over IS NOT TRUE
+),
+batting_bowling AS (
+    SELECT psi.* FROM player_stats_innings psi
+    WHERE {player_filter}
+),
+fielding_innings AS (
+    SELECT f.fielder_id AS player_id, f.match_id, f.innings_id,
+           SUM(CASE WHEN f.out_type IN ('caught', 'caught and bowled') THEN 1 ELSE 0 END) AS catches,
+           SUM(CASE WHEN f.out_type = 'stumped' THEN 1 ELSE 0 END) AS stumpings
+    FROM fielding f
+    WHERE {fielder_filter}
+    GROUP BY f.fielder_id, f.match_id, f.innings_id
+),
+player_innings AS (
+    SELECT COALESCE(bb.player_id, fi.player_id) AS player_id,
+           COALESCE(bb.match_id, fi.match_id) AS match_id,
+           COALESCE(bb.innings_id, fi.innings_id) AS innings_id,
+           COALESCE(bb.runs_scored, 0) AS runs_scored,
+           COALESCE(bb.balls_faced, 0) AS balls_faced,
+           COALESCE(bb.fours, 0) AS fours,
+           COALESCE(bb.sixes, 0) AS sixes,
+           COALESCE(bb.not_out, TRUE) AS not_out,
+           COALESCE(bb.did_not_bat, TRUE) = FALSE AS batted,
+           COALESCE(bb.did_not_bowl, TRUE) = FALSE AS bowled,
+           COALESCE(bb.balls_bowled, 0) AS balls_bowled,
+           COALESCE(bb.runs_conceded, 0) AS runs_conceded,
+           COALESCE(bb.wickets_taken, 0) AS wickets_taken,
+           COALESCE(fi.catches, 0) AS catches,
+           COALESCE(fi.stumpings, 0) AS stumpings
+    FROM batting_bowling bb
+    FULL OUTER JOIN fielding_innings fi ON fi.player_id = bb.player_id AND fi.innings_id = bb.innings_id
+)
+SELECT * FROM (
+    SELECT pi.*, p.name AS player_name, n.innings_number,
+           m.match_type, m.team_type, m.gender, m.match_dates[1] AS start_date, m.season,
+           m.outcome->>'winner' AS winner, m.outcome->>'result' AS outcome_result,
+           m.toss->>'winner' AS toss_winner,
+           CASE WHEN pi.batted THEN bt.name ELSE bw.name END AS team,
+           CASE WHEN pi.batted THEN bw.name ELSE bt.name END AS opposition,
+           s.name AS ground, t.name AS series
+    FROM player_innings pi
+    JOIN players p ON p.player_id = pi.player_id
+    JOIN matches m ON m.match_id = pi.match_id
+    JOIN numbered_innings n ON n.innings_id = pi.innings_id
+    LEFT JOIN teams bt ON bt.team_id = n.batting_team_id
+    LEFT JOIN teams bw ON bw.team_id = n.bowling_team_id
+    LEFT JOIN stadiums s ON s.stadium_id = m.stadium_id
+    LEFT JOIN tournaments t ON t.tournament_id = m.tournament_id
+) player_rows
+WHERE {filters}
+{order}
+"""
+
+# one row per player of the innings rows matching the filters, in the shape of a PlayerStatsCube.rollup row,
+# the best list is picked in the database instead of loading every international innings
+ALLROUND_QUERY = """
+WITH filtered AS ({innings_query}),
+player_stats AS (
+    SELECT player_id, player_name,
+           STRING_AGG(DISTINCT team, '/' ORDER BY team) AS teams,
+           MIN(EXTRACT(YEAR FROM start_date))::int AS first_year,
+           MAX(EXTRACT(YEAR FROM start_date))::int AS last_year,
+           COUNT(DISTINCT match_id) AS matches,
+           COUNT(*) FILTER (WHERE batted) AS innings,
+           COUNT(*) FILTER (WHERE batted AND not_out) AS not_outs,
+           COALESCE(SUM(runs_scored) FILTER (WHERE batted), 0) AS runs_scored,
+           COALESCE(SUM(balls_faced) FILTER (WHERE batted), 0) AS balls_faced,
+           COALESCE(SUM(fours) FILTER (WHERE batted), 0) AS fours,
+           COALESCE(SUM(sixes) FILTER (WHERE batted), 0) AS sixes,
+           COUNT(*) FILTER (WHERE batted AND runs_scored >= 100) AS hundreds,
+           COUNT(*) FILTER (WHERE batted AND runs_scored >= 50 AND runs_scored < 100) AS fifties,
+           COUNT(*) FILTER (WHERE batted AND runs_scored = 0 AND NOT not_out) AS ducks,
+           MAX(runs_scored * 2 + CASE WHEN not_out THEN 1 ELSE 0 END) FILTER (WHERE batted) AS best_innings,
+           COUNT(*) FILTER (WHERE bowled) AS innings_bowled,
+           COALESCE(SUM(balls_bowled) FILTER (WHERE bowled), 0) AS balls_bowled,
+           COALESCE(SUM(runs_conceded) FILTER (WHERE bowled), 0) AS runs_conceded,
+           COALESCE(SUM(wickets_taken) FILTER (WHERE bowled), 0) AS wickets_taken,
+           COUNT(*) FILTER (WHERE bowled AND wickets_taken = 4) AS four_wickets,
+           COUNT(*) FILTER (WHERE bowled AND wickets_taken >= 5) AS five_wickets,
+           MAX(wickets_taken * 10000 - runs_conceded) FILTER (WHERE bowled) AS best_bowling,
+           COUNT(*) FILTER (WHERE NOT batted) AS fielded_innings,
+           SUM(catches)::int AS catches,
+           SUM(stumpings)::int AS stumpings
+    FROM filtered
+    GROUP BY player_id, player_name
+)
+SELECT * FROM player_stats
+WHERE {qualifications}
+ORDER BY {orderby} {direction} NULLS LAST, player_id
+LIMIT :limit
+"""
+
+
+class LocalStatsEngine:
+    '''
+    Answers validated CricInfoPlayer / CricInfoAllRound queries with SQL over the ball by ball database,
+    returning rows in the same shape as CricInfoClient.extract_table_data.
+
+    Only a subset of the statsguru filters can be answered from the cricsheet data, search returns None
+    for anything else so that the caller can fall back to statsguru.
+    '''
+
+    def __init__(self, engine: sqlalchemy.engine.Engine):
+        self.engine = engine
+
+        with open('static/teams.json') as f:
+            teams = json.load(f)
+
+        # statsguru team id -> team name, cricsheet uses the same team names
+        self.team_names = {team_id: name for name, team_id in teams.items()}
+
+    @time_logger()
+    async def search(self, model, class_name: str = None) -> Optional[list[dict]]:
+        if not self.supports(model):
+            return None
+
+        try:
+            return await asyncio.to_thread(self.execute, model, class_name)
+        except Exception as e:
+            logger.error(f"Error in local stats query, falling back to statsguru: {e}")
+            return None
+
+    def supports(self, model) -> bool:
+        if isinstance(model, CricInfoPlayer):
+            fields = PLAYER_FIELDS
+            if model.view not in PLAYER_VIEWS:
+                return False
+        elif isinstance(model, CricInfoAllRound):
+            fields = ALLROUND_FIELDS
+            if model.view not in [None, "default"] or model.groupby not in [None, "default"]:
+                return False
+        else:
+            return False
+
+        if model.type not in STATS_TYPES or model.class_ not in MATCH_TYPES:
+            return False
+
+        for key, value in model.__dict__.items():
+            if value is not None and key not in fields:
+                return False
+
+        return True
+
+    def execute(self, model, class_name: str = None) -> Optional[list[dict]]:
+        if isinstance(model, CricInfoPlayer):
+            return self.execute_player(model, class_name)
+
+        return self.execute_allround(model)
+
+    def execute_player(self, player: CricInfoPlayer, class_name: str = None) -> Optional[list[dict]]:
+        # None falls back to statsguru, the player isn't in the database or has no matching innings in it
+        player_id = self.get_player_id(player.player)
+
+        if player_id is None:
+            return None
+
+        if self.supports_cube(player):
+            return self.execute_player_cube(player, player_id, class_name)
+
+        results = []
+
+        rows = self.fetch_rows(player, player_id=player_id)
+
+        if not rows:
+            return None
+
+        if class_name == "player":
+            # career summary, same as the "head" table on the statsguru player page
+            career_rows = self.fetch_rows(CricInfoPlayer(player=player.player, type=player.type, class_=player.class_), player_id=player_id)
+
+            unfiltered = {"": "unfiltered"}
+            unfiltered.update(aggregate(career_rows, player.type))
+            results.append(unfiltered)
+
+            filtered = {"": "filtered"}
+            filtered.update(aggregate(rows, player.type))
+            results.append(filtered)
+
+        view = player.view or "default"
+
+        if view == "default":
+            stats = [dict({"Grouping": "overall"}, **aggregate(rows, player.type))]
+        elif view == "innings":
+            stats = [innings_row(row, player.type) for row in rows if is_relevant(row, player.type)]
+        else:
+            stats = []
+            for label, group in group_rows(rows, view).items():
+                stats.append(dict({"Grouping": label}, **aggregate(group, player.type)))
+
+        results.extend(sort_rows(stats, player.orderby, player.orderbyad))
+
+        return results
+
+    def supports_cube(self, player: CricInfoPlayer) -> bool:
+        if player.type not in CUBE_TYPES or player.view not in CUBE_VIEWS or player.class_ not in CUBE_CLASSES:
+            return False
+
+        return all(value is None or key in CUBE_FIELDS for key, value in player.__dict__.items())
+
+    def execute_player_cube(self, player: CricInfoPlayer, player_id: int, class_name: str = None) -> Optional[list[dict]]:
+        results = []
+
+        match_types = MATCH_TYPES[player.class_]
+        opposition = self.get_team_names(player.opposition) if player.opposition else None
+
+        with self.engine.connect() as conn:
+            cube = PlayerStatsCube(conn)
+
+            if class_name == "player":
+                for label, filter_opposition in [("unfiltered", None), ("filtered", opposition)]:
+                    cells = cube.rollup([], player_id=player_id, match_types=match_types, opposition=filter_opposition)
+
+                    head = {"": label}
+                    head.update(cell_aggregate(cells[0] if cells else None, player.type))
+                    results.append(head)
+
+            view = player.view or "default"
+            group_by = [] if view == "default" else [view]
+
+            cells = cube.rollup(group_by, player_id=player_id, match_types=match_types, opposition=opposition)
+
+        # nothing in the cube for this slice, same as an empty fetch_rows
+        if not cells:
+            return None
+
+        if view == "default":
+            stats = [dict({"Grouping": "overall"}, **cell_aggregate(cells[0] if cells else None, player.type))]
+        else:
+            stats = []
+            for cell in cells:
+                label = f"year {cell['year']}" if view == "year" else f"v {cell['opposition']}"
+                stats.append(dict({"Grouping": label}, **cell_aggregate(cell, player.type)))
+
+        results.extend(sort_rows(stats, player.orderby, player.orderbyad))
+
+        return results
+
+    def execute_allround(self, allround: CricInfoAllRound) -> Optional[list[dict]]:
+        filters, params = self.build_filters(allround)
+
+        innings_query = INNINGS_QUERY.format(player_filter="TRUE", fielder_filter="TRUE", filters=" AND ".join(filters), order="")
+
+        qualifications = ["TRUE"]
+
+        if allround.result_qualifications is not None and allround.qual_value is not None:
+            column = get_orderby_column(allround.result_qualifications, allround.type)
+            value_from, value_to = allround.qual_value
+
+            if column is not None and value_from != -1:
+                qualifications.append(f"{column} >= :qual_from")
+                params["qual_from"] = value_from
+            if column is not None and value_to != -1:
+                qualifications.append(f"{column} <= :qual_to")
+                params["qual_to"] = value_to
+
+        orderby = get_orderby_column(allround.orderby, allround.type) or get_orderby_column(DEFAULT_ORDERBY[allround.type], allround.type)
+        params["limit"] = MAX_LIST_ROWS
+
+        query = ALLROUND_QUERY.format(
+            innings_query=innings_query,
+            qualifications=" AND ".join(qualifications),
+            orderby=orderby,
+            direction="ASC" if allround.orderbyad == "reverse" else "DESC"
+        )
+
+        rows = self.execute_query(query, params)
+
+        # nothing in the database for these filters, statsguru may still have it
+        if not rows:
+            return None
+
+        return [
+            dict({"Player": f"{row['player_name']} ({row['teams'] or ''})"}, **cell_aggregate(row, allround.type))
+            for row in rows
+        ]
+
+    def get_player_id(self, cricinfo_id) -> Optional[int]:
+        # players.cricinfo_id is filled by "python -m player_directory --sql"
+        statement = sqlalchemy.text("SELECT player_id FROM players WHERE cricinfo_id = :cricinfo_id")
+
+        with self.engine.connect() as conn:
+            return conn.execute(statement, {"cricinfo_id": int(cricinfo_id)}).scalar()
+
+    def fetch_rows(self, model, player_id: int = None) -> list[dict]:
+        # player_id is the database id, see get_player_id
+        filters, params = self.build_filters(model)
+
+        if player_id is not None:
+            player_filter = "psi.player_id = :player"
+            fielder_filter = "f.fielder_id = :player"
+            params["player"] = player_id
+        else:
+            player_filter = "TRUE"
+            fielder_filter = "TRUE"
+
+        query = INNINGS_QUERY.format(
+            player_filter=player_filter,
+            fielder_filter=fielder_filter,
+            filters=" AND ".join(filters),
+            order="ORDER BY start_date, innings_id"
+        )
+
+        return self.execute_query(query, params)
+
+    def execute_query(self, query: str, params: dict) -> list[dict]:
+        statement = sqlalchemy.text(query)
+
+        for key, value in params.items():
+            if isinstance(value, list):
+                statement = statement.bindparams(sqlalchemy.bindparam(key, expanding=True))
+
+        with self.engine.connect() as conn:
+            result = conn.execute(statement, params)
+            return [dict(row._mapping) for row in result]
+
+    def build_filters(self, model) -> tuple[list[str], dict]:
+        # statsguru classes 1, 2, 3 and 11 are men's internationals, team names are shared with the women's sides
+        filters = ["match_type IN :match_types", "team_type = 'international'", "gender = 'male'"]
+        params = {"match_types": MATCH_TYPES[model.class_]}
+
+        if getattr(model, "team", None):
+            filters.append("team IN :team")
+            params["team"] = self.get_team_names(model.team)
+
+        if model.opposition:
+            filters.append("opposition IN :opposition")
+            params["opposition"] = self.get_team_names(model.opposition)
+
+        if model.span:
+            span_from, span_to = model.span
+            if span_from not in ['-1', -1]:
+                filters.append("start_date >= :span_from")
+                params["span_from"] = datetime.strptime(span_from, "%d-%m-%Y").date()
+            if span_to not in ['-1', -1]:
+                filters.append("start_date <= :span_to")
+                params["span_to"] = datetime.strptime(span_to, "%d-%m-%Y").date()
+
+        if model.innings_number:
+            filters.append("innings_number IN :innings_number")
+            params["innings_number"] = model.innings_number
+
+        if model.result:
+            results = {
+                1: "winner = team",
+                2: "winner = opposition",
+                3: "outcome_result = 'tie'",
+                4: "outcome_result = 'draw'",
+                5: "outcome_result = 'no result'",
+            }
+            filters.append("(" + " OR ".join(results[r] for r in model.result if r in results) + ")")
+
+        if model.toss is not None:
+            filters.append("toss_winner = team" if model.toss == 1 else "toss_winner = opposition")
+
+        for field, column in [("runs_scored", "runs_scored"), ("balls_bowled", "balls_bowled"), ("runs_conceded", "runs_conceded"), ("wickets_taken", "wickets_taken")]:
+            value = getattr(model, field)
+            if value is None:
+                continue
+
+            value_from, value_to = value
+            if value_from != -1:
+                filters.append(f"{column} >= :{field}_from")
+                params[f"{field}_from"] = value_from
+            if value_to != -1:
+                filters.append(f"{column} <= :{field}_to")
+                params[f"{field}_to"] = value_to
+
+        return filters, params
+
+    def get_team_names(self, team_ids: list[int]) -> list[str]:
+        return [self.team_names.get(team_id, str(team_id)) for team_id in team_ids]
+
+
+@staticmethod
+def aggregate(rows: list[dict], type: str) -> dict:
+    years = [row["start_date"].year for row in rows if row["start_date"] is not None]
+    span = f"{min(years)}-{max(years)}" if years else "-"
+
+    matches = len({row["match_id"] for row in rows})
+
+    batting = [row for row in rows if row["batted"]]
+    bowling = [row for row in rows if row["bowled"]]
+
+    runs = sum(row["runs_scored"] for row in batting)
+    not_outs = sum(1 for row in batting if row["not_out"])
+    outs = len(batting) - not_outs
+    balls_faced = sum(row["balls_faced"] for row in batting)
+
+    high_score = "-"
+    if batting:
+        best = max(row["runs_scored"] for row in batting)
+        not_out = any(row["not_out"] for row in batting if row["runs_scored"] == best)
+        high_score = f"{best}*" if not_out else str(best)
+
+    balls = sum(row["balls_bowled"] for row in bowling)
+    conceded = sum(row["runs_conceded"] for row in bowling)
+    wickets = sum(row["wickets_taken"] for row in bowling)
+
+    best_bowling = "-"
+    if bowling:
+        best = max(bowling, key=lambda row: (row["wickets_taken"], -row["runs_conceded"]))
+        best_bowling = f"{best['wickets_taken']}/{best['runs_conceded']}"
+
+    catches = sum(row["catches"] for row in rows)
+    stumpings = sum(row["stumpings"] for row in rows)
+
+    if type == "batting":
+        return {
+            "Span": span,
+            "Mat": str(matches),
+            "Inns": str(len(batting)),
+            "NO": str(not_outs),
+            "Runs": str(runs),
+            "HS": high_score,
+            "Ave": ratio(runs, outs),
+            "BF": str(balls_faced),
+            "SR": ratio(runs * 100, balls_faced),
+            "100": str(sum(1 for row in batting if row["runs_scored"] >= 100)),
+            "50": str(sum(1 for row in batting if 50 <= row["runs_scored"] < 100)),
+            "0": str(sum(1 for row in batting if row["runs_scored"] == 0 and not row["not_out"])),
+            "4s": str(sum(row["fours"] for row in batting)),
+            "6s": str(sum(row["sixes"] for row in batting)),
+        }
+    elif type == "bowling":
+        return {
+            "Span": span,
+            "Mat": str(matches),
+            "Inns": str(len(bowling)),
+            "Balls": str(balls),
+            "Runs": str(conceded),
+            "Wkts": str(wickets),
+            "BBI": best_bowling,
+            "Ave": ratio(conceded, wickets),
+            "Econ": ratio(conceded * 6, balls),
+            "SR": ratio(balls, wickets, digits=1),
+            "4": str(sum(1 for row in bowling if row["wickets_taken"] == 4)),
+            "5": str(sum(1 for row in bowling if row["wickets_taken"] >= 5)),
+        }
+    elif type == "fielding":
+        fielded = [row for row in rows if not row["batted"]]
+        return {
+            "Span": span,
+            "Mat": str(matches),
+            "Inns": str(len(fielded)),
+            "Dis": str(catches + stumpings),
+            "Ct": str(catches),
+            "St": str(stumpings),
+            "D/I": ratio(catches + stumpings, len(fielded), digits=3),
+        }
+
+    batting_average = ratio(runs, outs)
+    bowling_average = ratio(conceded, wickets)
+    average_difference = "-"
+    if outs and wickets:
+        average_difference = f"{runs / outs - conceded / wickets:.2f}"
+
+    return {
+        "Span": span,
+        "Mat": str(matches),
+        "Runs": str(runs),
+        "HS": high_score,
+        "Bat Av": batting_average,
+        "100": str(sum(1 for row in batting if row["runs_scored"] >= 100)),
+        "Wkts": str(wickets),
+        "BBI": best_bowling,
+        "Bowl Av": bowling_average,
+        "5": str(sum(1 for row in bowling if row["wickets_taken"] >= 5)),
+        "Ct": str(catches),
+        "St": str(stumpings),
+        "Ave Diff": average_difference,
+    }
+
+@staticmethod
+def get_orderby_column(orderby: Optional[str], type: str) -> Optional[str]:
+    if orderby == "innings":
+        return INNINGS_COLUMNS.get(type)
+
+    return ORDERBY_COLUMNS.get(orderby)
+
+@staticmethod
+def cell_aggregate(cell: Optional[dict], type: str) -> dict:
+    # same headers as aggregate, from a PlayerStatsCube.rollup or ALLROUND_QUERY row,
+    # fielding and allround are only computed by ALLROUND_QUERY
+    if cell is None:
+        return aggregate([], type)
+
+    span = f"{cell['first_year']}-{cell['last_year']}"
+
+    high_score = "-"
+    best = decode_best_innings(cell["best_innings"])
+    if best is not None:
+        high_score = f"{best[0]}*" if best[1] else str(best[0])
+
+    best_bowling = "-"
+    best = decode_best_bowling(cell["best_bowling"])
+    if best is not None:
+        best_bowling = f"{best[0]}/{best[1]}"
+
+    outs = cell["innings"] - cell["not_outs"]
+    dismissals = cell["catches"] + cell["stumpings"]
+
+    if type == "fielding":
+        return {
+            "Span": span,
+            "Mat": str(cell["matches"]),
+            "Inns": str(cell["fielded_innings"]),
+            "Dis": str(dismissals),
+            "Ct": str(cell["catches"]),
+            "St": str(cell["stumpings"]),
+            "D/I": ratio(dismissals, cell["fielded_innings"], digits=3),
+        }
+    elif type == "allround":
+        average_difference = "-"
+        if outs and cell["wickets_taken"]:
+            average_difference = f"{cell['runs_scored'] / outs - cell['runs_conceded'] / cell['wickets_taken']:.2f}"
+
+        return {
+            "Span": span,
+            "Mat": str(cell["matches"]),
+            "Runs": str(cell["runs_scored"]),
+            "HS": high_score,
+            "Bat Av": ratio(cell["runs_scored"], outs),
+            "100": str(cell["hundreds"]),
+            "Wkts": str(cell["wickets_taken"]),
+            "BBI": best_bowling,
+            "Bowl Av": ratio(cell["runs_conceded"], cell["wickets_taken"]),
+            "5": str(cell["five_wickets"]),
+            "Ct": str(cell["catches"]),
+            "St": str(cell["stumpings"]),
+            "Ave Diff": average_difference,
+        }
+
+    if type == "batting":
+        return {
+            "Span": span,
+            "Mat": str(cell["matches"]),
+            "Inns": str(cell["innings"]),
+            "NO": str(cell["not_outs"]),
+            "Runs": str(cell["runs_scored"]),
+            "HS": high_score,
+            "Ave": ratio(cell["runs_scored"], outs),
+            "BF": str(cell["balls_faced"]),
+            "SR": ratio(cell["runs_scored"] * 100, cell["balls_faced"]),
+            "100": str(cell["hundreds"]),
+            "50": str(cell["fifties"]),
+            "0": str(cell["ducks"]),
+            "4s": str(cell["fours"]),
+            "6s": str(cell["sixes"]),
+        }
+
+    return {
+        "Span": span,
+        "Mat": str(cell["matches"]),
+        "Inns": str(cell["innings_bowled"]),
+        "Balls": str(cell["balls_bowled"]),
+        "Runs": str(cell["runs_conceded"]),
+        "Wkts": str(cell["wickets_taken"]),
+        "BBI": best_bowling,
+        "Ave": ratio(cell["runs_conceded"], cell["wickets_taken"]),
+        "Econ": ratio(cell["runs_conceded"] * 6, cell["balls_bowled"]),
+        "SR": ratio(cell["balls_bowled"], cell["wickets_taken"], digits=1),
+        "4": str(cell["four_wickets"]),
+        "5": str(cell["five_wickets"]),
+    }
+
+@staticmethod
+def innings_row(row: dict, type: str) -> dict:
+    details = {
+        "Inns": str(row["innings_number"]),
+        "Opposition": f"v {row['opposition']}",
+        "Ground": row["ground"] or "",
+        "Start Date": format_date(row["start_date"]),
+    }
+
+    score = f"{row['runs_scored']}*" if row["not_out"] else str(row["runs_scored"])
+    overs = f"{row['balls_bowled'] // 6}.{row['balls_bowled'] % 6}"
+
+    if type == "batting":
+        stats = {
+            "Runs": score,
+            "BF": str(row["balls_faced"]),
+            "4s": str(row["fours"]),
+            "6s": str(row["sixes"]),
+            "SR": ratio(row["runs_scored"] * 100, row["balls_faced"]),
+        }
+    elif type == "bowling":
+        stats = {
+            "Overs": overs,
+            "Runs": str(row["runs_conceded"]),
+            "Wkts": str(row["wickets_taken"]),
+            "Econ": ratio(row["runs_conceded"] * 6, row["balls_bowled"]),
+        }
+    elif type == "fielding":
+        stats = {
+            "Dis": str(row["catches"] + row["stumpings"]),
+            "Ct": str(row["catches"]),
+            "St": str(row["stumpings"]),
+        }
+    else:
+        stats = {
+            "Score": score if row["batted"] else "DNB",
+            "Overs": overs if row["bowled"] else "DNB",
+            "Conc": str(row["runs_conceded"]) if row["bowled"] else "-",
+            "Wkts": str(row["wickets_taken"]) if row["bowled"] else "-",
+            "Ct": str(row["catches"]),
+            "St": str(row["stumpings"]),
+        }
+
+    stats.update(details)
+    return stats
+
+@staticmethod
+def is_relevant(row: dict, type: str) -> bool:
+    if type == "batting":
+        return row["batted"]
+    elif type == "bowling":
+        return row["bowled"]
+    elif type == "fielding":
+        return not row["batted"]
+    return True
+
+@staticmethod
+def group_rows(rows: list[dict], view: str) -> dict[str, list[dict]]:
+    groups = {}
+
+    for row in rows:
+        if view == "year":
+            label = f"year {row['start_date'].year}"
+        elif view == "season":
+            label = f"season {row['season']}"
+        elif view == "opposition":
+            label = f"v {row['opposition']}"
+        elif view == "ground":
+            label = row["ground"] or ""
+        elif view == "series":
+            label = row["series"] or ""
+        else:
+            # match view
+            label = f"v {row['opposition']}, {row['ground'] or ''}, {format_date(row['start_date'])}"
+
+        groups.setdefault(label, []).append(row)
+
+    return groups
+
+@staticmethod
+def sort_rows(rows: list[dict], orderby: Optional[str], orderbyad: Optional[str]) -> list[dict]:
+    header = ORDERBY_HEADERS.get(orderby)
+
+    if header is None:
+        # keep the chronological order
+        return rows if orderbyad != "reverse" else list(reversed(rows))
+
+    def key(row: dict) -> float:
+        try:
+            return float(str(row.get(header, "-")).rstrip("*"))
+        except ValueError:
+            return float("-inf")
+
+    return sorted(rows, key=key, reverse=orderbyad != "reverse")
+
+@staticmethod
+def ratio(numerator: float, denominator: float, digits: int = 2) -> str:
+    if not denominator:
+        return "-"
+    return f"{numerator / denominator:.{digits}f}"
+
+@staticmethod
+def format_date(value) -> str:
+    if value is None:
+        return ""
+    return f"{value.day} {months[value.month - 1]} {value.year}"
@@ -4,14 +4,26 @@ from data_models.cricinfo import CricInfoAllRound, get_class_description, popula
 from id_mapper import IdMapper
 from utils.utils import load_json, filter_results
 from utils.prompts import get_summary_promt
-import json
-from datetime import datetime
+from db.stats_engine import LocalStatsEngine
+from similarity_cache import SimilarityCache
+from execution.fused_params import use_fused_prompt, get_likely_type_views, get_view_fields, get_query_candidates, get_fused_prompt
+from id_mapper import DROPDOWN_CLASSES
+from utils.speculative import SpeculativeTasks
+from utils.prompt_registry import prompts
+from utils.mappings import get_mapping, get_type_views, MappingNotFoundError
+from typing import Optional
+import asyncio
 
 class AllRound:
-    def __init__(self, openai_client: OpenAIClient, cricinfo_client: CricInfoClient, id_mapper: IdMapper):
+    # sampled similarity cache hits being resolved again, kept referenced until done since an AllRound only lives for one request
+    verify_tasks: set[asyncio.Task] = set()
+
+    def __init__(self, openai_client: OpenAIClient, cricinfo_client: CricInfoClient, id_mapper: IdMapper, stats_engine: Optional[LocalStatsEngine] = None, similarity_cache: Optional[SimilarityCache] = None):
         self.openai_client = openai_client
         self.cricinfo_client = cricinfo_client
         self.id_mapper = id_mapper
+        self.stats_engine = stats_engine
+        self.similarity_cache = similarity_cache
 
     async def get_summary(self, query, result: list) -> str:
         system_prompt = get_summary_promt()
@@ -25,10 +37,75 @@ class AllRound:
         return summary
 
     async def execute(self, input_data: dict):
-        system_prompt = get_stats_prompt()
-
         query = input_data["query"]
 
+        # reuse the parameters of a similar past query, otherwise ask the llm
+        response = None
+
+        if self.similarity_cache is not None:
+            response = self.similarity_cache.lookup("allround", query)
+
+            if response is not None and self.similarity_cache.should_verify():
+                task = asyncio.create_task(self.verify_params(query, dict(response)))
+                self.verify_tasks.add(task)
+                task.add_done_callback(self.verify_tasks.discard)
+
+        if response is None:
+            # refresh the dropdowns while the llm call runs, resolve_params shares the refreshes
+            speculative = SpeculativeTasks()
+            for entity in DROPDOWN_CLASSES:
+                speculative.start(f"options_{entity}", self.id_mapper.populate_options(entity))
+
+            try:
+                response = await self.resolve_params(query)
+            finally:
+                speculative.cancel_all()
+
+            if response is None:
+                return {
+                    "result": "No response from the model",
+                    "query": query,
+                    "url": None
+                }
+
+            if self.similarity_cache is not None:
+                self.similarity_cache.add("allround", query, response)
+
+        #load the cricinfo batting
+        batting = CricInfoAllRound.model_validate(response)
+
+        #now get the url
+        query_url = batting.get_query_url()
+
+        print(query_url)
+
+        #query the cricinfo site
+
+        #try the local database first, then query the cricinfo site
+        result = None
+
+        if self.stats_engine is not None:
+            result = await self.stats_engine.search(batting)
+
+        if result is None:
+            result = await self.cricinfo_client.get_search_data(query_url)
+
+        result = filter_results(result)
+
+        summary = await self.get_summary(query, result)
+
+        return {
+            "result": summary,
+            "query": query,
+            "url": query_url
+        }
+
+    async def resolve_params(self, query: str) -> Optional[dict]:
+        if use_fused_prompt:
+            return await self.resolve_params_fused(query)
+
+        system_prompt = get_stats_prompt()
+
         response = await self.openai_client.get_response(system_prompt=system_prompt, query=query)
 
         #load the response to json
@@ -36,13 +113,8 @@ class AllRound:
 
         print(response)
 
-        #now go through any string fields and convert them to id's
         if response is None or response == "":
-            return {
-                "result": "No response from the model",
-                "query": query,
-                "url": None
-            }
+            return None
 
         #now get the order by, groupby and result qualification fields
         type = response.get("type", "allround")
@@ -53,10 +125,12 @@ class AllRound:
         grounds: list[str] = response.get("ground", None)
 
         #get probable values for the fields
-        probable_tournaments = None if tournaments is None else await self.id_mapper.get_probable_matches("trophies", tournaments)
-        probable_series = None if series is None else await self.id_mapper.get_probable_matches("series", series)
-        probable_seasons = None if seasons is None else await self.id_mapper.get_probable_matches("seasons", seasons)
-        probable_grounds = None if grounds is None else await self.id_mapper.get_probable_matches("stadiums", grounds)
+        probable_tournaments, probable_series, probable_seasons, probable_grounds = await self.id_mapper.get_probable_matches_many({
+            "trophies": tournaments,
+            "series": series,
+            "seasons": seasons,
+            "stadiums": grounds,
+        })
 
         view_prompt = get_view_fields_prompt(type, view, probable_tournaments, probable_series, probable_seasons, probable_grounds)
 
@@ -76,27 +150,41 @@ class AllRound:
         if response.get("groupby") == "default":
             response["groupby"] = None
 
-        #load the cricinfo batting
-        batting = CricInfoAllRound.model_validate(response)
+        return response
 
-        #now get the url
-        query_url = batting.get_query_url()
+    async def resolve_params_fused(self, query: str) -> Optional[dict]:
+        # one llm call for the filter and the view fields, with the view fields of the likely type/view pairs
+        type_views = get_likely_type_views(query, ["batting", "bowling", "fielding", "allround", "team", "aggregate", "fow", "official"], default_types=["allround", "team"])
+        view_fields = {(type, view): get_view_fields(type, view) for type, view in type_views}
 
-        print(query_url)
+        candidates = await get_query_candidates(self.id_mapper, query)
 
-        #query the cricinfo site
+        system_prompt = get_fused_prompt(get_stats_prompt(), type_views, view_fields, candidates)
 
-        result = await self.cricinfo_client.get_search_data(query_url)
+        response = load_json(await self.openai_client.get_response(system_prompt=system_prompt, query=query))
 
-        result = filter_results(result)
+        if response is None or response == "":
+            return None
 
-        summary = await self.get_summary(query, result)
+        response = await populate_ids(response, self.id_mapper)
 
-        return {
-            "result": summary,
-            "query": query,
-            "url": query_url
-        }
+        if response.get("view") == "default":
+            response["view"] = None # set it to None
+        
+        if response.get("groupby") == "default":
+            response["groupby"] = None
+
+        return response
+
+    async def verify_params(self, query: str, cached_params: dict):
+        # shadow check of a similarity cache hit, only logged
+        try:
+            resolved_params = await self.resolve_params(query)
+        except Exception as e:
+            resolved_params = None
+            print(f"Error verifying the similarity cache hit: {e}")
+
+        self.similarity_cache.record_verification(query, cached_params, resolved_params)
 
 @staticmethod
 def get_view_fields_prompt(type: str, view: str, probable_tournaments: list[str], probable_series: list[str], probable_seasons: list[str], probable_grounds: list[str]) -> str:
@@ -104,31 +192,25 @@ def get_view_fields_prompt(type: str, view: str, probable_tournaments: list[str]
     if view is None or view == "":
         view = "default"
 
-    #depending on the type and view, provide the prompt
-    type_view = f"orderbyselect_{type}_{view}"
-
-    having_select = f"havingselect_{type}_{view}"
-
-    groupby_fields_select = f"groupby_{type}"
+    return prompts.get("allround_view_fields", (type, view), probable_tournaments=probable_tournaments, probable_series=probable_series,
+                       probable_seasons=probable_seasons, probable_grounds=probable_grounds)
 
+@staticmethod
+def build_view_fields_prompt(type: str, view: str) -> str:
     groupby_fields = {}
 
     if view == "default":
         # then we need to provide groupby fields
         if type != "aggregate":
             try:
-                with open(f"static/mappings/{groupby_fields_select}.json", "r") as f:
-                    groupby_fields = json.load(f)
-            except FileNotFoundError:
-                print(f"File not found for {groupby_fields_select}")
-            
-            
+                groupby_fields = get_mapping("groupby", type)
+            except MappingNotFoundError:
+                print(f"File not found for groupby_{type}")
 
-    with open(f"static/mappings/{having_select}.json", "r") as f:
-        having_select = json.load(f)
+    #depending on the type and view, provide the prompt
+    having_select = get_mapping("having", type, view)
 
-    with open(f"static/mappings/{type_view}.json", "r") as f:
-        orderby_fields = json.load(f)
+    orderby_fields = get_mapping("orderby", type, view)
 
     return f'''
 
@@ -198,10 +280,10 @@ def get_view_fields_prompt(type: str, view: str, probable_tournaments: list[str]
 
     Along with this you have provided probable values for the tourmanets, series, seasons, grounds etc, you need to provide the correct values for these fields in the json structure.
 
-    Probable values for the touramnets are : {probable_tournaments}
-    Probable values for the series are : {probable_series}
-    Probable values for the seasons are : {probable_seasons}
-    Probable values for the grounds are : {probable_grounds}
+    Probable values for the touramnets are : $probable_tournaments
+    Probable values for the series are : $probable_series
+    Probable values for the seasons are : $probable_seasons
+    Probable values for the grounds are : $probable_grounds
 
     These probable values are retried by string match, you need to use your reasoning to provide the correct values for the fields, it's possible that you can provide more than one value for the fields, if you think it's required.
 
@@ -233,10 +315,14 @@ def get_view_fields_prompt(type: str, view: str, probable_tournaments: list[str]
 
 @staticmethod
 def get_stats_prompt():
+    return prompts.get("allround_stats")
+
+@staticmethod
+def build_stats_prompt():
     return f'''
     You are an intelligent AI agent, whose reponsibilty is to provide a json structure that can be used to query the cricinfo website for batting stats.
     
-    Current Time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, which means you have stats knowledge till this time.
+    Current Time: $current_time, which means you have stats knowledge till this time.
     
     These are the follwing fields that you need to provide depending on the query:
 
@@ -340,3 +426,7 @@ def get_stats_prompt():
     Return a valid json format, don't add comments in the json format, make sure it is a valid json format and all the fields are in the correct format.
 
     '''
+
+
+prompts.register("allround_stats", build_stats_prompt)
+prompts.register("allround_view_fields", build_view_fields_prompt, get_type_views())
@@ -0,0 +1,141 @@
+import os
+import asyncio
+import re
+import json
+from id_mapper import IdMapper
+from utils.mappings import get_mapping, has_mapping, MappingNotFoundError
+
+# resolve the filter and the view fields (orderby, result qualifications, groupby) with a single llm call
+use_fused_prompt = os.environ.get("FUSED_PARAMS_PROMPT", 'False').lower() == 'true'
+
+# words hinting at the stats type, matched as word prefixes so "wicket" also matches "wickets"
+TYPE_KEYWORDS = {
+    "batting": ["bat", "run", "score", "century", "centuries", "hundred", "fifties", "fifty", "duck", "strike rate", "four", "six"],
+    "bowling": ["bowl", "wicket", "economy", "maiden", "five-for", "fifer", "haul"],
+    "fielding": ["field", "catch", "stumping", "keeper", "keeping"],
+    "allround": ["allround", "all-round", "all round"],
+    "team": ["team", "win", "won", "lost", "loss", "toss", "result", "chase", "chasing"],
+    "aggregate": ["aggregate", "total runs in", "total wickets in"],
+    "fow": ["partnership", "stand"],
+    "official": ["umpire", "referee", "official"],
+}
+
+VIEW_KEYWORDS = {
+    "innings": ["innings by innings", "each innings", "every innings", "per innings", "in an innings", "in a single innings"],
+    "match": ["match by match", "each match", "every match", "in a match"],
+    "series": ["each series", "per series", "in a series", "in a single series", "series wise", "series-wise", "by series"],
+    "ground": ["ground", "venue", "stadium"],
+    "host": ["host", "each country", "by country"],
+    "opposition": ["opposition", "opponent", "each team", "against each", "against every", "by team"],
+    "year": ["year"],
+    "season": ["season"],
+    "cumulative": ["cumulative", "progression"],
+    "results": ["match results", "results"],
+    "awards": ["award", "player of the match", "man of the match", "player of the series", "man of the series"],
+}
+
+# at most this many types are offered to the model, the view fields of each type/view pair are sent in full
+MAX_TYPES = 3
+
+# dropdown entity -> field of the query json
+CANDIDATE_FIELDS = {
+    "trophies": "trophy",
+    "series": "series",
+    "seasons": "season",
+    "stadiums": "ground",
+}
+
+
+@staticmethod
+def get_likely_type_views(query: str, types: list[str], default_types: list[str]) -> list[tuple[str, str]]:
+    '''
+    Guesses the type/view pairs the query can resolve to from its words, the default view is always included.
+    '''
+    query = query.lower()
+
+    likely_types = [type for type in types if matches_keywords(query, TYPE_KEYWORDS.get(type, []))][:MAX_TYPES]
+
+    if not likely_types:
+        likely_types = default_types
+
+    likely_views = ["default"] + [view for view, keywords in VIEW_KEYWORDS.items() if matches_keywords(query, keywords)]
+
+    type_views = []
+    for type in likely_types:
+        for view in likely_views:
+            if has_mapping("orderby", type, view):
+                type_views.append((type, view))
+
+    return type_views
+
+@staticmethod
+def matches_keywords(query: str, keywords: list[str]) -> bool:
+    return any(re.search(r"\b" + re.escape(keyword), query) for keyword in keywords)
+
+@staticmethod
+def get_view_fields(type: str, view: str, groupby: bool = True, exclude: list[str] = None) -> dict:
+    # the same mappings the two step prompts use
+    fields = {}
+
+    for name, kind, mapping_view in [
+        ("orderby", "orderby", view),
+        ("result_qualifications", "having", view),
+        ("groupby", "groupby", ""),
+    ]:
+        if name == "groupby" and (not groupby or view != "default" or type == "aggregate"):
+            continue
+
+        try:
+            values = get_mapping(kind, type, mapping_view)
+        except MappingNotFoundError:
+            continue
+
+        for key in exclude or []:
+            if isinstance(values, dict):
+                values.pop(key, None)
+            elif key in values:
+                values.remove(key)
+
+        fields[name] = values
+
+    return fields
+
+@staticmethod
+async def get_query_candidates(id_mapper: IdMapper, query: str) -> dict[str, list[str]]:
+    # the trophies, series, seasons and grounds that the query text itself fuzzy matches
+    matches = await asyncio.gather(*[id_mapper.get_probable_matches_in_query(entity, query) for entity in CANDIDATE_FIELDS])
+
+    return {field: values for field, values in zip(CANDIDATE_FIELDS.values(), matches) if values}
+
+@staticmethod
+def get_fused_prompt(stats_prompt: str, type_views: list[tuple[str, str]], view_fields: dict, candidates: dict[str, list[str]]) -> str:
+    type_view_fields = "\n".join(
+        f"    type: {type}, view: {view}\n    {json.dumps(view_fields[(type, view)])}\n"
+        for type, view in type_views
+    )
+
+    candidate_values = "\n".join(f"    {field}: {values}" for field, values in candidates.items()) or "    None found"
+
+    return stats_prompt + f'''
+
+    Along with the fields above, you also need to provide the view fields in the same json, there won't be another query for them.
+
+    These are the possible values of the view fields for the likely type and view combinations of this query:
+
+{type_view_fields}
+
+    Only pick the values listed under the type and view you selected above:
+
+    "orderby": "<order by>", a single value, the stats are sorted by highest to lowest
+    "orderbyad": "reverse", only if the query explicitly needs lowest to highest
+    "result_qualifications": "<result_qualification>" with "qual_value": [from, to], only when the query needs a minimum or maximum on the overall stats, like min 1000 runs
+    "groupby": "<groupby>", only when listed and the view is default
+
+    If the type/view you need isn't listed, still fill type and view and leave out the view fields.
+
+    For the trophy, series, season and ground fields only use these values, they are matched from the query text, omit the field if none of them is correct:
+
+{candidate_values}
+
+    Return everything as one valid json structure.
+    '''
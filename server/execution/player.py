@@ -4,15 +4,35 @@ from data_models.cricinfo import CricInfoPlayer, get_class_description, populate
 from id_mapper import IdMapper
 from utils.utils import load_json, filter_results
 from utils.prompts import get_summary_promt
-import asyncio, json, os
-from datetime import datetime
+from db.stats_engine import LocalStatsEngine
+from similarity_cache import SimilarityCache
+from player_directory import normalize_name
+from execution.fused_params import use_fused_prompt, get_likely_type_views, get_view_fields, get_query_candidates, get_fused_prompt, matches_keywords
+from id_mapper import DROPDOWN_CLASSES
+from utils.speculative import SpeculativeTasks
+from utils.prompt_registry import prompts
+from utils.mappings import get_mapping, get_type_views
+from typing import Optional
+import asyncio
+
+# statsguru class of each format
+FORMAT_KEYWORDS = {
+    1: ["test"],
+    2: ["odi", "one day", "one-day"],
+    3: ["t20i", "t20 international"],
+}
 
 
 class Player:
-    def __init__(self, openai_client: OpenAIClient, cricinfo_client: CricInfoClient, id_mapper: IdMapper):
+    # sampled similarity cache hits being resolved again, kept referenced until done since a Player only lives for one request
+    verify_tasks: set[asyncio.Task] = set()
+
+    def __init__(self, openai_client: OpenAIClient, cricinfo_client: CricInfoClient, id_mapper: IdMapper, stats_engine: Optional[LocalStatsEngine] = None, similarity_cache: Optional[SimilarityCache] = None):
         self.openai_client = openai_client
         self.cricinfo_client = cricinfo_client
         self.id_mapper = id_mapper
+        self.stats_engine = stats_engine
+        self.similarity_cache = similarity_cache
 
     async def get_summary(self, query, result: list) -> str:
         system_prompt = get_summary_promt()
@@ -28,11 +48,42 @@ class Player:
 
 
     async def execute(self, input_data: dict):
+        query = input_data["query"]
+
+        # the dropdown refreshes don't need the player id, run them while it's resolved
+        speculative = SpeculativeTasks()
+        for entity in DROPDOWN_CLASSES:
+            speculative.start(f"options_{entity}", self.id_mapper.populate_options(entity))
+
+        try:
+            return await self.execute_speculative(input_data, speculative)
+        finally:
+            speculative.cancel_all()
+
+    async def execute_speculative(self, input_data: dict, speculative: SpeculativeTasks):
         # extract the player name from the query
         player_name = input_data["player"]
-
         query = input_data["query"]
 
+        # reuse the parameters of a similar past query for the same player, scoped by the name as asked so the
+        # lookup doesn't wait for the player id
+        scope = f"player_{normalize_name(player_name)}"
+        names = [player_name]
+
+        response = None
+
+        if self.similarity_cache is not None:
+            response = self.similarity_cache.lookup(scope, query, exclude=names)
+
+            if response is not None and self.similarity_cache.should_verify():
+                task = asyncio.create_task(self.verify_params(query, dict(response)))
+                self.verify_tasks.add(task)
+                task.add_done_callback(self.verify_tasks.discard)
+
+        # otherwise ask the llm while the player id is resolved
+        if response is None:
+            speculative.start("params", self.resolve_params(query))
+
         # first fetch the player id
         player_name, player_id = await self.cricinfo_client.get_cricinfo_player(player_name)
 
@@ -42,7 +93,45 @@ class Player:
                 "query": query,
                 "url": None
             }
-        
+
+        # the statsguru page of the guessed type and format, most queries without filters end up on it,
+        # not needed when the local database answers
+        guessed_url = None
+        if self.stats_engine is None:
+            guessed_url = guess_player_stats(query, player_id).get_query_url()
+            speculative.start("page", self.cricinfo_client.get_search_data(guessed_url, class_name="player"))
+
+        if response is None:
+            response = await speculative.take("params")
+
+            if response is None:
+                return {
+                    "result": "No response from the model",
+                    "query": query,
+                    "url": None
+                }
+
+            if self.similarity_cache is not None:
+                self.similarity_cache.add(scope, query, response, exclude=names)
+
+        response["player"] = player_id
+
+        #load the cricinfo batting
+        player_stats = CricInfoPlayer.model_validate(response)
+
+        # everything the plan needs is either done or shared with run_query now
+        for entity in DROPDOWN_CLASSES:
+            speculative.cancel(f"options_{entity}")
+
+        if player_stats.get_query_url() != guessed_url:
+            speculative.cancel("page")
+
+        return await self.run_query(query, player_stats)
+
+    async def resolve_params(self, query: str) -> Optional[dict]:
+        if use_fused_prompt:
+            return await self.resolve_params_fused(query)
+
         # now query llm for the json format
         system_prompt = get_stats_prompt()
 
@@ -52,11 +141,7 @@ class Player:
 
         #load the response to json
         if response is None or response == "":
-            return {
-                "result": "No response from the model",
-                "query": query,
-                "url": None
-            }
+            return None
 
         #now get the order by fields
         type = response.get("type", "allround")
@@ -68,10 +153,12 @@ class Player:
 
 
         #get probable values for the fields
-        probable_tournaments = None if tournaments is None else await self.id_mapper.get_probable_matches("trophies", tournaments)
-        probable_series = None if series is None else await self.id_mapper.get_probable_matches("series", series)
-        probable_seasons = None if seasons is None else await self.id_mapper.get_probable_matches("seasons", seasons)
-        probable_grounds = None if grounds is None else await self.id_mapper.get_probable_matches("stadiums", grounds)
+        probable_tournaments, probable_series, probable_seasons, probable_grounds = await self.id_mapper.get_probable_matches_many({
+            "trophies": tournaments,
+            "series": series,
+            "seasons": seasons,
+            "stadiums": grounds,
+        })
 
         # print(probable_tournaments, probable_series, probable_seasons, probable_grounds)
 
@@ -85,7 +172,27 @@ class Player:
         for key, value in view.items():
             response[key] = value
 
-        response["player"] = player_id
+        if response.get("view") == "default":
+            response["view"] = None # set it to None
+
+        #now go through any string fields and convert them to id's
+        response = await populate_ids(response, self.id_mapper)
+
+        return response
+
+    async def resolve_params_fused(self, query: str) -> Optional[dict]:
+        # one llm call for the filter and the view fields, with the view fields of the likely type/view pairs
+        type_views = get_likely_type_views(query, ["batting", "bowling", "fielding", "allround"], default_types=["batting"])
+        view_fields = {(type, view): get_view_fields(type, view, groupby=False, exclude=["player_name"]) for type, view in type_views}
+
+        candidates = await get_query_candidates(self.id_mapper, query)
+
+        system_prompt = get_fused_prompt(get_stats_prompt(), type_views, view_fields, candidates)
+
+        response = load_json(await self.openai_client.get_response(system_prompt=system_prompt, query=query))
+
+        if response is None or response == "":
+            return None
 
         if response.get("view") == "default":
             response["view"] = None # set it to None
@@ -93,17 +200,38 @@ class Player:
         #now go through any string fields and convert them to id's
         response = await populate_ids(response, self.id_mapper)
 
-        #load the cricinfo batting
-        player_stats = CricInfoPlayer.model_validate(response)
+        return response
+
+    async def verify_params(self, query: str, cached_params: dict):
+        # shadow check of a similarity cache hit, only logged
+        try:
+            resolved_params = await self.resolve_params(query)
+        except Exception as e:
+            resolved_params = None
+            print(f"Error verifying the similarity cache hit: {e}")
+
+        if resolved_params is not None:
+            resolved_params.pop("player", None)
+
+        cached_params.pop("player", None)
 
+        self.similarity_cache.record_verification(query, cached_params, resolved_params)
+
+    async def run_query(self, query: str, player_stats: CricInfoPlayer):
         #now get the url
         query_url = player_stats.get_query_url()
 
         print(query_url)
 
-        #query the cricinfo site
+        #try the local database first, then query the cricinfo site
+        result = None
+
+        if self.stats_engine is not None:
+            result = await self.stats_engine.search(player_stats, class_name="player")
+
         try:
-            result = await self.cricinfo_client.get_search_data(query_url, class_name="player")
+            if result is None:
+                result = await self.cricinfo_client.get_search_data(query_url, class_name="player")
         except Exception as e:
             return {
                 "result": "Error in querying the cricinfo site",
@@ -122,29 +250,38 @@ class Player:
             "url": query_url    
         }
 
+@staticmethod
+def guess_player_stats(query: str, player_id: int) -> CricInfoPlayer:
+    # type from the query words, format from the format names in it
+    type = get_likely_type_views(query, ["batting", "bowling", "fielding", "allround"], default_types=["batting"])[0][0]
+
+    classes = [class_ for class_, keywords in FORMAT_KEYWORDS.items() if matches_keywords(query.lower(), keywords)]
+
+    return CricInfoPlayer(player=player_id, type=type, class_=classes[0] if len(classes) == 1 else 11)
+
 @staticmethod
 def get_view_fields_prompt(type: str, view: str, probable_tournaments: list[str], probable_series: list[str], probable_seasons: list[str], probable_grounds: list[str]) -> str:
 
     if view is None or view == "":
         view = "default"
 
-    #depending on the type and view, provide the prompt
-    type_view = f"orderbyselect_{type}_{view}"
-
-    file_path = os.path.join('static', 'mappings', type_view + ".json")
+    return prompts.get("player_view_fields", (type, view), probable_tournaments=probable_tournaments, probable_series=probable_series,
+                       probable_seasons=probable_seasons, probable_grounds=probable_grounds)
 
-    with open(file_path, "r") as f:
-        orderby_fields = json.load(f)
+@staticmethod
+def build_view_fields_prompt(type: str, view: str) -> str:
+    #depending on the type and view, provide the prompt
+    orderby_fields = get_mapping("orderby", type, view)
 
-        if "player_name" in orderby_fields:
-            orderby_fields.remove("player_name") # as we have only one player
+    if "player_name" in orderby_fields:
+        orderby_fields.remove("player_name") # as we have only one player
 
     return f'''
 
     You are an intelligent AI agent, whose reponsibilty is to provide a json structure that can be used to query the cricinfo website for player stats.
     Specially you are responsible for the view orderby fields which are high importance for the query and earth can be in danger if you don't provide them correctly.
 
-    Current Time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, which means you have stats knowledge till this time.
+    Current Time: $current_time, which means you have stats knowledge till this time.
     
     You have selected the type as {type} and view as {view}, so you need to provide the orderby fields for the query.
 
@@ -171,10 +308,10 @@ def get_view_fields_prompt(type: str, view: str, probable_tournaments: list[str]
 
     Along with this you have provided probable values for the tourmanets, series, seasons, grounds etc, you need to provide the correct values for these fields in the json structure.
 
-    Probable values for the touramnets are : {probable_tournaments}
-    Probable values for the series are : {probable_series}
-    Probable values for the seasons are : {probable_seasons}
-    Probable values for the grounds are : {probable_grounds}
+    Probable values for the touramnets are : $probable_tournaments
+    Probable values for the series are : $probable_series
+    Probable values for the seasons are : $probable_seasons
+    Probable values for the grounds are : $probable_grounds
 
     These probable values are retried by string match, you need to use your reasoning to provide the correct values for the fields, it's possible that you can provide more than one value for the fields, if you think it's required.
 
@@ -204,6 +341,10 @@ def get_view_fields_prompt(type: str, view: str, probable_tournaments: list[str]
 
 @staticmethod
 def get_stats_prompt():
+    return prompts.get("player_stats")
+
+@staticmethod
+def build_stats_prompt():
     return f'''
     You are an intelligent AI agent, whose reponsibilty is to provide a json structure that can be used to query the cricinfo website for player stats.    
     These are the follwing fields that you need to provide depending on the query:
@@ -333,4 +474,8 @@ def get_stats_prompt():
 
     Return a valid json format, don't add comments in the json format, make sure it is a valid json format and all the fields are in the correct format.
 
-    '''
\ No newline at end of file
+    '''
+
+
+prompts.register("player_stats", build_stats_prompt)
+prompts.register("player_view_fields", build_view_fields_prompt, get_type_views(["batting", "bowling", "fielding", "allround"]))
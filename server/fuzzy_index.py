@@ -0,0 +1,86 @@
+import numpy as np
+from collections import defaultdict
+from rapidfuzz import fuzz, utils
+from rapidfuzz.process import cdist
+
+NGRAM_SIZE = 3
+# a name is only scored when it shares this fraction of the trigrams of the shorter of it and the query
+MIN_SHARED_NGRAMS = 0.2
+
+
+class FuzzyIndex:
+    '''
+    The dropdown names of one IdMapper entity, preprocessed once per refresh.
+
+    A lookup only scores the names sharing enough character trigrams with one of the queries, all queries at once with cdist.
+    Results are the ones of process.extract per query with utils.default_process and the same scorer, limit and cutoff,
+    except for names too far apart to share MIN_SHARED_NGRAMS, which in practice only score low with a partial match.
+    '''
+
+    def __init__(self, choices: list[str]):
+        self.choices = list(choices)
+        self.processed = [utils.default_process(choice) for choice in self.choices]
+
+        # trigram -> indices of the choices containing it
+        postings = defaultdict(list)
+        ngram_counts = []
+        for i, choice in enumerate(self.processed):
+            ngrams = get_ngrams(choice)
+            ngram_counts.append(len(ngrams))
+
+            for ngram in ngrams:
+                postings[ngram].append(i)
+
+        self.postings = {ngram: np.array(indices, dtype=np.int32) for ngram, indices in postings.items()}
+        self.ngram_counts = np.array(ngram_counts, dtype=np.int32)
+
+    def get_candidates(self, processed_queries: list[str]) -> np.ndarray:
+        candidates = []
+
+        for query in processed_queries:
+            # too short to share a trigram, but can still score high with a partial match
+            if len(query) < NGRAM_SIZE:
+                return np.arange(len(self.choices))
+
+            ngrams = get_ngrams(query)
+            postings = [self.postings[ngram] for ngram in ngrams if ngram in self.postings]
+
+            if not postings:
+                continue
+
+            shared = np.bincount(np.concatenate(postings), minlength=len(self.choices))
+            needed = np.maximum(np.ceil(np.minimum(len(ngrams), self.ngram_counts) * MIN_SHARED_NGRAMS), 1)
+
+            candidates.append(np.nonzero(shared >= needed)[0])
+
+        if not candidates:
+            return np.array([], dtype=np.int32)
+
+        return np.unique(np.concatenate(candidates))
+
+    def extract(self, queries: list[str], scorer=fuzz.WRatio, limit: int = 5, score_cutoff: float = 80) -> list[list[tuple[str, float]]]:
+        '''
+        Returns the best (choice, score) pairs above score_cutoff for each query, in the order of the queries.
+        '''
+        processed_queries = [utils.default_process(query) for query in queries]
+
+        candidates = self.get_candidates(processed_queries)
+
+        if len(candidates) == 0:
+            return [[] for _ in queries]
+
+        scores = cdist(processed_queries, [self.processed[i] for i in candidates], scorer=scorer, processor=None, score_cutoff=score_cutoff, workers=-1)
+
+        results = []
+        for row in scores:
+            # stable, ties keep the choices order like process.extract
+            best = np.argsort(-row, kind="stable")[:limit]
+            results.append([(self.choices[candidates[i]], float(row[i])) for i in best if row[i] > score_cutoff])
+
+        return results
+
+
+@staticmethod
+def get_ngrams(text: str) -> set[str]:
+    padded = f" {text} "
+    return {padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)}
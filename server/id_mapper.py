@@ -1,37 +1,62 @@
+import os
 import json
+import fcntl
+import logging
 from api_clients.cricinfo_client import CricInfoClient
 from cache import PersistentCache
+from utils.singleflight import SingleFlight
+from player_directory import PlayerDirectory
+from typing import Optional
 import time
-from rapidfuzz import process
+import asyncio
+from rapidfuzz import fuzz
+from fuzzy_index import FuzzyIndex
+
+# statsguru dropdown name of each option entity
+DROPDOWN_CLASSES = {
+    "stadiums": "ground",
+    "trophies": "trophy",
+    "series": "series",
+    "seasons": "season",
+}
+
+# dropdown snapshots shared by the workers on this host, one json file per entity with its fetch time
+SNAPSHOT_DIR = os.environ.get("DROPDOWN_SNAPSHOT_DIR", "dropdown_snapshots")
+REFRESH_INTERVAL = 86400
+# the background refresher renews a snapshot once it is this fraction of REFRESH_INTERVAL old, before requests see it expire
+REFRESH_AHEAD = 0.8
+# how long to wait while another worker refreshes, and after a first failed refresh, doubled per consecutive failure
+RETRY_INTERVAL = 60
+MAX_RETRY_INTERVAL = 3600
+
+logger = logging.getLogger(__name__)
 
 class IdMapper:
-    def __init__(self, cricInfoClient: CricInfoClient, cache:PersistentCache):
+    def __init__(self, cricInfoClient: CricInfoClient, cache:PersistentCache, player_directory: Optional[PlayerDirectory] = None):
         self.cricInfoClient = cricInfoClient
         self.cache = cache
+        # the cricinfo id of a register player is its statsguru id, no search needed
+        self.player_directory = player_directory
+        # concurrent misses for the same player or dropdown share one fetch
+        self.flight = SingleFlight("id_mapper")
+        # entity -> (data the index was built from, index)
+        self.indexes: dict[str, tuple[dict, FuzzyIndex]] = {}
 
         #TODO: use elasticsearch to store the data
         with open('static/teams.json') as f:
             self.teams = json.load(f)
         
-        self.stadiums = {
-            "last_updated": 0, #unix timestamp
-            "data": {}
-        }
+        # the last snapshot written by any worker, or the bundled static/<entity>.json on a cold start
+        self.stadiums = load_snapshot("stadiums")
+        self.trophies = load_snapshot("trophies")
+        self.series = load_snapshot("series")
+        self.seasons = load_snapshot("seasons")
 
-        self.trophies = {
-            "last_updated": 0, #unix timestamp
-            "data": {}
-        }
-
-        self.series = {
-            "last_updated": 0, #unix timestamp
-            "data": {}
-        }
-
-        self.seasons = {
-            "last_updated": 0, #unix timestamp
-            "data": {}
-        }
+        # entity -> time before which no refresh is attempted
+        self.next_refresh: dict[str, float] = {}
+        self.refresh_tasks: set[asyncio.Task] = set()
+        # consecutive failed refreshes, for the backoff
+        self.failures = 0
 
     async def get_id(self, field: str, value: str):
         if field == 'country':
@@ -53,6 +78,12 @@ class IdMapper:
         return self.teams.get(team)
     
     async def get_player_id(self, player: str):
+        if self.player_directory is not None:
+            player_info = self.player_directory.lookup(player)
+
+            if player_info is not None:
+                return player_info[1]
+
         player_cache_id = f"statsguru_player_{player}"
 
         player_cache_str = await self.cache.get(player_cache_id)
@@ -61,6 +92,9 @@ class IdMapper:
             player_cache = json.loads(player_cache_str)
             return player_cache["player_id"]
 
+        return await self.flight.do(player_cache_id, lambda: self.load_player_id(player_cache_id, player))
+
+    async def load_player_id(self, player_cache_id: str, player: str):
         player_id = await self.cricInfoClient.get_statsguru_player_id(player)
 
         player_cache_str = json.dumps({
@@ -84,40 +118,235 @@ class IdMapper:
         return self.seasons["data"].get(season)
             
     async def populate_options(self, entity: str):
+        if entity not in DROPDOWN_CLASSES:
+            raise ValueError(f"Entity {entity} not found")
+
+        options = getattr(self, entity)
         current_time = time.time()
-        if entity == 'stadiums':
-            if current_time - self.stadiums["last_updated"] > 86400:
-                self.stadiums["data"] = await self.cricInfoClient.get_dropdown_options("ground")
-                self.stadiums["last_updated"] = current_time
-        elif entity == 'trophies':
-            if current_time - self.trophies["last_updated"] > 86400:
-                self.trophies["data"] = await self.cricInfoClient.get_dropdown_options("trophy")
-                self.trophies["last_updated"] = current_time
-        elif entity == 'series':
-            if current_time - self.series["last_updated"] > 86400:
-                self.series["data"] = await self.cricInfoClient.get_dropdown_options("series")
-                self.series["last_updated"] = current_time
-        elif entity == 'seasons':
-            if current_time - self.seasons["last_updated"] > 86400:
-                self.seasons["data"] = await self.cricInfoClient.get_dropdown_options("season")
-                self.seasons["last_updated"] = current_time
+
+        if current_time - options["last_updated"] <= REFRESH_INTERVAL or current_time < self.next_refresh.get(entity, 0):
+            return
+
+        # one statsguru page has every dropdown, all the entities are refreshed together
+        refresh = self.flight.do("options", lambda: self.load_options(REFRESH_INTERVAL))
+
+        # stale data is served while the refresh runs, only a worker that never had any waits for it
+        # (with run_refresher running this is only reached on a cold start or after failed refreshes)
+        if options["data"]:
+            task = asyncio.create_task(refresh)
+            self.refresh_tasks.add(task)
+            task.add_done_callback(self.refresh_done)
         else:
-            raise ValueError(f"Entity {entity} not found")
+            await refresh
+
+    def refresh_done(self, task: asyncio.Task):
+        self.refresh_tasks.discard(task)
+
+        # already logged by load_options, only raised to the requests waiting on it
+        if not task.cancelled():
+            task.exception()
+
+    async def run_refresher(self, interval: float = 60):
+        '''
+        Refreshes the dropdowns ahead of their expiry until cancelled, meant to run as a background task.
+        '''
+        while True:
+            try:
+                await self.refresh_options()
+            except Exception as e:
+                # already logged by load_options, retried with backoff
+                logger.debug(f"Background dropdown refresh failed: {e}")
+
+            await asyncio.sleep(interval)
+
+    async def refresh_options(self):
+        current_time = time.time()
+        max_age = REFRESH_INTERVAL * REFRESH_AHEAD
+
+        due = [
+            entity for entity in DROPDOWN_CLASSES
+            if current_time - getattr(self, entity)["last_updated"] > max_age and current_time >= self.next_refresh.get(entity, 0)
+        ]
+
+        if due:
+            await self.flight.do("options", lambda: self.load_options(max_age))
+
+    async def load_options(self, max_age: float):
+        stale = []
+
+        try:
+            # another worker may have refreshed them already
+            stale = await self.load_snapshots(max_age)
+
+            if not stale:
+                return
+
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+            with open(os.path.join(SNAPSHOT_DIR, "dropdowns.lock"), "a") as lock:
+                if not await asyncio.to_thread(try_lock, lock):
+                    # being refreshed by another worker, picked up from the snapshots on a later call
+                    for entity in stale:
+                        self.next_refresh[entity] = time.time() + RETRY_INTERVAL
+                    return
+
+                try:
+                    stale = await self.load_snapshots(max_age)
+
+                    if stale:
+                        await self.fetch_snapshots(stale)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+            self.failures = 0
+
+        except Exception as e:
+            self.failures += 1
+            retry_interval = min(RETRY_INTERVAL * 2 ** (self.failures - 1), MAX_RETRY_INTERVAL)
+
+            logger.warning(f"Failed to refresh the dropdowns {stale} ({self.failures} in a row), retrying in {retry_interval}s: {e}")
+
+            for entity in stale:
+                self.next_refresh[entity] = time.time() + retry_interval
+
+            if any(not getattr(self, entity)["data"] for entity in stale):
+                raise
+
+    async def load_snapshots(self, max_age: float) -> list[str]:
+        # takes the newer snapshots from disk, returns the entities still older than max_age
+        snapshots = await asyncio.to_thread(read_snapshots)
+
+        # swapped in here on the event loop, never edited in place while requests read them
+        for entity, snapshot in snapshots.items():
+            if snapshot["last_updated"] > getattr(self, entity)["last_updated"]:
+                setattr(self, entity, snapshot)
+
+        current_time = time.time()
+
+        return [entity for entity in DROPDOWN_CLASSES if current_time - getattr(self, entity)["last_updated"] > max_age]
+
+    async def fetch_snapshots(self, entities: list[str]):
+        start_time = time.time()
+        dropdowns = await self.cricInfoClient.get_dropdown_snapshot()
+        fetched_at = time.time()
+
+        for entity in entities:
+            data = dropdowns.get(DROPDOWN_CLASSES[entity])
+
+            # the page layout changed or statsguru is down, keep what we have
+            if not data:
+                raise ValueError(f"no {DROPDOWN_CLASSES[entity]} options found on the statsguru page")
+
+            snapshot = {"last_updated": fetched_at, "refresh_duration": fetched_at - start_time, "data": data}
+            await asyncio.to_thread(save_snapshot, entity, snapshot)
+
+            setattr(self, entity, snapshot)
         
+    def options_stats(self) -> dict:
+        current_time = time.time()
+
+        entities = {}
+        for entity in DROPDOWN_CLASSES:
+            options = getattr(self, entity)
+
+            entities[entity] = {
+                "options": len(options["data"]),
+                # None for the bundled seed, never fetched
+                "age": current_time - options["last_updated"] if options["last_updated"] else None,
+                "refresh_duration": options.get("refresh_duration"),
+                "retry_in": max(self.next_refresh.get(entity, 0) - current_time, 0),
+            }
+
+        return {
+            "entities": entities,
+            "consecutive_failures": self.failures,
+        }
+
     async def get_probable_matches(self, entity, query: list[str]) -> list[str]:
         #populate cache if not already populated
         await self.populate_options(entity)
 
-        data = getattr(self, entity)["data"]
+        index = await self.get_index(entity)
 
-        matches = set()
+        # all the names scored in one batch, off the event loop
+        probable_matches = await asyncio.to_thread(index.extract, query, limit=5, score_cutoff=80)
 
-        for q in query:
-            probable_mactes =  process.extract(q, data.keys(), limit=5)
+        matches = set()
 
-            for match in probable_mactes:
-                if match[1] > 80:
-                    matches.add(match[0])
+        for query_matches in probable_matches:
+            for match in query_matches:
+                matches.add(match[0])
 
         return list(matches)
-        
\ No newline at end of file
+
+    async def get_index(self, entity: str) -> FuzzyIndex:
+        # rebuilt whenever the entity's data is replaced by a refresh
+        data = getattr(self, entity)["data"]
+
+        indexed = self.indexes.get(entity)
+
+        if indexed is None or indexed[0] is not data:
+            indexed = (data, await asyncio.to_thread(FuzzyIndex, list(data.keys())))
+            self.indexes[entity] = indexed
+
+        return indexed[1]
+
+    async def get_probable_matches_many(self, queries: dict[str, list[str]]) -> list[list[str]]:
+        # entity -> names, looked up concurrently, None names give None
+        async def get_matches(entity, names):
+            return None if names is None else await self.get_probable_matches(entity, names)
+
+        return await asyncio.gather(*[get_matches(entity, names) for entity, names in queries.items()])
+
+    async def get_probable_matches_in_query(self, entity, query: str, limit: int = 5) -> list[str]:
+        # options whose words all (or nearly all) appear in the query, used before the llm has named them
+        await self.populate_options(entity)
+
+        index = await self.get_index(entity)
+
+        matches = await asyncio.to_thread(index.extract, [query], scorer=fuzz.token_set_ratio, limit=limit, score_cutoff=80)
+
+        return [match[0] for match in matches[0]]
+
+
+@staticmethod
+def load_snapshot(entity: str) -> dict:
+    snapshot_path = os.path.join(SNAPSHOT_DIR, f"{entity}.json")
+
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path) as f:
+            return json.load(f)
+
+    # bundled seed, old enough to be refreshed by the first worker that gets to it
+    static_path = os.path.join("static", f"{entity}.json")
+
+    if os.path.exists(static_path):
+        with open(static_path) as f:
+            return {"last_updated": 0, "data": json.load(f)}
+
+    return {"last_updated": 0, "data": {}}
+
+@staticmethod
+def read_snapshots() -> dict[str, dict]:
+    return {entity: load_snapshot(entity) for entity in DROPDOWN_CLASSES}
+
+@staticmethod
+def save_snapshot(entity: str, snapshot: dict):
+    # written to a temporary file and renamed, readers never see a partial snapshot
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+    snapshot_path = os.path.join(SNAPSHOT_DIR, f"{entity}.json")
+    temp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+
+    with open(temp_path, "w") as f:
+        json.dump(snapshot, f)
+
+    os.replace(temp_path, snapshot_path)
+
+@staticmethod
+def try_lock(lock) -> bool:
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
@@ -0,0 +1,209 @@
+import os
+import io
+import csv
+import json
+import time
+import logging
+import argparse
+import urllib.request
+import sqlalchemy
+from collections import defaultdict
+from typing import Optional
+from rapidfuzz import utils
+
+logger = logging.getLogger(__name__)
+
+# built by running "python -m player_directory" from the server folder
+DIRECTORY_PATH = os.environ.get("PLAYER_DIRECTORY_PATH", os.path.join("static", "player_directory.json"))
+
+# cricsheet people register, people.csv has the ids of each person on other sites and names.csv the other names they played under
+REGISTER_URL = "https://cricsheet.org/register/"
+
+
+class PlayerDirectory:
+    '''
+    Local name -> cricinfo id lookups for every player of the cricsheet people register, the cricinfo id is also the
+    statsguru player id.
+
+    A name is resolved by an exact match on any known name of a player, then by first initial and surname
+    ("Sachin Tendulkar" -> "SR Tendulkar"). Names shared by more than one player are left to the caller (scraping).
+    '''
+
+    def __init__(self, players: Optional[dict] = None):
+        # cricinfo id -> {"name": canonical name, "aliases": [other names]}
+        self.players: dict[str, dict] = players or {}
+
+        # normalized name -> cricinfo ids, (first initial, surname) -> cricinfo ids
+        self.names: dict[str, set[str]] = defaultdict(set)
+        self.initials: dict[tuple[str, str], set[str]] = defaultdict(set)
+
+        for cricinfo_id, player in self.players.items():
+            for name in [player["name"]] + player["aliases"]:
+                self.add_name(name, cricinfo_id)
+
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, path: str = DIRECTORY_PATH) -> "PlayerDirectory":
+        if not os.path.exists(path):
+            logger.info(f"{path} not found, players are resolved by scraping only")
+            return cls()
+
+        with open(path, "r") as f:
+            directory = json.load(f)
+
+        return cls(directory["players"])
+
+    def add_name(self, name: str, cricinfo_id: str):
+        key = normalize_name(name)
+
+        if not key:
+            return
+
+        self.names[key].add(cricinfo_id)
+
+        tokens = key.split()
+        if len(tokens) > 1:
+            self.initials[(tokens[0][0], tokens[-1])].add(cricinfo_id)
+
+    def lookup(self, name: str) -> Optional[tuple[str, str]]:
+        '''
+        Returns (canonical name, cricinfo id), None when the name is unknown or ambiguous.
+        '''
+        key = normalize_name(name)
+        tokens = key.split()
+
+        ids = self.names.get(key)
+
+        if not ids and len(tokens) > 1:
+            ids = self.initials.get((tokens[0][0], tokens[-1]))
+
+        if not ids or len(ids) > 1:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        cricinfo_id = next(iter(ids))
+        return self.players[cricinfo_id]["name"], cricinfo_id
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {
+            "players": len(self.players),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
+
+
+@staticmethod
+def normalize_name(name: str) -> str:
+    # lowercase words, leading initials joined so "M.S. Dhoni", "M S Dhoni" and "MS Dhoni" are the same name
+    tokens = utils.default_process(name or "").split()
+
+    initials = ""
+    while len(tokens) > 1 and len(tokens[0]) == 1:
+        initials += tokens.pop(0)
+
+    return " ".join(([initials] if initials else []) + tokens)
+
+@staticmethod
+def read_register(path: Optional[str], file_name: str) -> list[dict]:
+    # a local copy of the register file, downloaded from cricsheet otherwise
+    if path is not None:
+        with open(path, "r", encoding="utf-8") as f:
+            return list(csv.DictReader(f))
+
+    with urllib.request.urlopen(REGISTER_URL + file_name) as response:
+        return list(csv.DictReader(io.StringIO(response.read().decode("utf-8"))))
+
+@staticmethod
+def build_directory(people: list[dict], names: list[dict], table_names: Optional[dict[str, str]] = None) -> dict:
+    '''
+    Builds the directory from the rows of people.csv and names.csv, table_names (cricsheet identifier -> name in the
+    players table) adds the names the ingested matches used. People without a cricinfo id are left out.
+    '''
+    cricinfo_ids = {}
+    players = {}
+
+    for person in people:
+        cricinfo_id = person.get("key_cricinfo")
+
+        if not cricinfo_id:
+            continue
+
+        cricinfo_ids[person["identifier"]] = cricinfo_id
+        players[cricinfo_id] = {
+            "name": person["unique_name"] or person["name"],
+            "aliases": [person["name"]],
+        }
+
+    other_names = [(row["identifier"], row["name"]) for row in names]
+    other_names.extend((table_names or {}).items())
+
+    for identifier, name in other_names:
+        cricinfo_id = cricinfo_ids.get(identifier)
+
+        if cricinfo_id is not None:
+            players[cricinfo_id]["aliases"].append(name)
+
+    for player in players.values():
+        player["aliases"] = sorted(set(player["aliases"]) - {player["name"]})
+
+    return {
+        "built_at": time.time(),
+        "players": players,
+    }
+
+@staticmethod
+def sync_players_table(engine, cricinfo_ids: dict[str, str]) -> dict[str, str]:
+    '''
+    Fills players.cricinfo_id from the register and returns the names of the players table, by cricsheet identifier.
+    '''
+    with engine.begin() as conn:
+        rows = conn.execute(sqlalchemy.text("SELECT external_id, name, cricinfo_id FROM players")).fetchall()
+
+        updates = [
+            {"external_id": external_id, "cricinfo_id": int(cricinfo_ids[external_id])}
+            for external_id, _, cricinfo_id in rows
+            if external_id in cricinfo_ids and cricinfo_id != int(cricinfo_ids[external_id])
+        ]
+
+        if updates:
+            conn.execute(sqlalchemy.text("UPDATE players SET cricinfo_id = :cricinfo_id WHERE external_id = :external_id"), updates)
+
+    logger.info(f"Set the cricinfo id of {len(updates)} players")
+
+    return {external_id: name for external_id, name, _ in rows if external_id is not None}
+
+
+if __name__ == "__main__":
+    # build step: python -m player_directory [--people people.csv] [--names names.csv] [--sql] [--output path]
+    parser = argparse.ArgumentParser(description="Build the player directory from the cricsheet people register")
+    parser.add_argument("--people", help="local people.csv, downloaded from cricsheet when not given")
+    parser.add_argument("--names", help="local names.csv, downloaded from cricsheet when not given")
+    parser.add_argument("--sql", action="store_true", help="also fill players.cricinfo_id and add the names of the players table")
+    parser.add_argument("--output", default=DIRECTORY_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    people = read_register(args.people, "people.csv")
+    names = read_register(args.names, "names.csv")
+
+    table_names = None
+    if args.sql:
+        from db.sqlclient import SQLClient
+
+        cricinfo_ids = {person["identifier"]: person["key_cricinfo"] for person in people if person.get("key_cricinfo")}
+        table_names = sync_players_table(SQLClient().engine, cricinfo_ids)
+
+    directory = build_directory(people, names, table_names)
+
+    with open(args.output, "w") as f:
+        json.dump(directory, f, separators=(",", ":"))
+
+    print(f"Wrote {len(directory['players'])} players to {args.output}")
@@ -0,0 +1,170 @@
+import re
+import copy
+import json
+import math
+import random
+import logging
+from collections import Counter, OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# words that don't change which stats are asked for, every other word of the query must be in both queries
+# ("in" is left out, "in the team" and "out of the team" differ only by it)
+STOPWORDS = {
+    "a", "an", "the", "of", "on", "at", "for", "to", "and", "by", "with", "from", "as",
+    "what", "whats", "is", "are", "was", "were", "his", "her", "their", "how", "did", "does", "do",
+    "show", "me", "give", "tell", "get", "list", "all", "s", "stats", "stat", "statistic", "statistics",
+    "record", "number", "figure", "career", "please", "about", "overall",
+    # generic words of the phrasings
+    "he", "she", "they", "him", "has", "have", "had", "been", "be", "can", "could", "would", "you", "i", "it", "its",
+    "this", "that", "which", "who", "want", "know", "find", "fetch", "display", "provide", "look", "like",
+    "so", "far", "ever", "much", "many", "total", "player", "cricket", "cricketer", "data", "detail", "detailed",
+    "breakdown", "summary", "perform", "performed", "performance", "score", "scored", "scoring",
+    "made", "make", "take", "taken", "took",
+}
+
+NGRAM_SIZE = 3
+
+
+class SimilarityCache:
+    '''
+    Reuses the resolved query parameters of past sub-queries for new sub-queries phrased differently.
+
+    Queries are compared with the cosine similarity of their character n-gram counts, after the player names and
+    stopwords are removed. A past query only matches when it scores above threshold and has the same set of remaining
+    words, so queries differing by a name, a team, a number or a qualifier ("day" / "day night") never share parameters.
+
+    A sample (verify_rate) of the hits is also resolved again by the caller to measure the false hit rate.
+    '''
+
+    def __init__(self, threshold: float = 0.9, max_entries: int = 5000, verify_rate: float = 0.05):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.verify_rate = verify_rate
+
+        # compared against stemmed tokens
+        self.stopwords = {stem(word) for word in STOPWORDS}
+
+        # (scope, normalized query) -> entry, least recently used first
+        self.entries: OrderedDict[tuple[str, str], dict] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.verified = 0
+        self.false_hits = 0
+
+    def normalize(self, query: str, exclude: Optional[list[str]] = None) -> tuple[str, frozenset]:
+        excluded = set()
+        for name in exclude or []:
+            if name:
+                excluded.update(tokenize(name))
+
+        tokens = [token for token in tokenize(query) if token not in self.stopwords and token not in excluded]
+
+        return " ".join(tokens), frozenset(tokens)
+
+    def lookup(self, scope: str, query: str, exclude: Optional[list[str]] = None) -> Optional[dict]:
+        '''
+        Returns a copy of the parameters of the most similar past query in the scope, or None.
+        '''
+        normalized, words = self.normalize(query, exclude)
+        vector = ngram_vector(normalized)
+
+        best_key = None
+        best_score = 0
+
+        for key, entry in self.entries.items():
+            if key[0] != scope or entry["words"] != words:
+                continue
+
+            score = cosine_similarity(vector, entry["vector"])
+            if score > best_score:
+                best_key, best_score = key, score
+
+        if best_key is None or best_score < self.threshold:
+            self.misses += 1
+            logger.info(f"Similarity cache miss for '{query}' (best score {best_score:.2f}), hit rate {self.get_hit_rate():.2f}")
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(best_key)
+
+        entry = self.entries[best_key]
+        logger.info(f"Similarity cache hit for '{query}' on '{entry['query']}' (score {best_score:.2f}), hit rate {self.get_hit_rate():.2f}")
+
+        return copy.deepcopy(entry["params"])
+
+    def add(self, scope: str, query: str, params: dict, exclude: Optional[list[str]] = None):
+        normalized, words = self.normalize(query, exclude)
+
+        key = (scope, normalized)
+
+        self.entries[key] = {
+            "query": query,
+            "vector": ngram_vector(normalized),
+            "words": words,
+            "params": copy.deepcopy(params),
+        }
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def should_verify(self) -> bool:
+        return random.random() < self.verify_rate
+
+    def record_verification(self, query: str, cached_params: dict, resolved_params: Optional[dict]):
+        '''
+        Compares the parameters reused for query with the ones resolved from scratch.
+        '''
+        self.verified += 1
+
+        if resolved_params is None or json.dumps(cached_params, sort_keys=True) != json.dumps(resolved_params, sort_keys=True):
+            self.false_hits += 1
+            logger.warning(f"Similarity cache false hit for '{query}': reused {cached_params}, resolved {resolved_params}")
+
+        logger.info(f"Similarity cache false hit rate {self.false_hits / self.verified:.2f} over {self.verified} verified hits")
+
+    def get_hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.get_hit_rate(),
+            "verified": self.verified,
+            "false_hits": self.false_hits,
+            "false_hit_rate": self.false_hits / self.verified if self.verified else None,
+        }
+
+
+@staticmethod
+def tokenize(text: str) -> list[str]:
+    tokens = []
+
+    for token in re.findall(r"[a-z0-9]+", str(text).lower().replace("'s", "")):
+        tokens.append(stem(token))
+
+    return tokens
+
+@staticmethod
+def stem(token: str) -> str:
+    # plurals, odis -> odi, wickets -> wicket
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+@staticmethod
+def ngram_vector(text: str) -> Counter:
+    padded = f" {text} "
+    return Counter(padded[i:i + NGRAM_SIZE] for i in range(max(len(padded) - NGRAM_SIZE + 1, 1)))
+
+@staticmethod
+def cosine_similarity(a: Counter, b: Counter) -> float:
+    dot = sum(count * b[ngram] for ngram, count in a.items() if ngram in b)
+    norm = math.sqrt(sum(count * count for count in a.values())) * math.sqrt(sum(count * count for count in b.values()))
+    return dot / norm if norm else 0
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the server modules import each other from the server folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,25 @@
+import pytest
+from similarity_cache import SimilarityCache
+
+PARAMS = {"type": "batting", "class_": 1}
+
+
+@pytest.mark.parametrize("cached_query, query", [
+    ("Kohli's test batting average and strike rate in home matches against Australia since 2015 under Dhoni captaincy",
+     "Kohli's test batting average and strike rate in home matches against Australia since 2015 under Rahane captaincy"),
+    ("How many runs has Kohli scored in ODIs with Rohit Sharma in the team", "How many runs has Kohli scored in ODIs with Rohit Sharma out of the team"),
+    ("What is Kohli's ODI batting average and strike rate against Australia in home matches since 2015 in day night games",
+     "What is Kohli's ODI batting average and strike rate against Australia in home matches since 2015 in day games"),
+])
+def test_queries_differing_by_a_qualifier_miss(cached_query, query):
+    cache = SimilarityCache()
+    cache.add("player_virat kohli", cached_query, PARAMS, exclude=["Kohli"])
+
+    assert cache.lookup("player_virat kohli", query, exclude=["Kohli"]) is None
+
+
+def test_rephrased_query_hits():
+    cache = SimilarityCache()
+    cache.add("player_virat kohli", "What is Kohli's batting average in day night games", PARAMS, exclude=["Kohli"])
+
+    assert cache.lookup("player_virat kohli", "Show me the batting average of Kohli in day night games", exclude=["Kohli"]) == PARAMS
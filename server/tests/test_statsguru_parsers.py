@@ -0,0 +1,33 @@
+import os
+import pytest
+from api_clients.cricinfo_client import CricInfoClient
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "statsguru")
+
+# saved statsguru result pages, the file name starts with the class_name the page is fetched with
+PAGES = sorted(file_name for file_name in os.listdir(FIXTURES_DIR) if file_name.endswith(".html"))
+
+
+@pytest.mark.parametrize("file_name", PAGES)
+def test_fast_parser_matches_beautifulsoup(file_name):
+    with open(os.path.join(FIXTURES_DIR, file_name), encoding="utf-8") as f:
+        html = f.read()
+
+    class_name = file_name.split("_")[0]
+
+    expected = CricInfoClient.extract_search_results(html, class_name)
+
+    assert expected
+    assert CricInfoClient.extract_search_results_fast(html, class_name) == expected
+
+
+def test_player_page_has_career_summary():
+    with open(os.path.join(FIXTURES_DIR, "player_kohli_odi_batting.html"), encoding="utf-8") as f:
+        html = f.read()
+
+    results = CricInfoClient.extract_search_results_fast(html, "player")
+
+    assert [row[""] for row in results[:2]] == ["unfiltered", "filtered"]
+    assert results[2]["Runs"] == "12"
+    # the empty spacer row is skipped, the comment left out
+    assert [row["Runs"] for row in results[2:]] == ["12", "183", "DNB", "0"]
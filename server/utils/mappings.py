@@ -0,0 +1,164 @@
+import os
+import sys
+import copy
+import json
+import hashlib
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+MAPPINGS_DIR = os.path.join('static', 'mappings')
+# built from MAPPINGS_DIR by running "python -m utils.mappings" from the server folder, see the Dockerfile
+INDEX_PATH = os.path.join('static', 'mappings_index.json')
+
+# file name prefix -> kind, the rest of the name is <type>_<view> (<type> for groupby)
+KINDS = {
+    "orderbyselect": "orderby",
+    "havingselect": "having",
+    "groupby": "groupby",
+}
+
+
+class MappingNotFoundError(LookupError):
+    pass
+
+
+@staticmethod
+def get_file_names(directory: str) -> list[str]:
+    # mappings.html next to them is the statsguru page they were taken from
+    return sorted(file_name for file_name in os.listdir(directory) if file_name.endswith(".json"))
+
+@staticmethod
+def get_fingerprint(directory: str = MAPPINGS_DIR) -> str:
+    # names, sizes and modification times, enough to notice an edited mapping without reading the files
+    entries = []
+    for file_name in get_file_names(directory):
+        stat = os.stat(os.path.join(directory, file_name))
+        entries.append([file_name, stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+@staticmethod
+def compile_mappings(directory: str = MAPPINGS_DIR) -> dict:
+    '''
+    Parses every mapping file into one index, {kind: {type: {view: fields}}} with the groupby fields under view "".
+    Raises ValueError on anything that would otherwise only fail at query time.
+    '''
+    index = {
+        "fingerprint": get_fingerprint(directory),
+        "mappings": {kind: {} for kind in KINDS.values()},
+        "incomplete": [],
+    }
+
+    errors = []
+
+    for file_name in get_file_names(directory):
+        name = file_name[:-len(".json")]
+        prefix, _, key = name.partition("_")
+
+        if prefix not in KINDS or not key:
+            errors.append(f"{file_name}: not a <orderbyselect|havingselect|groupby>_<type>[_<view>].json mapping")
+            continue
+
+        kind = KINDS[prefix]
+        type, _, view = key.partition("_")
+
+        if (kind == "groupby") != (view == ""):
+            errors.append(f"{file_name}: groupby mappings are per type, the others per type and view")
+            continue
+
+        try:
+            with open(os.path.join(directory, file_name), "r") as f:
+                fields = json.load(f)
+        except json.JSONDecodeError as e:
+            errors.append(f"{file_name}: {e}")
+            continue
+
+        if not isinstance(fields, dict) or not fields or not all(isinstance(value, str) for value in fields.values()):
+            errors.append(f"{file_name}: expected a non empty json object of strings")
+            continue
+
+        index["mappings"][kind].setdefault(type, {})[view] = fields
+
+    orderby = index["mappings"]["orderby"]
+    having = index["mappings"]["having"]
+    groupby = index["mappings"]["groupby"]
+
+    for type, views in having.items():
+        for view in views:
+            if view not in orderby.get(type, {}):
+                errors.append(f"havingselect_{type}_{view}: no orderbyselect for the same type and view")
+
+    # allowed, but the prompts for these can't be built, listed so it's known up front
+    for type, views in orderby.items():
+        for view in views:
+            if view not in having.get(type, {}):
+                index["incomplete"].append(f"havingselect_{type}_{view}")
+
+        if "default" in views and type not in groupby and type != "aggregate":
+            index["incomplete"].append(f"groupby_{type}")
+
+    if errors:
+        raise ValueError("Invalid mappings:\n" + "\n".join(errors))
+
+    return index
+
+@staticmethod
+def load_index() -> dict:
+    # the compiled index when it's up to date, otherwise compiled here (local runs without the build step)
+    fingerprint = get_fingerprint()
+
+    if os.path.exists(INDEX_PATH):
+        with open(INDEX_PATH, "r") as f:
+            index = json.load(f)
+
+        if index.get("fingerprint") == fingerprint:
+            return index
+
+        logger.warning(f"{INDEX_PATH} is out of date, compiling the mappings")
+
+    return compile_mappings()
+
+INDEX = load_index()
+MAPPINGS: dict[str, dict] = INDEX["mappings"]
+
+@staticmethod
+def get_mapping(kind: str, type: str, view: str = ""):
+    # a copy, callers are free to edit it
+    try:
+        fields = MAPPINGS[kind][type][view]
+    except KeyError:
+        raise MappingNotFoundError(f"No {kind} mapping for type {type} and view {view or None}")
+
+    return copy.deepcopy(fields)
+
+@staticmethod
+def has_mapping(kind: str, type: str, view: str = "") -> bool:
+    return view in MAPPINGS.get(kind, {}).get(type, {})
+
+@staticmethod
+def get_type_views(types: Optional[list[str]] = None) -> list[tuple[str, str]]:
+    # every (type, view) that has an orderby mapping
+    return [
+        (type, view)
+        for type, views in MAPPINGS["orderby"].items()
+        if types is None or type in types
+        for view in views
+    ]
+
+
+if __name__ == "__main__":
+    # build step: python -m utils.mappings [output path]
+    output_path = sys.argv[1] if len(sys.argv) > 1 else INDEX_PATH
+
+    index = compile_mappings()
+
+    with open(output_path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+
+    count = sum(len(views) for types in index["mappings"].values() for views in types.values())
+    print(f"Compiled {count} mappings into {output_path}")
+
+    for name in index["incomplete"]:
+        print(f"Missing {name}, prompts that need it can't be built")
@@ -0,0 +1,40 @@
+import logging
+from string import Template
+from datetime import datetime
+from typing import Callable, Optional
+from utils.mappings import MappingNotFoundError
+
+logger = logging.getLogger(__name__)
+
+
+class PromptRegistry:
+    '''
+    Prompts built once at import time, keyed by name and an optional (type, view) key.
+
+    Builders return the full prompt with the per request parts left as $placeholders (string.Template),
+    get() only substitutes those, $current_time is always filled in.
+    '''
+
+    def __init__(self):
+        self.templates: dict[tuple, Template] = {}
+
+    def register(self, name: str, builder: Callable[..., str], keys: Optional[list[tuple]] = None):
+        for key in keys or [()]:
+            try:
+                self.templates[(name, key)] = Template(builder(*key))
+            except MappingNotFoundError as e:
+                # the type/view has no mapping for this prompt, same as before it's only an error when asked for
+                logger.debug(f"Skipping prompt {name} {key}: {e}")
+
+    def get(self, name: str, key: tuple = (), **values) -> str:
+        template = self.templates.get((name, key))
+
+        if template is None:
+            raise ValueError(f"Prompt {name} not found for {key}")
+
+        values.setdefault("current_time", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+        return template.safe_substitute(values)
+
+
+prompts = PromptRegistry()
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls with the same key into one execution, every caller awaits the same result.
+
+    The execution runs in its own task, so a caller that is cancelled (client went away) doesn't cancel it for the
+    others, it's only cancelled once every caller waiting on it is gone. Exceptions are raised to every caller and
+    nothing is remembered once the call finishes, caching the result is up to the caller.
+    '''
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+
+        # key -> [task, number of callers waiting]
+        self.calls: dict[Hashable, list] = {}
+
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        call = self.calls.get(key)
+
+        if call is None:
+            call = [asyncio.ensure_future(func()), 0]
+            self.calls[key] = call
+            self.executions += 1
+
+            call[0].add_done_callback(lambda _: self.forget(key, call))
+        else:
+            self.coalesced += 1
+            logger.info(f"{self.name}: coalesced call for {key}")
+
+        call[1] += 1
+
+        try:
+            return await asyncio.shield(call[0])
+        except asyncio.CancelledError:
+            if call[1] == 1 and not call[0].done():
+                call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+    def forget(self, key: Hashable, call: list):
+        # a newer call for the key may already be in flight
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    def stats(self) -> dict:
+        calls = self.executions + self.coalesced
+        return {
+            "in_flight": len(self.calls),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / calls if calls else 0,
+        }
@@ -0,0 +1,42 @@
+import asyncio
+import logging
+from typing import Any, Coroutine
+
+logger = logging.getLogger(__name__)
+
+
+class SpeculativeTasks:
+    '''
+    Work started before it's known to be needed, so it overlaps with the llm calls.
+
+    take() awaits a task that turned out to be needed, anything still running when it's not needed is cancelled
+    with cancel() or cancel_all().
+    '''
+
+    def __init__(self):
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    def start(self, name: str, coro: Coroutine):
+        task = asyncio.create_task(coro)
+        # errors of cancelled or never taken tasks are only logged
+        task.add_done_callback(log_exception)
+        self.tasks[name] = task
+
+    async def take(self, name: str) -> Any:
+        return await self.tasks.pop(name)
+
+    def cancel(self, name: str):
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    def cancel_all(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+
+
+@staticmethod
+def log_exception(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Speculative task failed: {task.exception()}")